@@ -0,0 +1,384 @@
+"""
+Benchmark of the planners against the local mock LLM backend, no network access or api key needed.
+Each scenario reports wall time, LLM calls, tokens and peak memory. Results can be saved and compared against
+an earlier run to catch performance regressions:
+
+    python src/benchmark.py --output baseline.json
+    python src/benchmark.py --baseline baseline.json
+"""
+import os
+
+# Function tracing is disabled before the planner modules are imported and decorated
+os.environ.setdefault("TRACE_LEVEL", "off")
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import openai_api
+import prompt_evolver
+from guidance_prompts import htn_prompts
+from htn_planner import HTNPlanner
+from llm_backend import MockBackend, set_backend
+from llm_cache import CACHE_MODE_OFF
+from llm_client import AsyncLLMClient
+from openai_api import response_cache
+from graph_manager import GraphManager
+from graph_search import dijkstra, bidirectional_dijkstra, yen_k_shortest_paths
+from search_planner import SearchPlanner
+from text_utils import extract_lists
+
+INITIAL_STATE = "A fresh Ubuntu installation with no development tools"
+GOAL_TASK = "Set up a Python web server that serves a hello world page"
+CAPABILITIES = "Linux terminal, internet access"
+
+# Size of the synthetic graph searched by the graph_search scenario
+GRAPH_SEARCH_NODES = 20000
+
+# Generated responses extract_lists is checked against the legacy parser on, and the items in each of the large
+# responses it's timed on
+EXTRACT_LISTS_CASES = 5000
+EXTRACT_LISTS_LARGE_ITEMS = 300
+EXTRACT_LISTS_WORDS = ["install", "python", "git", "configure", "nginx", "server", "page", "the", "hello", "world",
+                       "create", "directory", "file", "package", "run", "check", "version"]
+EXTRACT_LISTS_COMMANDS = ["apt install git", "pip install flask", "ls -la", "mkdir -p app", "python3 -m http.server"]
+
+# Allowed slowdown before a scenario is reported as a regression
+DEFAULT_TOLERANCE = 0.2
+# Allowed increase of the LLM calls. The mock responses are deterministic but the concurrent expansion rounds of the
+# search planner finish in any order, which changes the graph and the calls made by a few percent between runs
+DEFAULT_CALL_TOLERANCE = 0.05
+
+
+def count_nodes(task_node):
+    if task_node is None:
+        return 0
+    return 1 + sum(count_nodes(child) for child in task_node.children)
+
+
+def numbered_counter(template):
+    counter = iter(range(1, sys.maxsize))
+    return lambda prompt: template.format(next(counter))
+
+
+def score_weights(prompt):
+    edge_count = len(re.findall(r"\d+\. From state", prompt))
+    return json.dumps([float(10 + number % 7) for number in range(edge_count)])
+
+
+def rate_solution(prompt):
+    # Stable pseudo random rating so that the prompt evolver sees a spread of fitness scores
+    return f"{zlib.crc32(prompt.encode('utf-8')) % 100 / 100:.2f}"
+
+
+def streamed_subtasks(prompt):
+    task = re.match(r"^Given the task '(.*?)', the current state", prompt, re.S).group(1)
+    return ", ".join(f"[{task} / step {number}]" for number in range(1, 4))
+
+
+def mock_backend(latency, failure_rate, seed):
+    responses = [
+        (r"determine if the current state satisfies the goal", "False"),
+        (r"determine if the task can be executed", "True"),
+        (r"Describe the state '.*' as a JSON object of facts",
+         json.dumps({"operating system": "Ubuntu", "development tools": "none installed"})),
+        (r"list the facts that change after executing the task",
+         lambda prompt: json.dumps({re.search(r"and the task '(.*)', list", prompt, re.S).group(1): "done"})),
+        (r"generate a single task that transitions", numbered_counter("Intermediate task {}")),
+        (r"^Translate the task '(.*?)'", lambda prompt: "run " + re.match(r"^Translate the task '(.*?)'", prompt,
+                                                                         re.S).group(1)),
+        (r"weights of the following edges", score_weights),
+        (r"estimate the remaining cost", "10.0"),
+        (r"^Given the task '(.*?)', the current state", streamed_subtasks),
+        (r"^Generate a diverse prompt", numbered_counter("Initial prompt {}")),
+        (r"^Modify the following prompt", numbered_counter("Mutated prompt {}")),
+        (r"^Create a new prompt by combining", numbered_counter("Combined prompt {}")),
+        (r"^Rate the quality of the solution", rate_solution),
+        (r"^(Initial|Mutated|Combined) prompt", lambda prompt: f"Solution for {prompt[:40]}"),
+    ]
+    program_responses = {
+        "get_subtasks": lambda variables: {
+            "subtasks_list": ", ".join(f"[{variables['task']} / step {number}]" for number in range(1, 4))
+        },
+        "evaluate_candidate": {"score": "0.85000000"},
+        "check_subtasks": {"result": "True"},
+        "is_task_primitive": lambda variables: {
+            "choice": "primitive" if variables["task_name"].count("/ step") >= 2 else "compound"
+        },
+        "translate": lambda variables: {"translated_task": f"run {variables['task']}"},
+        "classify_subtasks": lambda variables: {"classifications": json.dumps([
+            {"index": number, "type": "primitive", "translation": f"run {task_name}"}
+            if task_name.count("/ step") >= 2 else {"index": number, "type": "compound"}
+            for number, task_name in enumerate(variables["task_names"], start=1)
+        ])},
+    }
+    return MockBackend(responses=responses, program_responses=program_responses, latency=latency,
+                       failure_rate=failure_rate, seed=seed)
+
+
+def run_htn_planner():
+    planner = HTNPlanner(INITIAL_STATE, GOAL_TASK, CAPABILITIES, max_depth=3, use_method_library=False)
+    return {"plan_nodes": count_nodes(planner.htn_planning())}
+
+
+def run_search_planner():
+    planner = SearchPlanner(INITIAL_STATE, GOAL_TASK, CAPABILITIES, max_iterations=40)
+    return {"plan_nodes": count_nodes(planner.plan())}
+
+
+def run_prompt_evolver():
+    prompt_evolver.main(GOAL_TASK, max_generations=2)
+    return {}
+
+
+def run_graph_search():
+    # The graph is built the way SearchPlanner.construct_graph grows it, an intermediate task between two
+    # random tasks per round, and searched without the LLM heuristic
+    graph_manager = GraphManager()
+    graph_manager.add_edge(INITIAL_STATE, GOAL_TASK, float('inf'))
+    for number in range(GRAPH_SEARCH_NODES):
+        task_a, task_b = graph_manager.select_random_tasks(INITIAL_STATE, GOAL_TASK)
+        intermediate_task = f"Intermediate task {number} between '{task_a[:40]}' and '{task_b[:40]}'"
+        graph_manager.add_edge(task_a, intermediate_task, random.uniform(1, 100))
+        graph_manager.add_edge(intermediate_task, task_b, random.uniform(1, 100))
+        if graph_manager.has_edge(task_a, task_b):
+            graph_manager.delete_edge(task_a, task_b)
+
+    start = graph_manager.node_id(INITIAL_STATE)
+    goal = graph_manager.node_id(GOAL_TASK)
+    result = {}
+    searches = {
+        "dijkstra": lambda: dijkstra(graph_manager, start, goal),
+        "bidirectional": lambda: bidirectional_dijkstra(graph_manager, start, goal),
+        "k_shortest": lambda: yen_k_shortest_paths(graph_manager, start, goal, 3),
+    }
+    for name, search in searches.items():
+        search_start = time.perf_counter()
+        search()
+        result[f"{name}_ms"] = (time.perf_counter() - search_start) * 1000
+    _, path = dijkstra(graph_manager, start, goal)
+    result["plan_nodes"] = len(path)
+    return result
+
+
+def legacy_extract_lists(text, restore_by_position=False):
+    """
+    The parser extract_lists replaced, kept to time it against and as the reference extract_lists is checked
+    against. It restores URLs and commands in the order they were found, so an item can get the URL of an earlier
+    one that isn't part of any item. With restore_by_position each placeholder gets back the text it replaced.
+    """
+    subtask_pattern = r'\[((?:[^\[\]]|\[[^\[\]]*\])*)\]'
+    url_pattern = r'https?://\S+'
+    command_pattern = r"(?<!\[)'(?:[^']|'')*?'(?!\])"
+    backtick_command_pattern = r"`(.+?)`"
+
+    url_placeholder = "URL_PLACEHOLDER"
+    command_placeholder = "COMMAND_PLACEHOLDER"
+    urls_replacements = re.findall(url_pattern, text)
+    commands_replacements = re.findall(command_pattern, text)
+    if restore_by_position:
+        urls_replacements, commands_replacements = [], []
+        text = re.sub(url_pattern, lambda match: urls_replacements.append(match.group(0)) or
+                      f"{url_placeholder}{len(urls_replacements) - 1}_", text)
+        text = re.sub(command_pattern, lambda match: commands_replacements.append(match.group(0)) or
+                      f"{command_placeholder}{len(commands_replacements) - 1}_", text)
+    else:
+        text = re.sub(url_pattern, url_placeholder, text)
+        text = re.sub(command_pattern, command_placeholder, text)
+
+    combined_list = re.findall(subtask_pattern, text) + re.findall(backtick_command_pattern, text)
+
+    cleaned_list = []
+    for item in combined_list:
+        cleaned_item = item.rstrip('.!?')
+        if len(cleaned_item) < len(item) and re.search(r'\w$', item):
+            cleaned_item += item[-1]
+        if restore_by_position:
+            # Commands can contain URL placeholders, so they're restored first
+            cleaned_item = re.sub(rf"{command_placeholder}(\d+)_",
+                                  lambda match: commands_replacements[int(match.group(1))], cleaned_item)
+            cleaned_item = re.sub(rf"{url_placeholder}(\d+)_",
+                                  lambda match: urls_replacements[int(match.group(1))], cleaned_item)
+        else:
+            while url_placeholder in cleaned_item and urls_replacements:
+                cleaned_item = cleaned_item.replace(url_placeholder, urls_replacements.pop(0), 1)
+            while command_placeholder in cleaned_item and commands_replacements:
+                cleaned_item = cleaned_item.replace(command_placeholder, commands_replacements.pop(0), 1)
+        cleaned_list.append(cleaned_item)
+    return cleaned_list
+
+
+def random_subtask_item():
+    # A subtask with the parts LLM responses contain: URLs, quoted and backtick commands, nested brackets and
+    # trailing punctuation
+    parts = []
+    for _ in range(random.randint(1, 12)):
+        kind = random.random()
+        if kind < 0.08:
+            # URLs run to the next whitespace, so one never ends an item
+            parts.append(f"https://{random.choice(EXTRACT_LISTS_WORDS)}.com/{random.choice(EXTRACT_LISTS_WORDS)}")
+            parts.append(random.choice(EXTRACT_LISTS_WORDS))
+        elif kind < 0.16:
+            parts.append(f"'{random.choice(EXTRACT_LISTS_COMMANDS)}'")
+        elif kind < 0.24:
+            parts.append(f"`{random.choice(EXTRACT_LISTS_COMMANDS)}`")
+        elif kind < 0.28:
+            parts.append(f"[{random.choice(EXTRACT_LISTS_WORDS)}]")
+        else:
+            parts.append(random.choice(EXTRACT_LISTS_WORDS))
+    return " ".join(parts) + random.choice(["", "", ".", "!", "?", "..."])
+
+
+def random_subtask_response(item_count):
+    separator = random.choice([", ", ",\n", "\n- "])
+    items = separator.join(f"[{random_subtask_item()}]" for _ in range(item_count))
+    return random.choice(["", "Here are the subtasks: ", "Subtasks:\n"]) + items + random.choice(["", "."])
+
+
+def run_extract_lists():
+    # Property check against the legacy parser on generated responses, then a micro benchmark on large ones
+    for _ in range(EXTRACT_LISTS_CASES):
+        text = random_subtask_response(random.randint(0, 10))
+        if extract_lists(text) != legacy_extract_lists(text, restore_by_position=True):
+            raise ValueError(f"extract_lists differs from the legacy parser on:\n{text}")
+
+    responses = [random_subtask_response(EXTRACT_LISTS_LARGE_ITEMS) for _ in range(20)]
+    result = {"response_kb": sum(len(text) for text in responses) / len(responses) / 1024}
+    for name, parse in (("legacy", legacy_extract_lists), ("extract_lists", extract_lists)):
+        parse_start = time.perf_counter()
+        for text in responses:
+            parse(text)
+        result[f"{name}_ms"] = (time.perf_counter() - parse_start) * 1000 / len(responses)
+    return result
+
+
+SCENARIOS = {
+    "extract_lists": run_extract_lists,
+    "graph_search": run_graph_search,
+    "htn_planner": run_htn_planner,
+    "search_planner": run_search_planner,
+    "prompt_evolver": run_prompt_evolver,
+}
+
+
+@contextlib.contextmanager
+def scenario_llm_client():
+    # Each scenario gets its own client without rate limits, the mock backend has none and a scenario mustn't wait
+    # for the budget the previous ones used. The concurrency limit is kept
+    client = AsyncLLMClient(openai_api.MODEL_NAME, requests_per_minute=None, tokens_per_minute=None)
+    previous_client = openai_api.set_llm_client(client)
+    htn_prompts.program_registry.client = client
+    try:
+        yield client
+    finally:
+        openai_api.set_llm_client(previous_client)
+        htn_prompts.program_registry.client = previous_client
+
+
+def run_scenario(name, latency, failure_rate, seed):
+    backend = mock_backend(latency, failure_rate, seed)
+    set_backend(backend)
+    random.seed(seed)
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), scenario_llm_client():
+        result = SCENARIOS[name]()
+    wall_seconds = time.perf_counter() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = backend.stats()
+    result.update({
+        "wall_seconds": wall_seconds,
+        "llm_calls": stats["calls"],
+        "llm_failures": stats["failures"],
+        "prompt_tokens": stats["prompt_tokens"],
+        "completion_tokens": stats["completion_tokens"],
+        "peak_memory_mb": peak_memory / (1024 * 1024),
+    })
+    return result
+
+
+def find_regressions(results, baseline, tolerance, call_tolerance=DEFAULT_CALL_TOLERANCE):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        previous = baseline[name]
+        if result["wall_seconds"] > previous["wall_seconds"] * (1 + tolerance):
+            regressions.append(f"{name}: wall time {previous['wall_seconds']:.2f}s -> {result['wall_seconds']:.2f}s")
+        if result["llm_calls"] > previous["llm_calls"] * (1 + call_tolerance):
+            regressions.append(f"{name}: LLM calls {previous['llm_calls']} -> {result['llm_calls']}")
+        if result["prompt_tokens"] + result["completion_tokens"] > \
+                (previous["prompt_tokens"] + previous["completion_tokens"]) * (1 + tolerance):
+            regressions.append(f"{name}: tokens increased beyond {tolerance:.0%}")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'scenario':<16}{'wall (s)':>10}{'calls':>8}{'tokens':>10}{'peak MB':>10}{'nodes':>8}")
+    for name, result in results.items():
+        tokens = result["prompt_tokens"] + result["completion_tokens"]
+        print(f"{name:<16}{result['wall_seconds']:>10.2f}{result['llm_calls']:>8}{tokens:>10}"
+              f"{result['peak_memory_mb']:>10.1f}{result.get('plan_nodes', '-'):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the planners against the mock LLM backend")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                        help="Scenario to run, may be repeated (default: all)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the mock backend waits per call")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of mock calls that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the results against a JSON file written with --output")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--call-tolerance", type=float, default=DEFAULT_CALL_TOLERANCE)
+    args = parser.parse_args()
+
+    # Every call must reach the mock backend to be counted, and nothing is written to the real cache
+    response_cache.mode = CACHE_MODE_OFF
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    results = {}
+    original_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_directory:
+        # The planners write their logs relative to the working directory
+        run_directory = os.path.join(temp_directory, "run")
+        os.makedirs(run_directory)
+        os.chdir(run_directory)
+        try:
+            for name in args.scenario or sorted(SCENARIOS):
+                results[name] = run_scenario(name, args.latency, args.failure_rate, args.seed)
+        finally:
+            os.chdir(original_directory)
+
+    print_results(results)
+
+    if output_path:
+        with open(output_path, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if baseline_path:
+        with open(baseline_path) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance,
+                                           args.call_tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
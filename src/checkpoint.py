@@ -0,0 +1,83 @@
+"""
+Checkpoints of long running planning sessions, so that a crash doesn't throw away the LLM work already paid for.
+
+A checkpoint is a JSON lines file. The first line is a header with the format version, the kind of session and
+the arguments needed to restart it, every following line is one record of the session's progress. Checkpoints
+are written to a temporary file and moved over the previous one, so a crash while saving leaves the last
+complete checkpoint in place.
+
+    CHECKPOINT_INTERVAL - Minimum number of seconds between periodic checkpoints (default 60)
+"""
+import json
+import os
+import threading
+import time
+
+CHECKPOINT_FORMAT = "gpt-htn-planner-checkpoint"
+CHECKPOINT_VERSION = 1
+DEFAULT_CHECKPOINT_INTERVAL = 60.0
+
+
+def write_checkpoint(path, kind, meta, records):
+    checkpoint_dir = os.path.dirname(path)
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    header = {"format": CHECKPOINT_FORMAT, "version": CHECKPOINT_VERSION, "kind": kind, "created": time.time(),
+              "meta": meta}
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as checkpoint_file:
+        checkpoint_file.write(json.dumps(header) + "\n")
+        for record in records:
+            checkpoint_file.write(json.dumps(record) + "\n")
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temp_path, path)
+
+
+def read_checkpoint(path, kind):
+    # Returns the header meta and the records of a checkpoint written by write_checkpoint for the given kind
+    with open(path) as checkpoint_file:
+        header = json.loads(checkpoint_file.readline())
+        if header.get("format") != CHECKPOINT_FORMAT:
+            raise ValueError(f"{path} is not a planner checkpoint.")
+        if header.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {header.get('version')} in {path}, "
+                             f"expected {CHECKPOINT_VERSION}.")
+        if header.get("kind") != kind:
+            raise ValueError(f"{path} is a {header.get('kind')} checkpoint, expected {kind}.")
+        records = [json.loads(line) for line in checkpoint_file if line.strip()]
+    return header["meta"], records
+
+
+def read_checkpoint_kind(path):
+    with open(path) as checkpoint_file:
+        return json.loads(checkpoint_file.readline()).get("kind")
+
+
+class Checkpointer:
+    """
+    Saves the records of a session to path, at most once every interval_seconds unless forced.
+    """
+
+    def __init__(self, path, kind, meta, interval_seconds=None):
+        self.path = path
+        self.kind = kind
+        self.meta = meta
+        if interval_seconds is None:
+            interval_seconds = float(os.environ.get("CHECKPOINT_INTERVAL", DEFAULT_CHECKPOINT_INTERVAL))
+        self.interval_seconds = interval_seconds
+        self.saved_at = time.monotonic()
+        self.saves = 0
+        self._lock = threading.Lock()
+
+    def save(self, records_function):
+        # records_function is only called when a checkpoint is written, it returns the records to save
+        with self._lock:
+            write_checkpoint(self.path, self.kind, self.meta, records_function())
+            self.saved_at = time.monotonic()
+            self.saves += 1
+
+    def maybe_save(self, records_function):
+        if time.monotonic() - self.saved_at >= self.interval_seconds:
+            self.save(records_function)
@@ -0,0 +1,82 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_client import DEFAULT_MAX_CONCURRENCY
+
+# Worker threads mostly wait on the LLM client, which enforces the real concurrency limit for the API calls and the
+# guidance programs alike. Twice its slots keeps enough requests waiting for the client to share the slots between
+# plans, the rest stay queued in the pool where speculative calls can still be cancelled
+LLM_WORKERS_PER_SLOT = 2
+# Threads shared by the parallel sibling expansions of every plan, whatever the depth of the decomposition
+DEFAULT_SIBLING_WORKERS = 8
+
+_llm_executor = None
+_sibling_executor = None
+_llm_executor_lock = threading.Lock()
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor that runs each task in a copy of the submitting thread's context,
+    so that context variables set by the caller are visible inside the worker.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        context = contextvars.copy_context()
+        return super().submit(context.run, fn, *args, **kwargs)
+
+
+class NestingThreadPoolExecutor(ContextThreadPoolExecutor):
+    """
+    Pool for tasks that wait on tasks submitted from inside the pool. try_submit only hands a task to the pool when
+    a worker is free for it and returns None otherwise, the caller then runs the task itself. Nested submissions
+    never wait on a full pool and the number of threads stays bounded by max_workers.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix=""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._free_workers = threading.BoundedSemaphore(max_workers)
+
+    def try_submit(self, fn, /, *args, **kwargs):
+        if not self._free_workers.acquire(blocking=False):
+            return None
+        try:
+            return self.submit(self._run_on_free_worker, fn, *args, **kwargs)
+        except BaseException:
+            self._free_workers.release()
+            raise
+
+    def _run_on_free_worker(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._free_workers.release()
+
+
+def get_llm_executor():
+    # Shared pool for independent LLM calls, tasks submitted to it must not wait on other tasks in the same pool
+    global _llm_executor
+
+    with _llm_executor_lock:
+        if _llm_executor is None:
+            max_concurrency = int(os.environ.get("OPENAI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+            max_workers = int(os.environ.get("LLM_WORKERS", LLM_WORKERS_PER_SLOT * max_concurrency))
+            _llm_executor = ContextThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-worker")
+        return _llm_executor
+
+
+def get_sibling_executor():
+    global _sibling_executor
+
+    with _llm_executor_lock:
+        if _sibling_executor is None:
+            max_workers = int(os.environ.get("SIBLING_WORKERS", DEFAULT_SIBLING_WORKERS))
+            _sibling_executor = NestingThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="htn-sibling")
+        return _sibling_executor
+
+
+def cancel_pending(futures):
+    for future in futures:
+        future.cancel()
@@ -1,40 +1,179 @@
-import React, { useEffect, useState } from 'react';
+import React, { createContext, useContext, useEffect, useRef, useState, useSyncExternalStore } from 'react';
 import io from 'socket.io-client';
 
+// Walks up the parent index to build the list of node names from the root to nodeName
+const pathTo = (parents, nodeName) => {
+  const path = [];
+  let current = nodeName;
+  while (current !== undefined && current !== null) {
+    path.unshift(current);
+    current = parents[current];
+  }
+  return path;
+};
+
+// Returns a copy of the tree where only the nodes along the path are replaced, so unchanged subtrees keep their identity
+const updateAt = (node, path, depth, update) => {
+  if (depth === path.length - 1) return update(node);
+  const childName = path[depth + 1];
+  return {
+    ...node,
+    children: node.children.map((child) => (child.node_name === childName ? updateAt(child, path, depth + 1, update) : child)),
+  };
+};
+
+const indexParents = (node, parent = null, parents = {}) => {
+  if (!node) return parents;
+  parents[node.node_name] = parent;
+  node.children.forEach((child) => indexParents(child, node.node_name, parents));
+  return parents;
+};
+
+const removeFromIndex = (node, parents) => {
+  delete parents[node.node_name];
+  node.children.forEach((child) => removeFromIndex(child, parents));
+};
+
+const applyPatch = (root, patch, parents) => {
+  switch (patch.op) {
+    case 'node-added': {
+      const newNode = { node_name: patch.node_name, task_name: patch.task_name, status: patch.status, children: [] };
+      parents[patch.node_name] = patch.parent;
+      if (patch.parent === null) return newNode;
+      return updateAt(root, pathTo(parents, patch.parent), 0, (node) => ({ ...node, children: [...node.children, newNode] }));
+    }
+    case 'node-removed':
+      return updateAt(root, pathTo(parents, patch.parent), 0, (node) => {
+        node.children.filter((child) => child.node_name === patch.node_name).forEach((child) => removeFromIndex(child, parents));
+        return { ...node, children: node.children.filter((child) => child.node_name !== patch.node_name) };
+      });
+    case 'status-changed':
+      return updateAt(root, pathTo(parents, patch.node_name), 0, (node) => ({ ...node, status: patch.status }));
+    case 'renamed':
+      return updateAt(root, pathTo(parents, patch.node_name), 0, (node) => ({ ...node, task_name: patch.task_name }));
+    default:
+      return root;
+  }
+};
+
+// parent node_name -> candidate -> subtasks streamed so far, shown until the accepted children are added.
+// Kept outside of the React state so that a streamed subtask only re-renders the node it belongs to
+const createStreamedStore = () => {
+  let streamed = {};
+  const listeners = new Set();
+  return {
+    get: (nodeName) => streamed[nodeName],
+    update: (updater) => {
+      streamed = updater(streamed);
+      listeners.forEach((listener) => listener());
+    },
+    subscribe: (listener) => {
+      listeners.add(listener);
+      return () => listeners.delete(listener);
+    },
+  };
+};
+
+const StreamedContext = createContext(null);
+
+// Memoized so that only the nodes along a changed path or with new streamed subtasks re-render
+const TaskNodeView = React.memo(({ node, candidates }) => (
+  <li>
+    {node.task_name} ({node.status}) {/* Display the task status */}
+    {candidates && node.children.length === 0 && (
+      <ul>
+        {Object.entries(candidates).map(([candidate, subtasks]) => (
+          <li key={candidate}><em>Candidate {Number(candidate) + 1}: {subtasks.join(', ')}</em></li>
+        ))}
+      </ul>
+    )}
+    {node.children.length > 0 && (
+      <ul>
+        {node.children.map((child) => <StreamedTaskNodeView key={child.node_name} node={child} />)}
+      </ul>
+    )}
+  </li>
+));
+
+// Passes a node only its own streamed candidates, which keep their identity until one of them changes
+const StreamedTaskNodeView = ({ node }) => {
+  const store = useContext(StreamedContext);
+  const candidates = useSyncExternalStore(store.subscribe, () => store.get(node.node_name));
+  return <TaskNodeView node={node} candidates={candidates} />;
+};
+
 function HTNPlanner() {
   const [taskNode, setTaskNode] = useState(null);
   const [socket, setSocket] = useState(null);
+  const streamed = useRef(null);
+  if (streamed.current === null) streamed.current = createStreamedStore();
+  const sequence = useRef(0);
+  const parents = useRef({});
+  const awaitingSnapshot = useRef(true);
 
   useEffect(() => {
     const newSocket = io('http://localhost:5000');
     setSocket(newSocket);
+    // With the planning service, ?job=<job_id> follows one job, its updates are sent to the job's room only
+    const jobId = new URLSearchParams(window.location.search).get('job');
+    const requestSnapshot = () => {
+      if (jobId) {
+        newSocket.emit('join_job', { job_id: jobId });
+      } else {
+        newSocket.emit('request_snapshot');
+      }
+    };
+
+    newSocket.on('connect', () => {
+      if (jobId) requestSnapshot();
+    });
+
+    // Sent on connect and whenever a patch was missed
+    newSocket.on('task_tree_snapshot', (data) => {
+      if (jobId && data.job_id !== jobId) return;
+      sequence.current = data.seq;
+      parents.current = indexParents(data.tree);
+      awaitingSnapshot.current = false;
+      setTaskNode(data.tree);
+    });
 
-    newSocket.on('task_node_update', (data) => {
-      setTaskNode(data);
+    newSocket.on('task_tree_patch', (data) => {
+      if (awaitingSnapshot.current || data.seq <= sequence.current) return;
+      if (data.seq !== sequence.current + 1) {
+        awaitingSnapshot.current = true;
+        requestSnapshot();
+        return;
+      }
+      sequence.current = data.seq;
+      setTaskNode((root) => data.patches.reduce((tree, patch) => applyPatch(tree, patch, parents.current), root));
+      const decomposed = data.patches.filter((patch) => patch.op === 'node-added' && patch.parent !== null);
+      if (decomposed.length > 0) {
+        streamed.current.update((current) => {
+          const remaining = { ...current };
+          decomposed.forEach((patch) => delete remaining[patch.parent]);
+          return remaining;
+        });
+      }
+    });
+
+    newSocket.on('subtask_streamed', (data) => {
+      if (jobId && data.job_id !== jobId) return;
+      streamed.current.update((current) => {
+        const candidates = current[data.parent] || {};
+        const subtasks = candidates[data.candidate] || [];
+        return { ...current, [data.parent]: { ...candidates, [data.candidate]: [...subtasks, data.task_name] } };
+      });
     });
 
     return () => newSocket.close();
   }, []);
 
-  // Render the task node as a tree
-  const renderTaskNode = (node) => {
-    if (!node) return null;
-    return (
-      <li>
-        {node.task_name} ({node.status}) {/* Display the task status */}
-        {node.children.length > 0 && (
-          <ul>
-            {node.children.map((child) => renderTaskNode(child))}
-          </ul>
-        )}
-      </li>
-    );
-  };
-
   return (
     <div>
       <h1>HTN Planner Visualization</h1>
-      <ul>{renderTaskNode(taskNode)}</ul>
+      <StreamedContext.Provider value={streamed.current}>
+        <ul>{taskNode && <StreamedTaskNodeView node={taskNode} />}</ul>
+      </StreamedContext.Provider>
     </div>
   );
 }
@@ -0,0 +1,48 @@
+import threading
+
+from gpt4_utils import gpt4_is_goal
+from world_state import WorldState
+
+
+class GoalChecker:
+    """
+    Decides whether a state satisfies a goal, decisions are memoized by (state version, goal) so the checks of
+    replan_required and htn_planning_recursive on the same state share one LLM call.
+    Every new decision goes to the LLM. A local similarity check can't settle any of them: hashed word features
+    can't tell "goal: X" or "X is pending" from X done, and a paraphrased goal shares no words with the state.
+    """
+
+    def __init__(self, is_goal=gpt4_is_goal):
+        # is_goal(state, goal) is the authoritative check
+        self.is_goal_llm = is_goal
+        self.memo = {}
+        self.memo_hits = 0
+        self.llm_decisions = 0
+        self._lock = threading.Lock()
+
+    def state_key(self, state):
+        # World states are never modified so their version identifies them, free text states are their own key
+        return state.version if isinstance(state, WorldState) else state
+
+    def is_goal(self, state, goal):
+        key = (self.state_key(state), goal)
+        with self._lock:
+            if key in self.memo:
+                self.memo_hits += 1
+                return self.memo[key]
+
+        result = self.is_goal_llm(state, goal)
+
+        with self._lock:
+            self.llm_decisions += 1
+            self.memo[key] = result
+        return result
+
+    def stats(self):
+        with self._lock:
+            checks = self.memo_hits + self.llm_decisions
+            return {
+                "memo_hits": self.memo_hits,
+                "llm_decisions": self.llm_decisions,
+                "memo_rate": self.memo_hits / checks if checks else 0.0,
+            }
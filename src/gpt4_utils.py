@@ -1,23 +1,29 @@
 import datetime
+import json
 import os
+import threading
 from openai_api import call_openai_api, log_response
 from text_utils import trace_function_calls
+from telemetry import llm_stage
 from guidance_prompts import htn_prompts
+from world_state import WorldState, parse_facts, render_state
 
 # Determines if the current world state matches the goal state
 @trace_function_calls
+@llm_stage("is_goal")
 def gpt4_is_goal(state, goal_task):
-    prompt = (f"Given the current state '{state}' and the goal '{goal_task}', "
+    prompt = (f"Given the current state '{render_state(state, goal_task)}' and the goal '{goal_task}', "
               f"determine if the current state satisfies the goal. "
               f"Please provide the answer as 'True' or 'False':")
 
-    response = call_openai_api(prompt)
+    response = call_openai_api(prompt, temperature=0)
 
     log_response("gpt4_is_goal", response.choices[0].message.content.strip())
     return response.choices[0].message.content.strip().lower() == "true"
 
 # Provides an initial high level task that is likely to meet the goal requirements to start performing decomposition from
 @trace_function_calls
+@llm_stage("initial_task")
 def get_initial_task(goal):
     prompt = f"Given the goal '{goal}', suggest a high level task that will complete it:"
 
@@ -26,39 +32,157 @@ def get_initial_task(goal):
     return response.choices[0].message.content.strip()
 
 @trace_function_calls
+@llm_stage("is_task_primitive")
 def is_task_primitive(task_name, capabilities_text):
     response = htn_prompts.is_task_primitive(task_name, capabilities_text)
 
     task_type = response.strip()
     return task_type == "primitive"
 
+# Classifications of sibling tasks keyed by (task, capabilities), see classify_tasks
+classification_cache = {}
+classification_cache_lock = threading.Lock()
+
+def parse_classifications(response_str, count):
+    """
+    Parses the JSON array returned by the classify_subtasks program into (is_primitive, translated_task) pairs.
+    Items that are missing, malformed or ambiguous are None, translated_task is None for compound tasks.
+    Items are matched to the tasks by the number they echo, by position only when the reply has one item per task,
+    so a skipped task can't shift the translations of the next ones onto the wrong tasks.
+    """
+    try:
+        items = json.loads(response_str)
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        items = []
+
+    numbered_items = {}
+    repeated_numbers = set()
+    for position, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            continue
+        number = item.get("index", position if len(items) == count else None)
+        if not isinstance(number, int) or isinstance(number, bool) or not 1 <= number <= count:
+            continue
+        if number in numbered_items:
+            repeated_numbers.add(number)
+        numbered_items[number] = item
+
+    classifications = []
+    for number in range(1, count + 1):
+        item = numbered_items.get(number) if number not in repeated_numbers else None
+        task_type = item.get("type", "").strip().lower() if isinstance(item, dict) else None
+        translation = item.get("translation") if isinstance(item, dict) else None
+        if task_type == "compound":
+            classifications.append((False, None))
+        elif task_type == "primitive" and isinstance(translation, str) and translation.strip():
+            classifications.append((True, translation.strip()))
+        else:
+            classifications.append(None)
+    return classifications
+
+# Labels sibling tasks primitive or compound in a single call and translates the primitive ones, so that each
+# child of a decomposition doesn't need its own is_task_primitive and translate calls
 @trace_function_calls
+@llm_stage("classify_subtasks")
+def classify_tasks(task_names, capabilities_text):
+    with classification_cache_lock:
+        cached = {task_name: classification_cache.get((task_name, capabilities_text)) for task_name in task_names}
+    uncached = list(dict.fromkeys(task_name for task_name in task_names if cached[task_name] is None))
+
+    if uncached:
+        response = htn_prompts.classify_subtasks(uncached, capabilities_text)
+        log_response("classify_subtasks", response)
+        for task_name, classification in zip(uncached, parse_classifications(response, len(uncached))):
+            if classification is None:
+                # Fall back to the single task check, the task is translated when it's decomposed
+                classification = (is_task_primitive(task_name, capabilities_text), None)
+            else:
+                with classification_cache_lock:
+                    classification_cache[(task_name, capabilities_text)] = classification
+            cached[task_name] = classification
+
+    return [cached[task_name] for task_name in task_names]
+
+# Splits the description of the initial state into key/value facts, see world_state.WorldState
+@trace_function_calls
+@llm_stage("extract_state_facts")
+def extract_state_facts(text):
+    prompt = (f"Describe the state '{text}' as a JSON object of facts, each key naming a part of the world "
+              f"and its value describing it. Respond with only the JSON object:")
+    response = call_openai_api(prompt, temperature=0)
+
+    facts = parse_facts(response.choices[0].message.content.strip())
+    log_response("extract_state_facts", facts)
+    return {key: value for key, value in facts.items() if value is not None} if facts else None
+
+class ClassificationPrefetcher:
+    """
+    Classifies subtasks while their decomposition is still being streamed, so the classification cache is warm
+    once the candidate is accepted. Subtasks that arrive while a call is running are batched into the next call.
+    """
+
+    def __init__(self, capabilities_text, executor):
+        self.capabilities_text = capabilities_text
+        self.executor = executor
+        self.pending = []
+        self.running = False
+        self._lock = threading.Lock()
+
+    def add(self, task_name):
+        with self._lock:
+            self.pending.append(task_name)
+            if self.running:
+                return
+            self.running = True
+        self._submit_pending()
+
+    def _submit_pending(self):
+        with self._lock:
+            task_names, self.pending = self.pending, []
+            if not task_names:
+                self.running = False
+                return
+        future = self.executor.submit(classify_tasks, task_names, self.capabilities_text)
+        future.add_done_callback(lambda _: self._submit_pending())
+
+@trace_function_calls
+@llm_stage("compress_capabilities")
 def compress_capabilities(text):
     prompt = f"Compress the capabilities description '{text}' into a more concise form:"
-    response = call_openai_api(prompt)
+    response = call_openai_api(prompt, temperature=0)
     return response.choices[0].message.content.strip()
 
 # Needs pre-conditions to prevent discontinuities in the graph
 @trace_function_calls
+@llm_stage("can_execute")
 def can_execute(task, capabilities, state):
     prompt = (f"Given the task '{task}', the capabilities '{capabilities}', "
-              f"and the state '{state}', determine if the task can be executed. "
+              f"and the state '{render_state(state, task)}', determine if the task can be executed. "
               f"Please provide the answer as 'True' or 'False':")
 
-    response = call_openai_api(prompt)
+    response = call_openai_api(prompt, temperature=0)
 
     log_response("can_execute", response.choices[0].message.content.strip())
     return response.choices[0].message.content.strip().lower() == "true"
 
+# Tasks are executed from concurrent workers, each state change is written in one piece
+state_change_log_lock = threading.Lock()
+
 def log_state_change(prev_state, new_state, task):
     log_dir = "../state_changes"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    os.makedirs(log_dir, exist_ok=True)
 
     log_file_path = f"{log_dir}/state_changes.log"
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    with open(log_file_path, "a") as log_file:
+    with state_change_log_lock, open(log_file_path, "a") as log_file:
         log_file.write(f"{timestamp}: Executing task '{task}'\n")
-        log_file.write(f"{timestamp}: Previous state: '{prev_state}'\n")
-        log_file.write(f"{timestamp}: New state: '{new_state}'\n\n")
\ No newline at end of file
+        if isinstance(new_state, WorldState):
+            # Only the facts that changed are logged, the full state can be rebuilt from the history
+            log_file.write(f"{timestamp}: State version {prev_state.version} -> {new_state.version}\n")
+            log_file.write(f"{timestamp}: Changed facts: {json.dumps(new_state.delta)}\n\n")
+        else:
+            log_file.write(f"{timestamp}: Previous state: '{prev_state}'\n")
+            log_file.write(f"{timestamp}: New state: '{new_state}'\n\n")
\ No newline at end of file
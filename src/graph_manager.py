@@ -2,83 +2,541 @@ import random
 
 import networkx as nx
 import matplotlib.pyplot as plt
+import numpy as np
+
+# Strategies for choosing the tasks to expand, all but uniform weight the nodes and sample them in O(log n)
+SAMPLING_UNIFORM = "uniform"
+# Favours the nodes that have been selected for expansion the least
+SAMPLING_FRONTIER = "frontier"
+# Favours the nodes with the fewest edges
+SAMPLING_LOW_DEGREE = "low_degree"
+SAMPLING_STRATEGIES = (SAMPLING_UNIFORM, SAMPLING_FRONTIER, SAMPLING_LOW_DEGREE)
+
+# Buffered edges are merged into the compact edge arrays once there are this many of them, or this share of the
+# compacted edges when that's more
+MIN_COMPACT_EDGES = 256
+COMPACT_RATIO = 0.25
+
+
+class FenwickTree:
+    """
+    Prefix sums over a growable array of non-negative weights, used to sample an index in proportion to its
+    weight. Updates, appends, pops and samples are all O(log n).
+    """
+
+    def __init__(self):
+        self.weights = []
+        # 1-based, tree[i] holds the sum of the weights in (i - lowbit(i), i]
+        self.tree = [0.0]
+
+    def __len__(self):
+        return len(self.weights)
+
+    def prefix_sum(self, count):
+        # Sum of the first count weights
+        total = 0.0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def total(self):
+        return self.prefix_sum(len(self.weights))
+
+    def append(self, weight):
+        self.weights.append(weight)
+        index = len(self.weights)
+        lowbit = index & -index
+        self.tree.append(self.prefix_sum(index - 1) - self.prefix_sum(index - lowbit) + weight)
+
+    def pop(self):
+        # The last position isn't covered by any other position of the tree
+        self.tree.pop()
+        return self.weights.pop()
+
+    def update(self, position, weight):
+        delta = weight - self.weights[position]
+        self.weights[position] = weight
+        index = position + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def sample(self, rng=random):
+        # Position chosen with probability weight / total, None when every weight is zero
+        total = self.total()
+        if total <= 0:
+            return None
+        target = rng.random() * total
+        index = 0
+        step = 1 << len(self.weights).bit_length()
+        while step:
+            next_index = index + step
+            if next_index < len(self.tree) and self.tree[next_index] <= target:
+                index = next_index
+                target -= self.tree[next_index]
+            step >>= 1
+        # Rounding can land past the last non-zero weight, walk back to it
+        index = min(index, len(self.weights) - 1)
+        while index > 0 and self.weights[index] <= 0:
+            index -= 1
+        return index
+
+
+class StringTable:
+    """
+    Interns the node texts as integer ids, so the graph stores, hashes and compares integers instead of long LLM
+    outputs. Ids of deleted nodes aren't reused.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.texts = []
+
+    def __len__(self):
+        return len(self.texts)
+
+    def get(self, text):
+        return self.ids.get(text)
+
+    def intern(self, text):
+        node_id = self.ids.get(text)
+        if node_id is None:
+            node_id = len(self.texts)
+            self.ids[text] = node_id
+            self.texts.append(text)
+        return node_id
+
+    def text(self, node_id):
+        return self.texts[node_id]
+
+    def rename(self, node_id, text):
+        del self.ids[self.texts[node_id]]
+        self.ids[text] = node_id
+        self.texts[node_id] = text
+
+    def release(self, node_id):
+        del self.ids[self.texts[node_id]]
+        self.texts[node_id] = None
+
+
+class EdgeStore:
+    """
+    Weighted directed edges between integer ids. The edges are kept in CSR arrays sorted by (source, target),
+    new edges go to an append buffer that is merged into the arrays once it's large enough. Deleted edges are
+    marked with a NaN weight until the next merge.
+    """
 
-class GraphManager:
     def __init__(self):
-        self.graph = nx.DiGraph()
+        # The edges of source are targets[indptr[source]:indptr[source + 1]]
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.targets = np.zeros(0, dtype=np.int64)
+        self.weights = np.zeros(0, dtype=np.float64)
+        self.deleted = 0
+        # source -> {target: weight} for the edges added since the last merge
+        self.buffer = {}
+        self.buffered = 0
+        # Edges grouped by target, (indptr, sources, positions in the compact arrays). Built on demand for
+        # searches that walk edges backwards and dropped when an edge is added or removed
+        self.reverse_index = None
+
+    def __len__(self):
+        return len(self.targets) - self.deleted + self.buffered
+
+    def _row(self, source):
+        if source + 1 >= len(self.indptr):
+            return 0, 0
+        return int(self.indptr[source]), int(self.indptr[source + 1])
+
+    def _find(self, source, target):
+        # Position of the live edge in the compact arrays, -1 when it isn't there
+        start, end = self._row(source)
+        if start == end:
+            return -1
+        position = start + int(np.searchsorted(self.targets[start:end], target))
+        if position < end and self.targets[position] == target and not np.isnan(self.weights[position]):
+            return position
+        return -1
+
+    def get(self, source, target):
+        buffered = self.buffer.get(source)
+        if buffered is not None and target in buffered:
+            return buffered[target]
+        position = self._find(source, target)
+        return float(self.weights[position]) if position >= 0 else None
+
+    def set(self, source, target, weight):
+        # Returns True when the edge is new, an existing edge only has its weight replaced
+        position = self._find(source, target)
+        if position >= 0:
+            self.weights[position] = weight
+            return False
+        buffered = self.buffer.setdefault(source, {})
+        if target in buffered:
+            buffered[target] = weight
+            return False
+        buffered[target] = weight
+        self.buffered += 1
+        self.reverse_index = None
+        if self.buffered >= max(MIN_COMPACT_EDGES, COMPACT_RATIO * len(self.targets)):
+            self.compact()
+        return True
+
+    def remove(self, source, target):
+        # Returns False when there's no such edge
+        buffered = self.buffer.get(source)
+        if buffered is not None and target in buffered:
+            del buffered[target]
+            if not buffered:
+                del self.buffer[source]
+            self.buffered -= 1
+            self.reverse_index = None
+            return True
+        position = self._find(source, target)
+        if position < 0:
+            return False
+        self.weights[position] = np.nan
+        self.deleted += 1
+        self.reverse_index = None
+        return True
+
+    def successors(self, source):
+        # (targets, weights) arrays of the edges leaving source
+        start, end = self._row(source)
+        targets = self.targets[start:end]
+        weights = self.weights[start:end]
+        if self.deleted:
+            live = ~np.isnan(weights)
+            targets, weights = targets[live], weights[live]
+        buffered = self.buffer.get(source)
+        if buffered:
+            targets = np.concatenate([targets, np.fromiter(buffered.keys(), dtype=np.int64, count=len(buffered))])
+            weights = np.concatenate([weights, np.fromiter(buffered.values(), dtype=np.float64,
+                                                            count=len(buffered))])
+        return targets, weights
+
+    def predecessors(self, target, indexed=False):
+        # (sources, weights) arrays of the edges into target. Uses the reverse index when it's current, or builds
+        # it when indexed is set, otherwise the compact arrays are scanned
+        if indexed and self.reverse_index is None:
+            self.build_reverse_index()
+        if self.reverse_index is not None:
+            indptr, sources, positions = self.reverse_index
+            if target + 1 >= len(indptr):
+                return sources[:0], self.weights[:0]
+            start, end = int(indptr[target]), int(indptr[target + 1])
+            return sources[start:end], self.weights[positions[start:end]]
+
+        positions = np.flatnonzero((self.targets == target) & ~np.isnan(self.weights))
+        sources = np.searchsorted(self.indptr, positions, side="right") - 1
+        weights = self.weights[positions]
+        buffered = [(source, edges[target]) for source, edges in self.buffer.items() if target in edges]
+        if buffered:
+            buffered_sources, buffered_weights = zip(*buffered)
+            sources = np.concatenate([sources, np.array(buffered_sources, dtype=np.int64)])
+            weights = np.concatenate([weights, np.array(buffered_weights, dtype=np.float64)])
+        return sources, weights
+
+    def build_reverse_index(self):
+        # Every edge has to be in the compact arrays for their positions to be stable
+        self.compact()
+        sources = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        positions = np.argsort(self.targets, kind="stable")
+        row_count = max(len(self.indptr) - 1, int(self.targets.max()) + 1 if len(self.targets) else 0)
+        indptr = np.zeros(row_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.targets, minlength=row_count), out=indptr[1:])
+        self.reverse_index = (indptr, sources[positions], positions)
+
+    def edges(self):
+        # (source, target, weight) for every edge
+        self.compact()
+        sources = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        return zip(sources.tolist(), self.targets.tolist(), self.weights.tolist())
+
+    def compact(self):
+        # Merges the append buffer into the compact arrays and drops the deleted edges
+        if not self.buffered and not self.deleted:
+            return
+        sources = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        targets = self.targets
+        weights = self.weights
+        if self.deleted:
+            live = ~np.isnan(weights)
+            sources, targets, weights = sources[live], targets[live], weights[live]
+        if self.buffered:
+            buffered = [(source, target, weight) for source, edges in self.buffer.items()
+                        for target, weight in edges.items()]
+            buffered_sources, buffered_targets, buffered_weights = zip(*buffered)
+            sources = np.concatenate([sources, np.array(buffered_sources, dtype=np.int64)])
+            targets = np.concatenate([targets, np.array(buffered_targets, dtype=np.int64)])
+            weights = np.concatenate([weights, np.array(buffered_weights, dtype=np.float64)])
+
+        order = np.lexsort((targets, sources))
+        sources, self.targets, self.weights = sources[order], targets[order], weights[order]
+        row_count = max(len(self.indptr) - 1, int(sources[-1]) + 1 if len(sources) else 0)
+        self.indptr = np.zeros(row_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=row_count), out=self.indptr[1:])
+        self.deleted = 0
+        self.buffer = {}
+        self.buffered = 0
+        self.reverse_index = None
+
+
+class GraphManager:
+    """
+    Directed weighted graph of states and tasks. Nodes are interned as integer ids and the edges are kept in
+    numpy arrays, the text API below converts at the boundary and the *_id methods work on the ids directly.
+    """
+
+    def __init__(self, sampling_strategy=SAMPLING_UNIFORM):
+        if sampling_strategy not in SAMPLING_STRATEGIES:
+            raise ValueError(f"Unknown sampling strategy '{sampling_strategy}', expected one of "
+                             f"{', '.join(SAMPLING_STRATEGIES)}.")
+        self.strings = StringTable()
+        self.edges = EdgeStore()
+        # Edges in and out of each node id
+        self.degrees = []
+        self.sampling_strategy = sampling_strategy
+        # Node ids in an array so a random node can be picked without copying the node list, a removed node is
+        # swapped with the last one so removal stays O(1)
+        self.node_list = []
+        self.node_positions = {}
+        # Sampling weights aligned with node_list, only kept for the weighted strategies
+        self.node_weights = FenwickTree() if sampling_strategy != SAMPLING_UNIFORM else None
+        # Number of times each node id was selected for expansion, used by the frontier strategy
+        self.selections = {}
+        # node id -> [(neighbor id, weight)], rebuilt after the node's outgoing edges change
+        self.neighbor_cache = {}
+        # node id -> [(predecessor id, weight)], rebuilt after the node's incoming edges change
+        self.predecessor_cache = {}
+
+    def node_id(self, node):
+        # Id of the node text, None when it isn't in the graph
+        return self.strings.get(node)
+
+    def node_text(self, node_id):
+        return self.strings.text(node_id)
+
+    def has_node(self, node):
+        return self.strings.get(node) is not None
+
+    def node_weight(self, node_id):
+        if self.sampling_strategy == SAMPLING_FRONTIER:
+            return 1.0 / (1 + self.selections.get(node_id, 0))
+        if self.sampling_strategy == SAMPLING_LOW_DEGREE:
+            return 1.0 / (1 + self.degrees[node_id])
+        return 1.0
+
+    def _index_node(self, node_id):
+        self.node_positions[node_id] = len(self.node_list)
+        self.node_list.append(node_id)
+        if self.node_weights is not None:
+            self.node_weights.append(self.node_weight(node_id))
+
+    def _unindex_node(self, node_id):
+        position = self.node_positions.pop(node_id)
+        last_node = self.node_list.pop()
+        if self.node_weights is not None:
+            last_weight = self.node_weights.pop()
+        if last_node != node_id:
+            self.node_list[position] = last_node
+            self.node_positions[last_node] = position
+            if self.node_weights is not None:
+                self.node_weights.update(position, last_weight)
+        self.selections.pop(node_id, None)
+        self.neighbor_cache.pop(node_id, None)
+        self.predecessor_cache.pop(node_id, None)
+
+    def _reweight(self, *node_ids):
+        if self.node_weights is None:
+            return
+        for node_id in node_ids:
+            position = self.node_positions.get(node_id)
+            if position is not None:
+                self.node_weights.update(position, self.node_weight(node_id))
+
+    def _required_id(self, node):
+        node_id = self.strings.get(node)
+        if node_id is None:
+            raise ValueError(f"The node '{node}' is not in the graph.")
+        return node_id
+
+    def get_nodes(self):
+        return [text for text in self.strings.texts if text is not None]
+
+    def get_edges(self):
+        # (node1, node2, weight) for every edge
+        texts = self.strings.texts
+        return [(texts[source], texts[target], weight) for source, target, weight in self.edges.edges()]
 
     def add_node(self, node):
-        self.graph.add_node(node)
+        node_id = self.strings.get(node)
+        if node_id is None:
+            node_id = self.strings.intern(node)
+            self.degrees.append(0)
+            self._index_node(node_id)
+        return node_id
 
     def add_nodes(self, nodes):
-        self.graph.add_nodes_from(nodes)
+        for node in nodes:
+            self.add_node(node)
 
     def update_node(self, old_node, new_node):
-        if old_node in self.graph:
-            in_edges = [(u, v, d) for u, v, d in self.graph.in_edges(old_node, data=True)]
-            out_edges = [(u, v, d) for u, v, d in self.graph.out_edges(old_node, data=True)]
-            self.graph.remove_node(old_node)
-            self.graph.add_node(new_node)
-            for u, v, d in in_edges:
-                self.graph.add_edge(u, new_node, weight=d['weight'])
-            for u, v, d in out_edges:
-                self.graph.add_edge(new_node, v, weight=d['weight'])
+        old_id = self.strings.get(old_node)
+        if old_id is None:
+            return
+        new_id = self.strings.get(new_node)
+        if new_id is None:
+            # Renaming keeps the id, so the edges stay where they are
+            self.strings.rename(old_id, new_node)
+            return
+        if new_id == old_id:
+            return
+
+        # The new node already exists, its edges are merged with the old node's
+        targets, weights = self.edges.successors(old_id)
+        sources, source_weights = self.edges.predecessors(old_id)
+        in_edges = list(zip(sources.tolist(), source_weights.tolist()))
+        for source, weight in in_edges:
+            if source != old_id:
+                self.add_edge_ids(source, new_id, weight)
+        for target, weight in zip(targets.tolist(), weights.tolist()):
+            self.add_edge_ids(new_id, new_id if target == old_id else target, weight)
+        self.selections[new_id] = self.selections.get(new_id, 0) + self.selections.get(old_id, 0)
+        self.delete_node(old_node)
 
     def delete_node(self, node):
-        self.graph.remove_node(node)
+        node_id = self._required_id(node)
+        targets, _ = self.edges.successors(node_id)
+        sources, _ = self.edges.predecessors(node_id)
+        for target in targets.tolist():
+            self._remove_edge_ids(node_id, target)
+        for source in sources.tolist():
+            if source != node_id:
+                self._remove_edge_ids(source, node_id)
+        self._unindex_node(node_id)
+        self.strings.release(node_id)
 
     def has_edge(self, node1, node2):
-        return self.graph.has_edge(node1, node2)
+        source = self.strings.get(node1)
+        target = self.strings.get(node2)
+        return source is not None and target is not None and self.edges.get(source, target) is not None
 
     def add_edge(self, node1, node2, weight=1):
-        self.graph.add_edge(node1, node2, weight=weight)
+        # Missing nodes are added to the graph
+        self.add_edge_ids(self.add_node(node1), self.add_node(node2), weight)
+
+    def add_edge_ids(self, source, target, weight=1):
+        if self.edges.set(source, target, weight):
+            self.degrees[source] += 1
+            self.degrees[target] += 1
+            if self.sampling_strategy == SAMPLING_LOW_DEGREE:
+                self._reweight(source, target)
+        self.neighbor_cache.pop(source, None)
+        self.predecessor_cache.pop(target, None)
 
     def delete_edge(self, node1, node2):
-        self.graph.remove_edge(node1, node2)
+        if not self._remove_edge_ids(self._required_id(node1), self._required_id(node2)):
+            raise ValueError(f"The edge '{node1}' -> '{node2}' is not in the graph.")
+
+    def _remove_edge_ids(self, source, target):
+        if not self.edges.remove(source, target):
+            return False
+        self.degrees[source] -= 1
+        self.degrees[target] -= 1
+        if self.sampling_strategy == SAMPLING_LOW_DEGREE:
+            self._reweight(source, target)
+        self.neighbor_cache.pop(source, None)
+        self.predecessor_cache.pop(target, None)
+        return True
 
     def get_edge_weight(self, task_a, task_b):
-        if self.graph.has_edge(task_a, task_b):
-            return self.graph[task_a][task_b]['weight']
-        else:
+        source = self.strings.get(task_a)
+        target = self.strings.get(task_b)
+        if source is None or target is None:
             return None
+        return self.edges.get(source, target)
+
+    def to_networkx(self):
+        graph = nx.DiGraph()
+        graph.add_nodes_from(self.get_nodes())
+        for node1, node2, weight in self.get_edges():
+            graph.add_edge(node1, node2, weight=weight)
+        return graph
 
     def visualize(self):
-        pos = nx.spring_layout(self.graph)
-        nx.draw(self.graph, pos, with_labels=True, font_weight='bold')
-        labels = nx.get_edge_attributes(self.graph, 'weight')
-        nx.draw_networkx_edge_labels(self.graph, pos, edge_labels=labels)
+        graph = self.to_networkx()
+        pos = nx.spring_layout(graph)
+        nx.draw(graph, pos, with_labels=True, font_weight='bold')
+        labels = nx.get_edge_attributes(graph, 'weight')
+        nx.draw_networkx_edge_labels(graph, pos, edge_labels=labels)
         plt.show()
 
+    def sample_node(self, excluded=()):
+        # A random node id that isn't in excluded, picked according to the sampling strategy
+        if self.node_weights is None:
+            # excluded holds at most a couple of ids, so rejection takes O(1) expected draws
+            while True:
+                node_id = self.node_list[random.randrange(len(self.node_list))]
+                if node_id not in excluded:
+                    return node_id
+
+        # Excluded nodes are given no weight while sampling instead of being drawn and rejected
+        excluded_positions = [self.node_positions[node_id] for node_id in set(excluded)
+                              if node_id in self.node_positions]
+        for position in excluded_positions:
+            self.node_weights.update(position, 0.0)
+        try:
+            position = self.node_weights.sample()
+        finally:
+            for position_excluded in excluded_positions:
+                self.node_weights.update(position_excluded, self.node_weight(self.node_list[position_excluded]))
+        if position is None:
+            # Every remaining weight was zero
+            return random.choice([node_id for node_id in self.node_list if node_id not in excluded])
+        return self.node_list[position]
+
     def select_random_tasks(self, initial_node, final_node):
-        nodes = list(self.graph.nodes)
-        if len(nodes) < 2:
+        if len(self.node_list) < 2:
             raise ValueError("Graph must have at least 2 nodes to select random states.")
 
-        if len(nodes) == 2:
-            node1, node2 = nodes
+        if len(self.node_list) == 2:
+            node1, node2 = sorted(self.node_list)
         else:
-            # Remove only the final node from the list
-            nodes_filtered = [node for node in nodes if node != final_node]
-
-            # Randomly select one node from the filtered list
-            node1 = random.choice(nodes_filtered)
+            # The first task can be anything but the final node, the second anything but the first task and the
+            # initial node
+            node1 = self.sample_node((self.strings.get(final_node),))
+            node2 = self.sample_node((node1, self.strings.get(initial_node)))
 
-            # Add the final node back into the list
-            nodes_filtered.append(final_node)
+        self.selections[node1] = self.selections.get(node1, 0) + 1
+        self.selections[node2] = self.selections.get(node2, 0) + 1
+        if self.sampling_strategy == SAMPLING_FRONTIER:
+            self._reweight(node1, node2)
+        return self.strings.text(node1), self.strings.text(node2)
 
-            # Remove the selected node1 and the initial node from the list
-            nodes_filtered.remove(node1)
-            if initial_node in nodes_filtered:
-                nodes_filtered.remove(initial_node)
+    def get_neighbor_ids(self, node_id):
+        # (neighbor id, edge cost) for every outgoing edge, cached until the node's outgoing edges change. The
+        # list is shared, callers must not modify it
+        neighbors = self.neighbor_cache.get(node_id)
+        if neighbors is None:
+            targets, weights = self.edges.successors(node_id)
+            neighbors = list(zip(targets.tolist(), weights.tolist()))
+            self.neighbor_cache[node_id] = neighbors
+        return neighbors
 
-            # Randomly select the second node from the updated list
-            node2 = random.choice(nodes_filtered)
+    def get_predecessor_ids(self, node_id):
+        # (predecessor id, edge cost) for every incoming edge, cached like get_neighbor_ids
+        predecessors = self.predecessor_cache.get(node_id)
+        if predecessors is None:
+            sources, weights = self.edges.predecessors(node_id, indexed=True)
+            predecessors = list(zip(sources.tolist(), weights.tolist()))
+            self.predecessor_cache[node_id] = predecessors
+        return predecessors
 
-        return node1, node2
-            
     def get_neighbors(self, node):
-        neighbors = []
-        for neighbor, edge_data in self.graph[node].items():
-            edge_cost = edge_data['weight']
-            neighbors.append((neighbor, edge_cost))
-        return neighbors
\ No newline at end of file
+        texts = self.strings.texts
+        return [(texts[neighbor], weight) for neighbor, weight in self.get_neighbor_ids(self._required_id(node))]
+
+    def get_predecessors(self, node):
+        texts = self.strings.texts
+        return [(texts[source], weight) for source, weight in self.get_predecessor_ids(self._required_id(node))]
@@ -0,0 +1,171 @@
+"""
+Shortest path searches over a GraphManager graph. The searches run on the graph's integer node ids and return
+(cost, path) with the path as a list of ids, or None when the goal can't be reached.
+
+Heap entries are (priority, tie breaker, node id) so equal priorities never fall back to comparing nodes, and an
+entry is skipped when a cheaper path to its node was found after it was pushed, so every node is expanded once.
+"""
+import heapq
+import itertools
+
+
+def reconstruct_path(came_from, start, goal):
+    path = [goal]
+    current = goal
+    while current != start:
+        current = came_from[current]
+        path.append(current)
+    path.reverse()
+    return path
+
+
+def astar(graph_manager, start, goal, heuristic=None, prefetch=None, excluded_nodes=(), excluded_edges=()):
+    """
+    heuristic(node_id) estimates the remaining cost from a node to the goal, it's called at most once per node.
+    prefetch(node_ids) is called with the newly reached neighbors of each expanded node before their estimates
+    are needed. Without a heuristic this is Dijkstra's algorithm.
+    """
+    if start in excluded_nodes:
+        return None
+
+    estimates = {}
+
+    def estimate(node):
+        if heuristic is None or node == goal:
+            return 0.0
+        if node not in estimates:
+            estimates[node] = heuristic(node)
+        return estimates[node]
+
+    tie_breaker = itertools.count()
+    open_list = [(estimate(start), next(tie_breaker), start)]
+    came_from = {}
+    cost_so_far = {start: 0.0}
+    closed = set()
+
+    while open_list:
+        _, _, current = heapq.heappop(open_list)
+        if current in closed:
+            # A stale entry, the node was already expanded through a cheaper path
+            continue
+        if current == goal:
+            return cost_so_far[goal], reconstruct_path(came_from, start, goal)
+        closed.add(current)
+
+        neighbors = [(next_node, edge_cost) for next_node, edge_cost in graph_manager.get_neighbor_ids(current)
+                     if next_node not in closed and next_node not in excluded_nodes
+                     and (current, next_node) not in excluded_edges]
+        if prefetch is not None:
+            # Request the estimates for all new neighbors at once, the loop below only waits for the results
+            reached = [next_node for next_node, _ in neighbors if next_node not in estimates]
+            if reached:
+                prefetch(reached)
+
+        current_cost = cost_so_far[current]
+        for next_node, edge_cost in neighbors:
+            new_cost = current_cost + edge_cost
+            # Unscored edges have an infinite weight, a path over them is still returned when there's no other
+            if next_node not in cost_so_far or new_cost < cost_so_far[next_node]:
+                cost_so_far[next_node] = new_cost
+                came_from[next_node] = current
+                heapq.heappush(open_list, (new_cost + estimate(next_node), next(tie_breaker), next_node))
+
+    return None
+
+
+def dijkstra(graph_manager, start, goal, excluded_nodes=(), excluded_edges=()):
+    return astar(graph_manager, start, goal, excluded_nodes=excluded_nodes, excluded_edges=excluded_edges)
+
+
+def bidirectional_dijkstra(graph_manager, start, goal):
+    """
+    Searches forwards from start and backwards from goal, expanding the side with the smaller frontier cost, and
+    stops once the two frontiers together can't improve on the best path found through a meeting node.
+    """
+    if start == goal:
+        return 0.0, [start]
+
+    # Index 0 is the forward search over outgoing edges, index 1 the backward search over incoming edges
+    edges = (graph_manager.get_neighbor_ids, graph_manager.get_predecessor_ids)
+    tie_breaker = itertools.count()
+    open_lists = ([(0.0, next(tie_breaker), start)], [(0.0, next(tie_breaker), goal)])
+    costs = ({start: 0.0}, {goal: 0.0})
+    parents = ({}, {})
+    closed = (set(), set())
+    best_cost = float('inf')
+    meeting_node = None
+
+    while open_lists[0] and open_lists[1]:
+        if open_lists[0][0][0] + open_lists[1][0][0] >= best_cost:
+            break
+        side = 0 if open_lists[0][0][0] <= open_lists[1][0][0] else 1
+        other = 1 - side
+        _, _, current = heapq.heappop(open_lists[side])
+        if current in closed[side]:
+            continue
+        closed[side].add(current)
+
+        current_cost = costs[side][current]
+        for next_node, edge_cost in edges[side](current):
+            if next_node in closed[side]:
+                continue
+            new_cost = current_cost + edge_cost
+            if next_node not in costs[side] or new_cost < costs[side][next_node]:
+                costs[side][next_node] = new_cost
+                parents[side][next_node] = current
+                heapq.heappush(open_lists[side], (new_cost, next(tie_breaker), next_node))
+            if next_node in costs[other] and (meeting_node is None or
+                                              new_cost + costs[other][next_node] < best_cost):
+                best_cost = new_cost + costs[other][next_node]
+                meeting_node = next_node
+
+    if meeting_node is None:
+        return None
+    path = reconstruct_path(parents[0], start, meeting_node)
+    node = meeting_node
+    while node != goal:
+        node = parents[1][node]
+        path.append(node)
+    return best_cost, path
+
+
+def path_cost(graph_manager, path):
+    return sum(graph_manager.edges.get(source, target) for source, target in zip(path, path[1:]))
+
+
+def yen_k_shortest_paths(graph_manager, start, goal, k):
+    """
+    Up to k loopless paths from start to goal, cheapest first. Each path after the first is the cheapest
+    deviation from a path already found, searched with Dijkstra's algorithm with the shared prefix nodes and the
+    used deviation edges removed.
+    """
+    shortest = dijkstra(graph_manager, start, goal)
+    if shortest is None:
+        return []
+    paths = [shortest]
+    found = {tuple(shortest[1])}
+    candidates = []
+    tie_breaker = itertools.count()
+
+    while len(paths) < k:
+        _, previous_path = paths[-1]
+        for index in range(len(previous_path) - 1):
+            spur_node = previous_path[index]
+            root_path = previous_path[:index + 1]
+            excluded_edges = {(path[index], path[index + 1]) for _, path in paths
+                              if len(path) > index + 1 and path[:index + 1] == root_path}
+            excluded_nodes = set(root_path[:-1])
+            spur = dijkstra(graph_manager, spur_node, goal, excluded_nodes, excluded_edges)
+            if spur is None:
+                continue
+            candidate = root_path[:-1] + spur[1]
+            if tuple(candidate) not in found:
+                found.add(tuple(candidate))
+                heapq.heappush(candidates, (path_cost(graph_manager, root_path) + spur[0], next(tie_breaker),
+                                            candidate))
+        if not candidates:
+            break
+        cost, _, path = heapq.heappop(candidates)
+        paths.append((cost, path))
+
+    return paths
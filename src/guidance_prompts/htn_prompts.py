@@ -1,25 +1,40 @@
 import guidance
 import os
 
+from guidance_prompts.program_registry import ProgramRegistry
+from openai_api import stream_openai_api, llm_client
+
 guidance_gpt4_api = guidance.llms.OpenAI("gpt-4", api_key=os.environ.get('OPENAI_KEY'))
 guidance.llm = guidance_gpt4_api
 
-# Add new functions for extracting and suggesting new queries here
-def extract_and_format_information(webpage_content):
-    structured_info = guidance('''
+# Programs are built once from their templates and reused with their parsed templates, see program_stats() for call
+# counts and latencies
+# Their requests share the rate limits and fair scheduling of the other API calls
+program_registry = ProgramRegistry(llm_client)
+
+
+def program_stats():
+    return program_registry.program_stats()
+
+
+def print_program_stats():
+    program_registry.print_stats()
+
+
+EXTRACT_AND_FORMAT_INFORMATION_TEMPLATE = '''
     {{#system~}}You are a helpful assistant.{{~/system}}
     {{#user~}}Extract and format relevant information from the following webpage content: {{webpage_content}}{{~/user}}
-    {{#assistant}}{{gen "extracted_info"}}{{/assistant}}''',
-    llm=guidance_gpt4_api)
+    {{#assistant}}{{gen "extracted_info"}}{{/assistant}}'''
+program_registry.register("extract_and_format_information", EXTRACT_AND_FORMAT_INFORMATION_TEMPLATE,
+                          llm=guidance_gpt4_api)
 
-    output = structured_info(webpage_content=webpage_content)
+# Add new functions for extracting and suggesting new queries here
+def extract_and_format_information(webpage_content):
+    output = program_registry.run("extract_and_format_information", webpage_content=webpage_content)
 
     return output['extracted_info']
 
-def check_subtasks(task, subtasks, capabilities_input):
-    task_statuses = ['True', 'False']
-
-    check_subtasks_program = guidance('''
+CHECK_SUBTASKS_TEMPLATE = '''
     {{#system~}}
     You are a helpful assistant.
     {{~/system}}
@@ -31,15 +46,19 @@ def check_subtasks(task, subtasks, capabilities_input):
     {{~/user}}
     {{#assistant~}}
     {{select "result" options=task_statuses}}
-    {{~/assistant}}''', llm=guidance_gpt4_api)
+    {{~/assistant}}'''
+program_registry.register("check_subtasks", CHECK_SUBTASKS_TEMPLATE, llm=guidance_gpt4_api)
 
-    response = check_subtasks_program(task=task, subtasks=subtasks, capabilities_input=capabilities_input, task_statuses=task_statuses)
+def check_subtasks(task, subtasks, capabilities_input):
+    task_statuses = ['True', 'False']
+
+    response = program_registry.run("check_subtasks", task=task, subtasks=subtasks,
+                                    capabilities_input=capabilities_input, task_statuses=task_statuses)
     result = response["result"].strip().lower()
 
     return result
 
-def get_subtasks(task, state, remaining_decompositions, capabilities_input):
-    subtasks_prompt = guidance('''
+GET_SUBTASKS_TEMPLATE = '''
     {{#system}}You are a helpful agent{{/system}}
 
     {{#user}}
@@ -50,32 +69,56 @@ def get_subtasks(task, state, remaining_decompositions, capabilities_input):
     '{{capabilities_input}}'. Provide the subtasks in a comma-separated list,
     each enclosed in square brackets: [subtask1], [subtask2], ...
     {{/user}}
-    {{#assistant}}{{gen "subtasks_list"}}{{/assistant}}
-    ''', llm=guidance_gpt4_api)
-
-    result = subtasks_prompt(task=task, state=state,
-                             remaining_decompositions=remaining_decompositions,
-                             capabilities_input=capabilities_input)
+    {{#assistant}}{{gen "subtasks_list" temperature=temperature}}{{/assistant}}
+    '''
+program_registry.register("get_subtasks", GET_SUBTASKS_TEMPLATE, llm=guidance_gpt4_api)
+
+# Decoding parameters of the get_subtasks program, the default max_tokens of guidance's gen. The first candidate
+# decomposition is generated at temperature 0, the others at GET_SUBTASKS_CANDIDATE_TEMPERATURE since identical
+# requests at temperature 0 would all pay for the same completion
+GET_SUBTASKS_TEMPERATURE = 0
+GET_SUBTASKS_CANDIDATE_TEMPERATURE = 0.7
+GET_SUBTASKS_MAX_TOKENS = 500
+
+def get_subtasks_temperature(candidate):
+    return GET_SUBTASKS_TEMPERATURE if candidate == 0 else GET_SUBTASKS_CANDIDATE_TEMPERATURE
+
+def get_subtasks(task, state, remaining_decompositions, capabilities_input, temperature=GET_SUBTASKS_TEMPERATURE):
+    result = program_registry.run("get_subtasks", task=task, state=state,
+                                  remaining_decompositions=remaining_decompositions,
+                                  capabilities_input=capabilities_input, temperature=temperature)
     subtasks_with_types = result['subtasks_list'].strip()
 
     return subtasks_with_types
 
-def suggest_new_query(query):
-    new_query = guidance('''
+# Same request as GET_SUBTASKS_TEMPLATE sent as a plain streamed completion, so the subtasks can be parsed as they arrive
+GET_SUBTASKS_PROMPT = (
+    "Given the task '{task}', the current state '{state}', "
+    "and {remaining_decompositions} decompositions remaining before failing, "
+    "please decompose the task into a detailed step-by-step plan "
+    "that can be achieved using the following capabilities: "
+    "'{capabilities_input}'. Provide the subtasks in a comma-separated list, "
+    "each enclosed in square brackets: [subtask1], [subtask2], ..."
+)
+
+def stream_subtasks(task, state, remaining_decompositions, capabilities_input, temperature=GET_SUBTASKS_TEMPERATURE):
+    # Yields the text of the subtask list as it's generated
+    prompt = GET_SUBTASKS_PROMPT.format(task=task, state=state, remaining_decompositions=remaining_decompositions,
+                                        capabilities_input=capabilities_input)
+    return stream_openai_api(prompt, max_tokens=GET_SUBTASKS_MAX_TOKENS, temperature=temperature)
+
+SUGGEST_NEW_QUERY_TEMPLATE = '''
     {{#system~}}You are a helpful assistant.{{~/system}}
     {{#user~}}Suggest a new query to find the missing information based on the initial query: {{query}}{{~/user}}
-    {{#assistant}}{{gen "new_query"}}{{/assistant}}''',
-    llm=guidance_gpt4_api)
+    {{#assistant}}{{gen "new_query"}}{{/assistant}}'''
+program_registry.register("suggest_new_query", SUGGEST_NEW_QUERY_TEMPLATE, llm=guidance_gpt4_api)
 
-    output = new_query(query=query)
+def suggest_new_query(query):
+    output = program_registry.run("suggest_new_query", query=query)
 
     return output['new_query']
 
-def update_plan_output(task_name, task_description, elapsed_time, time_limit, context_window):
-    task_statuses = ['not started', 'in progress', 'completed']
-    action_types = ['update', 'insert', 'delete']
-
-    structured_prompt = guidance('''
+UPDATE_PLAN_OUTPUT_TEMPLATE = '''
     {{#system~}}
     You are a helpful assistant.
     {{~/system}}
@@ -104,9 +147,15 @@ def update_plan_output(task_name, task_description, elapsed_time, time_limit, co
     {{#if (eq action "insert")}}{{gen "insert_line"}}Insert "{{insert_text}}" at line {{insert_line}}{{/if}}
     {{#if (eq action "delete")}}{{gen "delete_line"}}Delete line {{delete_line}}{{/if}}
     {{~/assistant}}
-    ''')
+    '''
+program_registry.register("update_plan_output", UPDATE_PLAN_OUTPUT_TEMPLATE)
+
+def update_plan_output(task_name, task_description, elapsed_time, time_limit, context_window):
+    task_statuses = ['not started', 'in progress', 'completed']
+    action_types = ['update', 'insert', 'delete']
 
-    output = structured_prompt(
+    output = program_registry.run(
+        "update_plan_output",
         task_name=task_name,
         task_description=task_description,
         elapsed_time=elapsed_time,
@@ -131,10 +180,7 @@ def update_plan_output(task_name, task_description, elapsed_time, time_limit, co
 
     return { "status": status, "action": action, "details": details }
 
-def confirm_deliverable_changes(deliverable_content, updated_content):
-    confirm_choices = ['yes', 'no']
-
-    confirm_changes = guidance('''
+CONFIRM_DELIVERABLE_CHANGES_TEMPLATE = '''
     {{#system}}You are a helpful agent{{/system}}
     {{#user}}
     Please confirm the changes made to the deliverable.
@@ -147,17 +193,20 @@ def confirm_deliverable_changes(deliverable_content, updated_content):
     Type 'yes' to confirm the changes or 'no' to revert them.
     {{/user}}
     {{#assistant}}{{select "confirm" options=confirm_choices}}{{/assistant}}
-    ''')
+    '''
+program_registry.register("confirm_deliverable_changes", CONFIRM_DELIVERABLE_CHANGES_TEMPLATE)
 
-    result = confirm_changes(deliverable_content=deliverable_content,
-                             updated_content=updated_content,
-                             confirm_choices=confirm_choices)
+def confirm_deliverable_changes(deliverable_content, updated_content):
+    confirm_choices = ['yes', 'no']
+
+    result = program_registry.run("confirm_deliverable_changes",
+                                  deliverable_content=deliverable_content,
+                                  updated_content=updated_content,
+                                  confirm_choices=confirm_choices)
     return result['confirm']
 
 
-def translate(original_task, capabilities_input):
-    # translates a task into a form that can be completed with the specified capabilities
-    task_translation = guidance('''
+TRANSLATE_TEMPLATE = '''
     {{#system}}You are a helpful agent{{/system}}
     
     {{#user}}Translate the task '{{task}}' into a form that can be executed using the following capabilities:
@@ -166,16 +215,16 @@ def translate(original_task, capabilities_input):
     
     When translated to use the specified capabilities the result is:{{/user}}
     {{#assistant}}{{gen "translated_task"}}{{/assistant}}
-    ''', llm=guidance_gpt4_api)
+    '''
+program_registry.register("translate", TRANSLATE_TEMPLATE, llm=guidance_gpt4_api)
 
-    result = task_translation(task=original_task, capabilities_input=capabilities_input)
+def translate(original_task, capabilities_input):
+    # translates a task into a form that can be completed with the specified capabilities
+    result = program_registry.run("translate", task=original_task, capabilities_input=capabilities_input)
     return result['translated_task']
 
 
-def is_task_primitive(task_name, capabilities_text):
-    task_types = ['primitive', 'compound']
-
-    primitive_check = guidance('''
+IS_TASK_PRIMITIVE_TEMPLATE = '''
     {{#system}}You are a helpful agent{{/system}}
 
     {{#user}}
@@ -186,14 +235,43 @@ def is_task_primitive(task_name, capabilities_text):
     {{~#assistant~}}
     {{select "choice" options=task_types}}
     {{~/assistant~}}
-    ''', llm=guidance_gpt4_api)
+    '''
+program_registry.register("is_task_primitive", IS_TASK_PRIMITIVE_TEMPLATE, llm=guidance_gpt4_api)
+
+def is_task_primitive(task_name, capabilities_text):
+    task_types = ['primitive', 'compound']
 
-    result = primitive_check(task_name=task_name, capabilities_text=capabilities_text, task_types=task_types)
+    result = program_registry.run("is_task_primitive", task_name=task_name, capabilities_text=capabilities_text,
+                                  task_types=task_types)
     return result['choice']
 
 
-def evaluate_candidate(task, subtasks, capabilities_input):
-    evaluation = guidance('''
+CLASSIFY_SUBTASKS_TEMPLATE = '''
+    {{#system}}You are a helpful agent{{/system}}
+
+    {{#user}}
+    Given the capabilities '{{capabilities_text}}', determine for each of the following tasks if it is primitive
+    which cannot be broken up further or compound which can be broken down more:
+    {{#each task_names}}{{add @index 1}}. {{this}}
+    {{/each}}
+    For each primitive task also translate it into a form that can be executed using the capabilities, in a single
+    line without any commentary or superfluous text.
+    Respond with only a JSON array with one object per task in the same order, each with the number of its task,
+    for example:
+    [{"index": 1, "type": "primitive", "translation": "..."}, {"index": 2, "type": "compound"}]
+    {{/user}}
+    {{#assistant~}}
+    {{gen "classifications" temperature=0}}
+    {{~/assistant}}
+    '''
+program_registry.register("classify_subtasks", CLASSIFY_SUBTASKS_TEMPLATE, llm=guidance_gpt4_api)
+
+def classify_subtasks(task_names, capabilities_text):
+    result = program_registry.run("classify_subtasks", task_names=task_names, capabilities_text=capabilities_text)
+    return result['classifications'].strip()
+
+
+EVALUATE_CANDIDATE_TEMPLATE = '''
     {{#system}}You are a helpful agent{{/system}}
 
     {{#user}}
@@ -208,8 +286,10 @@ def evaluate_candidate(task, subtasks, capabilities_input):
     {{/user}}
     {{#assistant~}}
     {{gen 'score' temperature=0.5 max_tokens=10}}
-    {{~/assistant}}''',
-                          llm=guidance_gpt4_api)
+    {{~/assistant}}'''
+program_registry.register("evaluate_candidate", EVALUATE_CANDIDATE_TEMPLATE, llm=guidance_gpt4_api)
 
-    result = evaluation(task=task, subtasks=subtasks, capabilities_input=capabilities_input)
-    return result['score']
+def evaluate_candidate(task, subtasks, capabilities_input):
+    result = program_registry.run("evaluate_candidate", task=task, subtasks=subtasks,
+                                  capabilities_input=capabilities_input)
+    return result['score']
\ No newline at end of file
@@ -0,0 +1,189 @@
+import threading
+import time
+
+import guidance
+
+from llm_backend import get_backend, count_tokens
+from telemetry import telemetry
+
+
+class ParsedTemplateCache:
+    """
+    Stands in for guidance's template grammar. guidance 0.0.x parses the template of a program every time it's
+    called, Program.__call__ creates a new Program whose ProgramExecutor runs grammar.parse(text). The parse trees
+    are only read while executing, so the tree of each registered template is parsed once and reused. Other texts
+    go to the grammar as before.
+    """
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.templates = set()
+        self.trees = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def add_template(self, template):
+        with self._lock:
+            self.templates.add(template)
+
+    def parse(self, text, *args, **kwargs):
+        if args or kwargs or text not in self.templates:
+            return self.grammar.parse(text, *args, **kwargs)
+        with self._lock:
+            tree = self.trees.get(text)
+            if tree is not None:
+                self.hits += 1
+                return tree
+        tree = self.grammar.parse(text)
+        with self._lock:
+            self.trees[text] = tree
+            self.misses += 1
+        return tree
+
+    def __getattr__(self, name):
+        return getattr(self.grammar, name)
+
+    def stats(self):
+        with self._lock:
+            return {"parsed": self.misses, "reused": self.hits}
+
+
+_parse_cache = None
+_parse_cache_lock = threading.Lock()
+
+
+def get_parse_cache():
+    # Installed once per process in place of the grammar guidance's executor parses templates with, None when this
+    # guidance version doesn't parse through a module level grammar
+    global _parse_cache
+
+    with _parse_cache_lock:
+        if _parse_cache is None:
+            try:
+                from guidance import _program_executor
+            except ImportError:
+                return None
+            grammar = getattr(_program_executor, "grammar", None)
+            if grammar is None or not hasattr(grammar, "parse"):
+                return None
+            _parse_cache = grammar if isinstance(grammar, ParsedTemplateCache) else ParsedTemplateCache(grammar)
+            _program_executor.grammar = _parse_cache
+        return _parse_cache
+
+
+class ProgramStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, failed=False):
+        self.calls += 1
+        self.errors += 1 if failed else 0
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_seconds": self.total_seconds,
+            "average_seconds": self.total_seconds / self.calls if self.calls else 0.0,
+            "max_seconds": self.max_seconds,
+        }
+
+
+class ProgramRegistry:
+    """
+    Keeps the templates of the guidance programs in one place and runs them by name with the given variables.
+    The guidance Program object is created on first use and reused, and the parse tree of its template is cached
+    by ParsedTemplateCache, since calling a Program would otherwise parse the template again on every run.
+    Call counts and latencies are kept per program.
+    guidance calls the API itself, so with a client every run holds one of the client's request slots and its
+    request and token budget, keyed by the current plan like the client's own requests.
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+        self.templates = {}
+        self.programs = {}
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, template, llm=None):
+        # llm=None uses the default guidance.llm
+        self.templates[name] = (template, llm)
+        self.stats[name] = ProgramStats()
+
+    def get_program(self, name):
+        with self._lock:
+            if name not in self.programs:
+                template, llm = self.templates[name]
+                parse_cache = get_parse_cache()
+                if parse_cache is not None:
+                    parse_cache.add_template(template)
+                self.programs[name] = guidance(template, llm=llm) if llm is not None else guidance(template)
+            return self.programs[name]
+
+    def run(self, name, **variables):
+        backend = get_backend()
+        span = telemetry.start_span("program", name)
+        start_time = time.perf_counter()
+        failed = True
+        try:
+            if self.client is None:
+                output = self._execute(backend, name, variables)
+                self._estimate_tokens(span, name, variables, output)
+            else:
+                template, _ = self.templates[name]
+                with self.client.reserve(self._prompt_text(template, variables)) as reservation:
+                    output = self._execute(backend, name, variables)
+                    self._estimate_tokens(span, name, variables, output)
+                    reservation["tokens"] = span["prompt_tokens"] + span["completion_tokens"]
+            failed = False
+            return output
+        except Exception as e:
+            span["error"] = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self._lock:
+                self.stats[name].record(elapsed, failed)
+            telemetry.end_span(span)
+
+    def _execute(self, backend, name, variables):
+        # Backends without guidance support, such as the mock backend, complete the program by name
+        if backend.supports_guidance:
+            return self.get_program(name)(**variables)
+        return backend.run_program(name, variables)
+
+    def _prompt_text(self, template, variables):
+        return template + " ".join(str(value) for value in variables.values())
+
+    def _estimate_tokens(self, span, name, variables, output):
+        # guidance doesn't report usage, so the tokens are estimated from the text
+        template, _ = self.templates[name]
+        prompt_tokens = count_tokens(self._prompt_text(template, variables))
+        if isinstance(output, dict):
+            completion_tokens = count_tokens(" ".join(str(value) for value in output.values()))
+        else:
+            # The executed program's text holds the prompt followed by the generated values
+            completion_tokens = max(0, count_tokens(str(output)) - prompt_tokens)
+        span["prompt_tokens"] = prompt_tokens
+        span["completion_tokens"] = completion_tokens
+
+    def program_stats(self):
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in self.stats.items() if stats.calls}
+
+    def print_stats(self):
+        print(f"{'program':<32}{'calls':>7}{'errors':>8}{'avg s':>8}{'max s':>8}")
+        for name, stats in sorted(self.program_stats().items(), key=lambda item: item[1]["total_seconds"],
+                                  reverse=True):
+            print(f"{name:<32}{stats['calls']:>7}{stats['errors']:>8}{stats['average_seconds']:>8.2f}"
+                  f"{stats['max_seconds']:>8.2f}")
+        parse_cache = _parse_cache
+        if parse_cache is not None:
+            print(f"Template parses: {parse_cache.stats()}")
@@ -0,0 +1,68 @@
+import threading
+
+from concurrency import get_llm_executor
+
+
+class HeuristicOracle:
+    """
+    Memoizes heuristic estimates by (node, goal) for the duration of a search.
+    Estimates can be prefetched concurrently, e.g. for every neighbor of a popped node,
+    so that the search only waits for the slowest request instead of each one in turn.
+    """
+
+    def __init__(self, estimate, executor=None):
+        # estimate(node, goal) returns the estimated remaining cost from node to goal
+        self.estimate = estimate
+        self.executor = executor if executor is not None else get_llm_executor()
+        self.memo = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.memo = {}
+            self.pending = {}
+            self.hits = 0
+            self.misses = 0
+
+    def _submit(self, node, goal):
+        # Must be called while holding the lock
+        key = (node, goal)
+        if key not in self.memo and key not in self.pending:
+            self.misses += 1
+            self.pending[key] = self.executor.submit(self.estimate, node, goal)
+        return self.pending.get(key)
+
+    def prefetch(self, nodes, goal):
+        with self._lock:
+            for node in nodes:
+                if node != goal:
+                    self._submit(node, goal)
+
+    def precompute(self, nodes, goal):
+        self.prefetch(nodes, goal)
+        for node in nodes:
+            self.get(node, goal)
+
+    def get(self, node, goal):
+        # The goal is reached from itself at no cost, no need to ask the LLM
+        if node == goal:
+            return 0.0
+
+        key = (node, goal)
+        with self._lock:
+            if key in self.memo:
+                self.hits += 1
+                return self.memo[key]
+            future = self._submit(node, goal)
+
+        value = future.result()
+        with self._lock:
+            self.memo[key] = value
+            self.pending.pop(key, None)
+        return value
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memoized": len(self.memo)}
@@ -2,39 +2,108 @@
 # Due to the expressiveness of language, a lot of steps that would generally require complex functions are left up
 # to the LLM
 
-from gpt4_utils import gpt4_is_goal, is_task_primitive, can_execute, log_state_change
+import threading
+import uuid
+
+from checkpoint import Checkpointer, read_checkpoint
+from concurrency import get_llm_executor, get_sibling_executor, cancel_pending
+from goal_checker import GoalChecker
+from gpt4_utils import is_task_primitive, classify_tasks, can_execute, log_state_change, \
+    extract_state_facts, ClassificationPrefetcher
 from openai_api import call_openai_api, log_response
 from task_node import TaskNode
-from text_utils import extract_lists, trace_function_calls
+from telemetry import llm_stage, llm_plan
+from text_utils import extract_lists, trace_function_calls, SubtaskStreamParser
 from guidance_prompts import htn_prompts
+from vector_db import VectorDB
+from world_state import WorldState, parse_facts, render_state, state_records, load_states
+
+# Completion tokens allowed for the facts changed by a single task
+STATE_DELTA_MAX_TOKENS = 256
+
+CHECKPOINT_KIND = "htn_planner"
 
 class HTNPlanner:
-    def __init__(self, initial_state, goal_task, capabilities_input, max_depth=5, send_update_callback=None):
+    def __init__(self, initial_state, goal_task, capabilities_input, max_depth=5, send_update_callback=None,
+                 executor=None, use_method_library=True, parallel_siblings=False, checkpoint_path=None,
+                 stream_subtasks=True, send_subtask_callback=None, prefetch_classification=False):
         self.initial_state = initial_state
         self.goal_task = goal_task
         self.capabilities_input = capabilities_input
         self.max_depth = max_depth
         self.send_update_callback = send_update_callback
+        # Pool used to generate, score and check the candidate decompositions concurrently
+        self.executor = executor if executor is not None else get_llm_executor()
+        # Successful decompositions are stored and reused for tasks with the same normalized name
+        self.use_method_library = use_method_library
+        # Expand sibling subtasks concurrently against the parent's state and reconcile them afterwards
+        self.parallel_siblings = parallel_siblings
+        self.plan_id = f"htn-{uuid.uuid4()}"
+        # Stream the candidate decompositions, send_subtask_callback(task_node, candidate, subtask) is called for
+        # each subtask as soon as it's generated
+        self.stream_subtasks = stream_subtasks
+        self.send_subtask_callback = send_subtask_callback
+        # Classify the streamed subtasks while the rest of the candidate is generated, costs a classification
+        # call per candidate instead of one for the accepted decomposition
+        self.prefetch_classification = prefetch_classification
+        # Goal decisions are memoized per state so replan_required and htn_planning_recursive share them
+        self.goal_checker = GoalChecker()
+        # Accepted decompositions and completed subtrees keyed by their path from the root, saved to
+        # checkpoint_path so that an interrupted plan can be resumed without repeating the LLM calls
+        self.journal_subtasks = {}
+        self.journal_completed = {}
+        self.initial_world_state = None
+        self._journal_lock = threading.Lock()
+        self.checkpointer = Checkpointer(checkpoint_path, CHECKPOINT_KIND, {
+            "initial_state": initial_state,
+            "goal_task": goal_task,
+            "capabilities_input": capabilities_input,
+            "max_depth": max_depth,
+        }) if checkpoint_path else None
+
+    @classmethod
+    def resume(cls, checkpoint_path, send_update_callback=None, **options):
+        # Continues the plan saved in checkpoint_path, new progress is saved to the same file
+        meta, records = read_checkpoint(checkpoint_path, CHECKPOINT_KIND)
+        planner = cls(meta["initial_state"], meta["goal_task"], meta["capabilities_input"], meta["max_depth"],
+                      send_update_callback, checkpoint_path=checkpoint_path, **options)
+        planner.load_checkpoint_records(records)
+        return planner
 
     def htn_planning(self):
-        # Storage for successful task_node's so that they don't need to get regenerated for similar inputs
-        db = None  # db = VectorDB()
-        root_node = TaskNode(self.goal_task)
-        while self.replan_required(self.initial_state, self.goal_task, root_node):
-            root_node = self.htn_planning_recursive(
-                self.initial_state,
-                self.goal_task,
-                root_node,
-                self.max_depth,
-                self.capabilities_input,
-                db,
-                self.send_update_callback,
-            )
-        return root_node
+        # LLM calls made while planning are attributed to this plan in the telemetry
+        with llm_plan(self.plan_id):
+            # Storage for successful task_node's so that they don't need to get regenerated for similar inputs
+            db = VectorDB() if self.use_method_library else None
+            # Tasks update a structured copy of the initial state, prompts only include the facts relevant to them
+            if self.initial_world_state is None:
+                self.initial_world_state = WorldState.from_text(self.initial_state,
+                                                                extract_state_facts(self.initial_state))
+            state = self.initial_world_state
+            root_node = TaskNode(self.goal_task)
+            try:
+                while self.replan_required(state, self.goal_task, root_node):
+                    root_node = self.htn_planning_recursive(
+                        state,
+                        self.goal_task,
+                        root_node,
+                        self.max_depth,
+                        self.capabilities_input,
+                        db,
+                        self.send_update_callback,
+                    )
+            finally:
+                # Saved even when planning fails so that a restart continues from the last completed subtree
+                if self.checkpointer is not None:
+                    self.checkpointer.save(self.checkpoint_records)
+            if db is not None:
+                db.persist()
+            print(f"Goal checks: {self.goal_checker.stats()}")
+            return root_node
 
     @trace_function_calls
     def htn_planning_recursive(self, state, goal_task, root_node, max_depth, capabilities_input, db, send_update_callback=None):
-        if gpt4_is_goal(state, goal_task):
+        if self.goal_checker.is_goal(state, goal_task):
             return root_node
 
         if send_update_callback:
@@ -45,15 +114,17 @@ class HTNPlanner:
         if success:
             root_node.status = "succeeded"
             state = updated_state
-            return root_node
         else:
             root_node.status = "failed"
 
+        if send_update_callback:
+            send_update_callback(root_node)
+
         return root_node
 
     @trace_function_calls
     def replan_required(self, state, goal_task, task_node):
-        if gpt4_is_goal(state, goal_task):
+        if self.goal_checker.is_goal(state, goal_task):
             return False
         if task_node is None or task_node.children == []:
             return True
@@ -61,6 +132,7 @@ class HTNPlanner:
 
 
     @trace_function_calls
+    @llm_stage("translate_task")
     def translate_task(self, task, capabilities_input):
         response = htn_prompts.translate(task, capabilities_input)
         translated_task = response.strip()
@@ -70,6 +142,7 @@ class HTNPlanner:
 
     # Add a new function to check if subtasks meet the requirements
     @trace_function_calls
+    @llm_stage("check_subtasks")
     def check_subtasks(self, task, subtasks, capabilities_input):
         result = htn_prompts.check_subtasks(task, subtasks, capabilities_input)
         log_response("check_subtasks", result)
@@ -78,15 +151,13 @@ class HTNPlanner:
 
     @trace_function_calls
     def decompose(self, task_node, state, depth, max_depth, capabilities_input, goal_state, db, send_update_callback=None,
-                n_candidates=3):
+                n_candidates=3, classification=None, path=()):
+        # classification is the (is_primitive, translated_task) pair found for the task alongside its siblings,
+        # when it's None the task is classified and translated on its own
+        # path is the position of task_node below the root used to journal progress, None for speculative subtrees
         task = task_node.task_name
         decompose_state = state
 
-        # similar_task_nodes = db.query_by_name(task_node.task_name)
-        #
-        # if similar_task_nodes != None and similar_task_nodes != []:
-        #     task_node = similar_task_nodes[0]
-
         if depth > max_depth:
             return False, decompose_state
 
@@ -96,88 +167,373 @@ class HTNPlanner:
         if remaining_decompositions == 0:
             return True, decompose_state
         else:
-            if is_task_primitive(task, capabilities_input):
+            # Reuse a stored decomposition of the same task instead of generating the subtree again
+            if db is not None:
+                stored_task_node = db.query_by_name(task, capabilities_input, remaining_decompositions)
+                if stored_task_node is not None:
+                    reused = self.reuse_decomposition(task_node, stored_task_node, decompose_state,
+                                                      capabilities_input, send_update_callback)
+                    if reused is not None:
+                        return reused
+                    print(f"Stored decomposition can't be executed in the current state, decomposing task:\n{task}")
+
+            if classification is None:
+                classification = (is_task_primitive(task, capabilities_input), None)
+            task_is_primitive, translated_task = classification
+
+            if task_is_primitive:
                 # Translate the task before checking if it can be executed
-                translated_task = self.translate_task(task, capabilities_input)
+                if translated_task is None:
+                    translated_task = self.translate_task(task, capabilities_input)
 
                 # Needs pre-conditions to prevent discontinuities in the graph
                 if can_execute(translated_task, capabilities_input, decompose_state):
                     task_node.update_task_name(translated_task)  # Update the task with the translated form
+                    task_node.is_primitive = True
+                    if send_update_callback:
+                        send_update_callback(task_node)
                     print(f"Executing task:\n{translated_task}")
                     updated_state = self.execute_task(state, translated_task)
                     decompose_state = updated_state
+
+                    if db is not None and path is not None:
+                        db.add_task_node(task, task_node, capabilities_input)
                     return True, decompose_state
                 else:
                     return False, decompose_state
             else:
                 print(f"Decomposing task:\n{task}")
 
-                success = False
-                best_candidate = None  # Add a variable to store the best candidate
-                best_candidate_score = float('-inf')  # Add a variable to store the best candidate score
-
-                """
-                Create n candidate lists of subtask decompositions. If one list of subtasks passes
-                the check_subtasks requirements then continue using that candidate.
-                If the list of subtasks fails the check then continue until one passes or candidates are exhausted.
-                Track the effectiveness of each candidate using the evaluate_candidate function
-                If candidates are exhausted, choose the best candidate list of subtasks and continue.
-                """
-                candidates = []
-                subtasks_list = []
-                for _ in range(n_candidates):
-                    subtasks_list = self.get_subtasks(task, decompose_state, remaining_decompositions, capabilities_input)
-                    score = self.evaluate_candidate(task, [subtask for subtask in subtasks_list], capabilities_input)
-                    candidates.append((subtasks_list, score))
-
-                # Sort candidates by their score
-                candidates.sort(key=lambda x: x[1], reverse=True)
-
-                for subtasks_list, score in candidates:
-                    if self.check_subtasks(task, [subtask for subtask in subtasks_list], capabilities_input):
-                        print(f"Successfully decomposed task into subtasks:\n'{', '.join(subtasks_list)}'")
-                        success = True
-                        break
-
-                    if score > best_candidate_score:
-                        best_candidate_score = score
-                        best_candidate = subtasks_list
-
-                if not success and best_candidate is not None:
-                    print(f"No candidates met the requirements, using the best candidate:\n'{', '.join(best_candidate)}'")
-                    subtasks_list = best_candidate
-
-                if success or best_candidate is not None:
-                    for subtask in subtasks_list:
-                        if send_update_callback:  # Add this line
-                            send_update_callback(task_node)  # Add this line
-
-                        subtask_node = TaskNode(subtask, parent=task_node)
-                        task_node.add_child(subtask_node)
-
-                        success, updated_state = self.decompose(subtask_node, decompose_state, depth + 1, max_depth,
-                                                        capabilities_input,
-                                                        goal_state, db, send_update_callback)
-
-                        if success:
-                            decompose_state = updated_state
-                            task_node.status = "succeeded"
-
-                            if send_update_callback:
-                                send_update_callback(task_node)
-                        else:
-                            task_node.status = "failed"
-                            task_node.children.clear()
+                journaled_subtasks = self.get_journaled_subtasks(path)
+                if journaled_subtasks is not None:
+                    # Resumed from a checkpoint, the decomposition was already chosen
+                    subtasks_list, success = journaled_subtasks
+                    best_candidate = subtasks_list
+                else:
+                    success = False
+                    best_candidate = None  # Add a variable to store the best candidate
+                    best_candidate_score = float('-inf')  # Add a variable to store the best candidate score
+
+                    """
+                    Create n candidate lists of subtask decompositions concurrently and score each with evaluate_candidate.
+                    The check_subtasks requirements are then probed speculatively for all candidates at once.
+                    Every call waits for a slot and budget of the shared LLM client, so the fan-out stays within its limits.
+                    The highest scoring candidate that passes the check is used and the checks still pending are cancelled.
+                    If no candidate passes, choose the best candidate list of subtasks and continue.
+                    """
+                    candidate_futures = [
+                        self.executor.submit(self.generate_candidate, task, decompose_state, remaining_decompositions,
+                                             capabilities_input, task_node, candidate)
+                        for candidate in range(n_candidates)
+                    ]
+                    candidates = [future.result() for future in candidate_futures]
+
+                    # Sort candidates by their score
+                    candidates.sort(key=lambda x: x[1], reverse=True)
+
+                    check_futures = [
+                        self.executor.submit(self.check_subtasks, task, [subtask for subtask in subtasks_list],
+                                             capabilities_input)
+                        for subtasks_list, _ in candidates
+                    ]
+
+                    subtasks_list = []
+                    for index, (subtasks_list, score) in enumerate(candidates):
+                        # Wait in score order so that a passing candidate is only accepted once every better one failed
+                        if check_futures[index].result():
+                            print(f"Successfully decomposed task into subtasks:\n'{', '.join(subtasks_list)}'")
+                            success = True
+                            cancel_pending(check_futures[index + 1:])
                             break
 
-                # Update the db with the current task_node
-                # if success:
-                #     db.add_task_node(task_node)
+                        if score > best_candidate_score:
+                            best_candidate_score = score
+                            best_candidate = subtasks_list
+
+                    if not success and best_candidate is not None:
+                        print(f"No candidates met the requirements, using the best candidate:\n'{', '.join(best_candidate)}'")
+                        subtasks_list = best_candidate
+
+                    if success or best_candidate is not None:
+                        self.add_journaled_subtasks(path, subtasks_list, success)
+
+                if success or best_candidate is not None:
+                    # The siblings are known up front, classify and translate them together before recursing
+                    classifications = classify_tasks(subtasks_list, capabilities_input) \
+                        if remaining_decompositions > 1 else [None] * len(subtasks_list)
+                    if self.parallel_siblings and len(subtasks_list) > 1:
+                        success, decompose_state = self.decompose_siblings_parallel(
+                            task_node, subtasks_list, classifications, decompose_state, depth, max_depth,
+                            capabilities_input, goal_state, db, send_update_callback, path)
+                    else:
+                        for index, (subtask, subtask_classification) in enumerate(zip(subtasks_list, classifications)):
+                            if send_update_callback:  # Add this line
+                                send_update_callback(task_node)  # Add this line
+
+                            subtask_path = path + (index,) if path is not None else None
+                            journaled_completion = self.get_journaled_completion(subtask_path)
+                            if journaled_completion is not None:
+                                subtask_node, updated_state = journaled_completion
+                                task_node.add_child(subtask_node)
+                                success = True
+                            else:
+                                subtask_node = TaskNode(subtask, parent=task_node)
+                                task_node.add_child(subtask_node)
+
+                                success, updated_state = self.decompose(subtask_node, decompose_state, depth + 1,
+                                                                max_depth, capabilities_input,
+                                                                goal_state, db, send_update_callback,
+                                                                classification=subtask_classification,
+                                                                path=subtask_path)
+
+                            if success:
+                                decompose_state = updated_state
+                                task_node.status = "succeeded"
+                                self.add_journaled_completion(subtask_path, subtask_node, decompose_state)
+
+                                if send_update_callback:
+                                    send_update_callback(task_node)
+                            else:
+                                task_node.status = "failed"
+                                task_node.children.clear()
+                                self.discard_journal(path)
+
+                                if send_update_callback:
+                                    send_update_callback(task_node)
+                                break
+
+                # Update the db with the current task_node, speculative subtrees are stored once they are re-validated
+                if success and db is not None and path is not None:
+                    db.add_task_node(task, task_node, capabilities_input)
 
                 return success, decompose_state
 
 
     @trace_function_calls
+    def decompose_siblings_parallel(self, task_node, subtasks_list, classifications, state, depth, max_depth,
+                                    capabilities_input, goal_state, db, send_update_callback=None, path=()):
+        """
+        Expands every sibling speculatively in parallel against the parent's state, then walks them in order
+        re-validating their primitive tasks with can_execute against the state left by the previous siblings.
+        Only the subtrees that conflict with that state are expanded again.
+        """
+        subtask_paths = [path + (index,) if path is not None else None for index in range(len(subtasks_list))]
+
+        # Siblings completed before a checkpoint are restored, the rest are expanded from the state they left
+        subtask_nodes = []
+        speculative_results = []
+        for subtask_path in subtask_paths:
+            journaled_completion = self.get_journaled_completion(subtask_path)
+            if journaled_completion is None:
+                break
+            subtask_node, state = journaled_completion
+            task_node.add_child(subtask_node)
+            subtask_nodes.append(subtask_node)
+            speculative_results.append((True, state))
+        resumed = len(subtask_nodes)
+
+        for subtask in subtasks_list[resumed:]:
+            subtask_node = TaskNode(subtask, parent=task_node)
+            task_node.add_child(subtask_node)
+            subtask_nodes.append(subtask_node)
+
+        if send_update_callback:
+            send_update_callback(task_node)
+
+        def expand(index):
+            # Only the first expansion runs against the real state, the speculative subtrees aren't journaled or
+            # stored in the method library until they are re-validated
+            return self.decompose(subtask_nodes[index], state, depth + 1, max_depth, capabilities_input, goal_state,
+                                  db, send_update_callback, classification=classifications[index],
+                                  path=subtask_paths[index] if index == resumed else None)
+
+        # The expansions wait on decompositions of their own, so they run on the shared sibling pool instead of
+        # self.executor. Nested levels share its threads, the siblings it has no free thread for are expanded here
+        sibling_executor = get_sibling_executor()
+        futures = {index: sibling_executor.try_submit(expand, index)
+                   for index in range(resumed + 1, len(subtask_nodes))}
+        expanded = {index: expand(index) for index in range(resumed, len(subtask_nodes))
+                    if futures.get(index) is None}
+        speculative_results.extend(expanded[index] if index in expanded else futures[index].result()
+                                   for index in range(resumed, len(subtask_nodes)))
+
+        success = True
+        for index, (success, speculative_state) in enumerate(speculative_results):
+            if index <= resumed:
+                # Restored siblings and the first expanded one match the real state, there is nothing to reconcile
+                if success:
+                    state = speculative_state
+            else:
+                replayed_state = self.replay_subtree(subtask_nodes[index], state, capabilities_input) \
+                    if success else None
+                if replayed_state is not None:
+                    state = replayed_state
+                    if db is not None and path is not None:
+                        db.add_task_node(subtasks_list[index], subtask_nodes[index], capabilities_input)
+                else:
+                    print(f"Re-expanding task after a state conflict:\n{subtasks_list[index]}")
+                    subtask_node = TaskNode(subtasks_list[index], parent=task_node)
+                    task_node.children[index] = subtask_node
+                    success, state = self.decompose(subtask_node, state, depth + 1, max_depth,
+                                                    capabilities_input, goal_state, db, send_update_callback,
+                                                    classification=classifications[index],
+                                                    path=subtask_paths[index])
+
+            if success:
+                task_node.status = "succeeded"
+                self.add_journaled_completion(subtask_paths[index], task_node.children[index], state)
+                if send_update_callback:
+                    send_update_callback(task_node)
+            else:
+                task_node.status = "failed"
+                task_node.children.clear()
+                self.discard_journal(path)
+                if send_update_callback:
+                    send_update_callback(task_node)
+                break
+
+        return success, state
+
+
+    @trace_function_calls
+    def replay_subtree(self, task_node, state, capabilities_input):
+        # Executes the primitive tasks of a speculatively expanded or stored subtree in order, None if one can't be
+        # executed from state
+        for primitive_task in self.primitive_tasks(task_node):
+            if not can_execute(primitive_task, capabilities_input, state):
+                print(f"Task can't be executed in the current state:\n{primitive_task}")
+                return None
+            state = self.execute_task(state, primitive_task)
+        return state
+
+
+    def get_journaled_subtasks(self, path):
+        if path is None:
+            return None
+        with self._journal_lock:
+            return self.journal_subtasks.get(path)
+
+    def add_journaled_subtasks(self, path, subtasks_list, accepted):
+        if path is None:
+            return
+        with self._journal_lock:
+            self.journal_subtasks[path] = (list(subtasks_list), accepted)
+
+    def get_journaled_completion(self, path):
+        # A copy of the completed subtree and the state it left, the stored subtree is never attached to the plan
+        if path is None:
+            return None
+        with self._journal_lock:
+            completion = self.journal_completed.get(path)
+        if completion is None:
+            return None
+        subtree, state = completion
+        return TaskNode.from_dict(subtree), state
+
+    def add_journaled_completion(self, path, task_node, state):
+        if path is None:
+            return
+        with self._journal_lock:
+            # The subtree replaces the entries journaled while it was being decomposed
+            self._discard_journal_locked(path)
+            self.journal_completed[path] = (task_node.to_dict(), state)
+        if self.checkpointer is not None:
+            self.checkpointer.maybe_save(self.checkpoint_records)
+
+    def discard_journal(self, path):
+        # The decomposition at path failed, it and everything below it will be generated again
+        if path is None:
+            return
+        with self._journal_lock:
+            self._discard_journal_locked(path)
+
+    def _discard_journal_locked(self, path):
+        for journal in (self.journal_subtasks, self.journal_completed):
+            for journaled_path in [journaled_path for journaled_path in journal
+                                   if journaled_path[:len(path)] == path]:
+                del journal[journaled_path]
+
+    def checkpoint_records(self):
+        with self._journal_lock:
+            subtasks = list(self.journal_subtasks.items())
+            completed = list(self.journal_completed.items())
+
+        states = [self.initial_world_state] + [state for _, (_, state) in completed]
+        records = state_records(state for state in states if state is not None)
+        if self.initial_world_state is not None:
+            records.append({"type": "initial_state", "state": self.initial_world_state.version})
+        records.extend({"type": "subtasks", "path": list(path), "subtasks": subtasks_list, "accepted": accepted}
+                       for path, (subtasks_list, accepted) in subtasks)
+        records.extend({"type": "completed", "path": list(path), "subtree": subtree, "state": state.version}
+                       for path, (subtree, state) in completed)
+        return records
+
+    def load_checkpoint_records(self, records):
+        states = load_states(record for record in records if record["type"] == "state")
+        for record in records:
+            if record["type"] == "initial_state":
+                self.initial_world_state = states[record["state"]]
+            elif record["type"] == "subtasks":
+                self.journal_subtasks[tuple(record["path"])] = (record["subtasks"], record["accepted"])
+            elif record["type"] == "completed":
+                self.journal_completed[tuple(record["path"])] = (record["subtree"], states[record["state"]])
+
+
+    @trace_function_calls
+    def reuse_decomposition(self, task_node, stored_task_node, state, capabilities_input, send_update_callback=None):
+        # Graft the stored subtree onto task_node once its primitive tasks were re-validated with can_execute
+        # against the current state, None when one of them can't be executed
+        updated_state = self.replay_subtree(stored_task_node, state, capabilities_input)
+        if updated_state is None:
+            return None
+
+        print(f"Reusing stored decomposition for task:\n{task_node.task_name}")
+        # The node keeps the requested task name, a stored primitive task is named after its translated form
+        if stored_task_node.is_primitive:
+            task_node.update_task_name(stored_task_node.task_name)
+        task_node.is_primitive = stored_task_node.is_primitive
+        task_node.status = stored_task_node.status
+        for child in list(stored_task_node.children):
+            task_node.add_child(child)
+
+        if send_update_callback:
+            send_update_callback(task_node)
+
+        return True, updated_state
+
+
+    def primitive_tasks(self, task_node):
+        if task_node.is_primitive:
+            return [task_node.task_name]
+        primitive_tasks = []
+        for child in task_node.children:
+            primitive_tasks.extend(self.primitive_tasks(child))
+        return primitive_tasks
+
+
+    @trace_function_calls
+    def generate_candidate(self, task, state, remaining_decompositions, capabilities_input, task_node=None,
+                           candidate=0):
+        on_subtask = None
+        if self.stream_subtasks and (self.send_subtask_callback or self.prefetch_classification):
+            # Subtasks of the candidate are only classified when they can still be decomposed
+            prefetcher = ClassificationPrefetcher(capabilities_input, self.executor) \
+                if self.prefetch_classification and remaining_decompositions > 1 else None
+
+            def on_subtask(subtask):
+                if self.send_subtask_callback and task_node is not None:
+                    self.send_subtask_callback(task_node, candidate, subtask)
+                if prefetcher is not None:
+                    prefetcher.add(subtask)
+
+        subtasks_list = self.get_subtasks(task, state, remaining_decompositions, capabilities_input, on_subtask,
+                                          htn_prompts.get_subtasks_temperature(candidate))
+        score = self.evaluate_candidate(task, [subtask for subtask in subtasks_list], capabilities_input)
+        return subtasks_list, score
+
+
+    @trace_function_calls
+    @llm_stage("evaluate_candidate")
     def evaluate_candidate(self, task, subtasks, capabilities_input):
         max_retries = 3
         retries = 0
@@ -195,8 +551,21 @@ class HTNPlanner:
 
 
     @trace_function_calls
-    def get_subtasks(self, task, state, remaining_decompositions, capabilities_input):
-        subtasks_with_types = htn_prompts.get_subtasks(task, state, remaining_decompositions, capabilities_input)
+    @llm_stage("decompose")
+    def get_subtasks(self, task, state, remaining_decompositions, capabilities_input, on_subtask=None,
+                     temperature=htn_prompts.GET_SUBTASKS_TEMPERATURE):
+        if self.stream_subtasks:
+            # on_subtask(subtask) is called as each subtask is parsed out of the stream
+            parser = SubtaskStreamParser()
+            for chunk in htn_prompts.stream_subtasks(task, render_state(state, task), remaining_decompositions,
+                                                     capabilities_input, temperature):
+                for subtask in parser.feed(chunk):
+                    if on_subtask:
+                        on_subtask(subtask)
+            subtasks_with_types = parser.text.strip()
+        else:
+            subtasks_with_types = htn_prompts.get_subtasks(task, render_state(state, task), remaining_decompositions,
+                                                           capabilities_input, temperature)
         print(f"Decomposing task {task} into candidates:\n{subtasks_with_types}")
         subtasks_list = extract_lists(subtasks_with_types)
         return subtasks_list
@@ -204,13 +573,26 @@ class HTNPlanner:
 
     # Update the execute_task function to log state changes
     @trace_function_calls
+    @llm_stage("execute_task")
     def execute_task(self, state, task):
-        prompt = (f"Given the current state '{state}' and the task '{task}', "
-                f"update the state after executing the task:")
-
-        response = call_openai_api(prompt)
-
-        updated_state = response.choices[0].message.content.strip()
+        # Only the facts changed by the task are generated, so the reply doesn't grow with the length of the plan.
+        # The prompt only shows the facts most relevant to the task, changes to the others returned under a
+        # differently formatted name are mapped onto the existing fact by resolve_delta
+        prompt = (f"Given the current state '{render_state(state, task)}' and the task '{task}', "
+                  f"list the facts that change after executing the task as a JSON object mapping each fact to its "
+                  f"new value, use the existing name of a fact that changes and null for facts that no longer hold. "
+                  f"Respond with only the JSON object:")
+
+        response = call_openai_api(prompt, max_tokens=STATE_DELTA_MAX_TOKENS)
+
+        response_str = response.choices[0].message.content.strip()
+        delta = parse_facts(response_str)
+        if delta is None:
+            # Keep the reply as a fact of its own rather than losing the change
+            delta = {f"after {task}": response_str}
+        elif isinstance(state, WorldState):
+            delta = state.resolve_delta(delta)
+        updated_state = state.apply(delta, task)
         log_response("execute_task", task)
         log_state_change(state, updated_state, task)  # Add this line to log state changes
         return updated_state
@@ -0,0 +1,174 @@
+import asyncio
+import random
+import re
+import threading
+import time
+
+import openai
+
+CHARACTERS_PER_TOKEN = 4
+# Characters per chunk when the mock backend streams a response
+MOCK_STREAM_CHUNK_SIZE = 16
+
+
+def count_tokens(text):
+    return max(1, len(text) // CHARACTERS_PER_TOKEN)
+
+
+def make_chat_response(model, content, prompt_tokens, completion_tokens):
+    # Same shape as the responses returned by openai.ChatCompletion
+    return openai.util.convert_to_openai_object({
+        "object": "chat.completion",
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    })
+
+
+class LLMBackend:
+    """
+    Interface for the service that completes prompts.
+    Backends that can't run guidance programs complete them by name through run_program instead.
+    """
+
+    supports_guidance = False
+
+    async def acomplete(self, model, prompt, max_tokens, temperature):
+        raise NotImplementedError
+
+    async def astream(self, model, prompt, max_tokens, temperature):
+        # Async iterator over the text of the completion as it's generated
+        raise NotImplementedError
+
+    def run_program(self, name, variables):
+        raise NotImplementedError
+
+
+class OpenAIBackend(LLMBackend):
+    supports_guidance = True
+
+    async def acomplete(self, model, prompt, max_tokens, temperature):
+        return await openai.ChatCompletion.acreate(
+            model=model,
+            messages=[{"role": "system", "content": prompt}],
+            max_tokens=max_tokens,
+            n=1,
+            stop=None,
+            temperature=temperature,
+        )
+
+    async def astream(self, model, prompt, max_tokens, temperature):
+        response = await openai.ChatCompletion.acreate(
+            model=model,
+            messages=[{"role": "system", "content": prompt}],
+            max_tokens=max_tokens,
+            n=1,
+            stop=None,
+            temperature=temperature,
+            stream=True,
+        )
+        async for chunk in response:
+            text = chunk.choices[0].delta.get("content")
+            if text:
+                yield text
+
+
+class MockBackend(LLMBackend):
+    """
+    Local, scriptable stand-in for the OpenAI API.
+
+    responses is a list of (pattern, response) pairs, the first pattern found in the prompt is used.
+    program_responses maps guidance program names to their outputs.
+    In both cases the response can be a callable that receives the prompt or the program variables.
+    Every call waits latency seconds and fails with an APIError at the given failure_rate.
+    """
+
+    def __init__(self, responses=None, program_responses=None, default_response="True", latency=0.0,
+                 failure_rate=0.0, seed=None):
+        self.responses = [(re.compile(pattern), response) for pattern, response in (responses or [])]
+        self.program_responses = program_responses or {}
+        self.default_response = default_response
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+        self.calls = 0
+        self.failures = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def _should_fail(self):
+        with self._lock:
+            self.calls += 1
+            failed = self.random.random() < self.failure_rate
+            self.failures += 1 if failed else 0
+            return failed
+
+    def _record_tokens(self, prompt_tokens, completion_tokens):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def _respond(self, prompt):
+        for pattern, response in self.responses:
+            if pattern.search(prompt):
+                return response(prompt) if callable(response) else response
+        return self.default_response
+
+    async def acomplete(self, model, prompt, max_tokens, temperature):
+        await asyncio.sleep(self.latency)
+        if self._should_fail():
+            raise openai.error.APIError("Mock backend failure")
+
+        content = self._respond(prompt)
+        prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(content)
+        self._record_tokens(prompt_tokens, completion_tokens)
+        return make_chat_response(model, content, prompt_tokens, completion_tokens)
+
+    async def astream(self, model, prompt, max_tokens, temperature):
+        # The latency is spread over the chunks so the first text arrives before the whole response
+        if self._should_fail():
+            raise openai.error.APIError("Mock backend failure")
+
+        content = self._respond(prompt)
+        self._record_tokens(count_tokens(prompt), count_tokens(content))
+        chunks = [content[i:i + MOCK_STREAM_CHUNK_SIZE] for i in range(0, len(content), MOCK_STREAM_CHUNK_SIZE)]
+        for chunk in chunks:
+            await asyncio.sleep(self.latency / len(chunks))
+            yield chunk
+
+    def run_program(self, name, variables):
+        time.sleep(self.latency)
+        if self._should_fail():
+            raise openai.error.APIError("Mock backend failure")
+
+        response = self.program_responses[name]
+        output = dict(response(variables) if callable(response) else response)
+        self._record_tokens(count_tokens(" ".join(str(value) for value in variables.values())),
+                            count_tokens(" ".join(str(value) for value in output.values())))
+        return output
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+_backend = OpenAIBackend()
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
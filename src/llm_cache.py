@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Cache modes
+CACHE_MODE_OFF = "off"
+CACHE_MODE_DETERMINISTIC = "deterministic"  # Only temperature 0 calls are cached
+CACHE_MODE_ALL = "all"
+
+DEFAULT_CACHE_PATH = "cache/llm_cache.sqlite3"
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def make_cache_key(model, prompt, temperature, max_tokens):
+    key_data = json.dumps([model, prompt, temperature, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Disk-backed, content-addressed cache of LLM responses stored in SQLite.
+    Entries expire after ttl_seconds and the least recently used entries are evicted once the
+    total size of the stored responses exceeds max_bytes.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES,
+                 mode=CACHE_MODE_DETERMINISTIC):
+        if mode not in (CACHE_MODE_OFF, CACHE_MODE_DETERMINISTIC, CACHE_MODE_ALL):
+            raise ValueError(f"Unknown cache mode '{mode}'")
+
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.mode = mode
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._connection = None
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.environ.get("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+            ttl_seconds=float(os.environ.get("LLM_CACHE_TTL", DEFAULT_TTL_SECONDS)),
+            max_bytes=int(os.environ.get("LLM_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+            mode=os.environ.get("LLM_CACHE_MODE", CACHE_MODE_DETERMINISTIC),
+        )
+
+    def is_cacheable(self, temperature):
+        if self.mode == CACHE_MODE_OFF:
+            return False
+        if self.mode == CACHE_MODE_DETERMINISTIC:
+            return temperature == 0
+        return True
+
+    def _connect(self):
+        # The connection is opened lazily so that importing the api module doesn't touch the disk
+        if self._connection is None:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, "
+                "created REAL, last_access REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._connection.commit()
+            self._purge_expired()
+            self._total_bytes = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self._connection
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        cursor = self._connection.execute("DELETE FROM responses WHERE created < ?", (cutoff,))
+        self.expirations += cursor.rowcount
+        self._connection.commit()
+
+    def get(self, model, prompt, temperature, max_tokens):
+        if not self.is_cacheable(temperature):
+            return None
+
+        key = make_cache_key(model, prompt, temperature, max_tokens)
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT response, size, created FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            response, size, created = row
+            if created + self.ttl_seconds < now:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                connection.commit()
+                self._total_bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            connection.commit()
+            self.hits += 1
+            return response
+
+    def put(self, model, prompt, temperature, max_tokens, response):
+        if not self.is_cacheable(temperature):
+            return
+
+        key = make_cache_key(model, prompt, temperature, max_tokens)
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            connection = self._connect()
+            previous = connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if previous is not None:
+                self._total_bytes -= previous[0]
+
+            now = time.time()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, now, now),
+            )
+            self._total_bytes += size
+            self.stores += 1
+            self._evict()
+            connection.commit()
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache fits within max_bytes
+        while self._total_bytes > self.max_bytes:
+            row = self._connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_access ASC LIMIT 1").fetchone()
+            if row is None:
+                self._total_bytes = 0
+                break
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            self._total_bytes -= row[1]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM responses")
+            connection.commit()
+            self._total_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "total_bytes": self._total_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,348 @@
+import asyncio
+import collections
+import contextlib
+import os
+import queue
+import random
+import threading
+import time
+
+import openai
+
+from llm_backend import get_backend
+from telemetry import current_plan
+
+# Defaults for the request and token quotas, override them with environment variables to match the account limits
+DEFAULT_REQUESTS_PER_MINUTE = 200
+DEFAULT_TOKENS_PER_MINUTE = 40000
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+# Completion size assumed for the token budget when max_tokens isn't given
+DEFAULT_COMPLETION_TOKENS = 512
+CHARACTERS_PER_TOKEN = 4
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+)
+
+
+def estimate_tokens(prompt, max_tokens=None):
+    completion_tokens = max_tokens if max_tokens is not None else DEFAULT_COMPLETION_TOKENS
+    return len(prompt) // CHARACTERS_PER_TOKEN + completion_tokens
+
+
+def get_retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+    # Exponential backoff with full jitter so that concurrent callers don't retry in lockstep
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    Refills continuously at rate_per_minute up to capacity. Waiters are served in arrival order.
+    A rate_per_minute of None doesn't limit anything, e.g. in front of the mock backend.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.unlimited = rate_per_minute is None
+        self.rate_per_second = rate_per_minute / 60.0 if not self.unlimited else None
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        if self.unlimited:
+            return
+        # Requests larger than the bucket would never be served, so they're clamped to a full bucket
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate_per_second)
+
+    def adjust(self, amount):
+        # Positive amounts return unused tokens, negative amounts charge for usage beyond the estimate
+        if self.unlimited:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds):
+        # Drain the bucket so that no requests are issued for the given number of seconds
+        if self.unlimited:
+            return
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate_per_second)
+
+
+class FairSemaphore:
+    """
+    Semaphore whose free slots are handed to the waiting plans in turn, one request each, so a plan issuing
+    many requests at once can't starve the plans running next to it. Only used from the client loop.
+    """
+
+    def __init__(self, value):
+        self.value = value
+        # plan -> requests waiting for a slot, in arrival order
+        self.waiters = collections.OrderedDict()
+
+    async def acquire(self, plan):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(plan, collections.deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over as the request was cancelled, pass it on
+                self.release()
+            else:
+                self._remove_waiter(plan, waiter)
+            raise
+
+    def _remove_waiter(self, plan, waiter):
+        queue = self.waiters.get(plan)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self.waiters[plan]
+
+    def release(self):
+        while self.waiters:
+            plan, queue = next(iter(self.waiters.items()))
+            waiter = queue.popleft()
+            if queue:
+                # The plan goes to the back of the line for its next request
+                self.waiters.move_to_end(plan)
+            else:
+                del self.waiters[plan]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.value += 1
+
+    def slot(self, plan):
+        return _FairSlot(self, plan)
+
+
+class _FairSlot:
+    def __init__(self, semaphore, plan):
+        self.semaphore = semaphore
+        self.plan = plan
+
+    async def __aenter__(self):
+        await self.semaphore.acquire(self.plan)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.semaphore.release()
+
+
+class AsyncLLMClient:
+    """
+    asyncio chat completion client with bounded concurrency and a request/token budget.
+    The client owns an event loop running on a background thread so that the blocking wrappers
+    can be used from any thread, including worker pools.
+    The budget is shared by every plan in the process, requests from concurrent plans are served in turn.
+    """
+
+    def __init__(self, model="gpt-4", requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.model = model
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._request_bucket = None
+        self._token_bucket = None
+        self._semaphore = None
+
+    @classmethod
+    def from_env(cls, model="gpt-4"):
+        return cls(
+            model=model,
+            requests_per_minute=float(os.environ.get("OPENAI_RPM", DEFAULT_REQUESTS_PER_MINUTE)),
+            tokens_per_minute=float(os.environ.get("OPENAI_TPM", DEFAULT_TOKENS_PER_MINUTE)),
+            max_concurrency=int(os.environ.get("OPENAI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+        )
+
+    @property
+    def loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="llm-client-loop", daemon=True)
+                thread.start()
+                self._loop = loop
+            return self._loop
+
+    def _ensure_limits(self):
+        # The asyncio primitives are created on the client loop, the only loop they are ever used from
+        if self._semaphore is None:
+            self._request_bucket = TokenBucket(self.requests_per_minute)
+            self._token_bucket = TokenBucket(self.tokens_per_minute)
+            self._semaphore = FairSemaphore(self.max_concurrency)
+
+    async def _acquire_budget(self, estimated_tokens):
+        self._ensure_limits()
+        await self._request_bucket.acquire(1)
+        await self._token_bucket.acquire(estimated_tokens)
+
+    def _settle_budget(self, estimated_tokens, response):
+        usage = response.get("usage") if hasattr(response, "get") else None
+        if usage and "total_tokens" in usage:
+            self._token_bucket.adjust(estimated_tokens - usage["total_tokens"])
+
+    async def _create(self, prompt, max_tokens, temperature, span=None, plan=None):
+        # span is the telemetry record of the call, the number of retries is added to it
+        # plan is the plan making the request, concurrent plans take turns for the request slots
+        estimated_tokens = estimate_tokens(prompt, max_tokens)
+        self._ensure_limits()
+
+        for attempt in range(self.max_retries):
+            try:
+                # The slot is taken before the budget so the budget's queue is filled fairly across plans
+                async with self._semaphore.slot(plan):
+                    await self._acquire_budget(estimated_tokens)
+                    response = await get_backend().acomplete(self.model, prompt, max_tokens, temperature)
+                self._settle_budget(estimated_tokens, response)
+                return response
+            except RETRYABLE_ERRORS as e:
+                await self._wait_before_retry(e, attempt, span)
+
+        raise Exception("Failed to get a response from the GPT-4 API after multiple retries.")
+
+    async def _wait_before_retry(self, error, attempt, span=None):
+        delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            # The server told us when the quota frees up, hold every request until then
+            delay = max(delay, retry_after)
+            self._request_bucket.pause(retry_after)
+        print(f"{type(error).__name__} encountered: {error}. Retrying in {delay:.1f} seconds...")
+        if span is not None:
+            span["retries"] += 1
+        await asyncio.sleep(delay)
+
+    async def _stream(self, prompt, max_tokens, temperature, on_text, span=None, plan=None):
+        # Calls on_text with each piece of the completion as it arrives, on the client loop
+        estimated_tokens = estimate_tokens(prompt, max_tokens)
+        self._ensure_limits()
+
+        for attempt in range(self.max_retries):
+            streamed_characters = 0
+            try:
+                async with self._semaphore.slot(plan):
+                    await self._acquire_budget(estimated_tokens)
+                    async for text in get_backend().astream(self.model, prompt, max_tokens, temperature):
+                        streamed_characters += len(text)
+                        on_text(text)
+                # Streamed responses carry no usage, the budget is settled from the text received
+                self._token_bucket.adjust(
+                    estimated_tokens - estimate_tokens(prompt, streamed_characters // CHARACTERS_PER_TOKEN))
+                return
+            except RETRYABLE_ERRORS as e:
+                if streamed_characters:
+                    # Part of the response was already delivered, retrying would repeat it
+                    raise
+                await self._wait_before_retry(e, attempt, span)
+
+        raise Exception("Failed to get a response from the GPT-4 API after multiple retries.")
+
+    async def acomplete(self, prompt, max_tokens=None, temperature=1.0, span=None):
+        coroutine = self._create(prompt, max_tokens, temperature, span, current_plan.get())
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self.loop:
+            return await coroutine
+        # Awaited from another event loop, run on the client loop so that the limits are shared
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    def stream(self, prompt, max_tokens=None, temperature=1.0, span=None):
+        # Yields the text of the completion on the calling thread as it arrives
+        chunks = queue.Queue()
+        finished = object()
+        coroutine = self._stream(prompt, max_tokens, temperature, chunks.put, span, current_plan.get())
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(lambda _: chunks.put(finished))
+        try:
+            while True:
+                text = chunks.get()
+                if text is finished:
+                    break
+                yield text
+        finally:
+            # The consumer stopped early, stop the request and free its slot instead of streaming into the queue
+            if not future.done():
+                future.cancel()
+        # Raises the error that ended the stream, if any
+        future.result()
+
+    async def _acquire_slot(self, estimated_tokens, plan):
+        self._ensure_limits()
+        await self._semaphore.acquire(plan)
+        try:
+            await self._acquire_budget(estimated_tokens)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def _release_slot(self, unused_tokens):
+        self._token_bucket.adjust(unused_tokens)
+        self._semaphore.release()
+
+    @contextlib.contextmanager
+    def reserve(self, prompt, max_tokens=None):
+        """
+        Holds a request slot and the budget of one request while a call that doesn't go through the client, such as
+        a guidance program, reaches the API, so it's throttled and takes turns with the requests of the other plans.
+        The yielded dict holds the tokens charged, set its "tokens" to the tokens actually used.
+        """
+        estimated_tokens = estimate_tokens(prompt, max_tokens)
+        coroutine = self._acquire_slot(estimated_tokens, current_plan.get())
+        asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        reservation = {"tokens": estimated_tokens}
+        try:
+            yield reservation
+        finally:
+            self.loop.call_soon_threadsafe(self._release_slot, estimated_tokens - reservation["tokens"])
+
+    def complete(self, prompt, max_tokens=None, temperature=1.0, span=None):
+        # The plan is read on the calling thread, the coroutine runs in the client loop's own context
+        coroutine = self._create(prompt, max_tokens, temperature, span, current_plan.get())
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
@@ -1,57 +1,64 @@
+import argparse
+import datetime
+import os
 import threading
 
 from flask import Flask
 from flask_cors import CORS
-from flask_socketio import SocketIO
-from htn_planner import HTNPlanner
-from search_planner import SearchPlanner
+from flask_socketio import SocketIO, emit
+from htn_planner import HTNPlanner, CHECKPOINT_KIND as HTN_PLANNER_CHECKPOINT
+from search_planner import SearchPlanner, CHECKPOINT_KIND as SEARCH_PLANNER_CHECKPOINT, SEARCH_ASTAR, \
+    SEARCH_ALGORITHMS
 
+from checkpoint import read_checkpoint_kind
 from gpt4_utils import get_initial_task, compress_capabilities
-from text_utils import trace_function_calls
+from guidance_prompts.htn_prompts import print_program_stats
+from openai_api import response_cache
+from planning_service import PlanningService
+from telemetry import telemetry
+from tree_updates import TaskTreePublisher
 
 app = Flask(__name__)
 CORS(app)  # Add this line to enable CORS
 socketio = SocketIO(app, cors_allowed_origins="*")
 
-@trace_function_calls
-def task_node_to_dict(task_node):
-    if task_node is None:
-        return None
+CHECKPOINT_DIR = "checkpoints"
 
-    return {
-        "task_name": task_node.task_name,
-        "status": task_node.status,
-        "children": [task_node_to_dict(child) for child in task_node.children]
-    }
+# Sends changes to the plan as patches, clients receive a snapshot when they connect
+task_tree_publisher = TaskTreePublisher(socketio.emit)
 
 @socketio.on('connect')
 def handle_connect():
     print('Client connected')
+    emit('task_tree_snapshot', task_tree_publisher.snapshot())
+
+@socketio.on('request_snapshot')
+def handle_request_snapshot():
+    # Sent by clients that missed a patch
+    emit('task_tree_snapshot', task_tree_publisher.snapshot())
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
 
 def send_task_node_update(task_node):
-    root_task_node = task_node
-    while root_task_node.parent is not None:
-        root_task_node = root_task_node.parent
-    task_node_data = task_node_to_dict(root_task_node)
-    socketio.emit('task_node_update', task_node_data)
+    task_tree_publisher.publish(task_node)
+
+def send_streamed_subtask(task_node, candidate, task_name):
+    task_tree_publisher.publish_subtask(task_node, candidate, task_name)
 
-def run_server():
-    socketio.run(app, host="127.0.0.1", debug=True, use_reloader=False, port=5000, allow_unsafe_werkzeug=True, log_output=False)
+def run_server(host="127.0.0.1", port=5000, debug=True, allow_werkzeug=True):
+    # The service runs with debug off, it can be bound to a public address. The werkzeug development server is only
+    # used when neither eventlet nor gevent is installed, without allow_werkzeug flask_socketio refuses to start it
+    socketio.run(app, host=host, debug=debug, use_reloader=False, port=port, allow_unsafe_werkzeug=allow_werkzeug,
+                 log_output=False)
 
 def print_plan(task_node, depth=0):
     print(f"{'  ' * depth}- {task_node.task_name}")
     for child in task_node.children:
         print_plan(child, depth + 1)
 
-def main():
-    # Clear the log file at the beginning of each run
-    with open('function_trace.log', 'w') as log_file:
-        log_file.write("")
-
+def create_planner(search_algorithm=SEARCH_ASTAR):
     initial_state_input = input("Describe the initial state: ")
     goal_input = input("Describe your goal: ")
 
@@ -75,17 +82,72 @@ def main():
         print("HTN planner selected")
         use_search_planner = False
 
-    server_thread = threading.Thread(target=run_server)
-    server_thread.start()
     print("Starting planning with the initial goal task:", goal_task)
 
+    # Progress is saved so that the plan can be resumed with --resume if the run is interrupted
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     if use_search_planner:
-        search_planner = SearchPlanner(initial_state_input, goal_task, compressed_capabilities, 5000,
-                                       send_task_node_update)
-        plan = search_planner.plan()
+        checkpoint_path = os.path.join(CHECKPOINT_DIR, f"search-planner-{timestamp}.jsonl")
+        planner = SearchPlanner(initial_state_input, goal_task, compressed_capabilities, 5000,
+                                send_task_node_update, checkpoint_path=checkpoint_path,
+                                search_algorithm=search_algorithm)
+    else:
+        checkpoint_path = os.path.join(CHECKPOINT_DIR, f"htn-planner-{timestamp}.jsonl")
+        planner = HTNPlanner(initial_state_input, goal_task, compressed_capabilities, 5, send_task_node_update,
+                             checkpoint_path=checkpoint_path, send_subtask_callback=send_streamed_subtask)
+    print(f"Saving progress to {checkpoint_path}")
+    return planner
+
+def resume_planner(checkpoint_path, search_algorithm=SEARCH_ASTAR):
+    kind = read_checkpoint_kind(checkpoint_path)
+    if kind == SEARCH_PLANNER_CHECKPOINT:
+        return SearchPlanner.resume(checkpoint_path, send_task_node_update, search_algorithm=search_algorithm)
+    if kind == HTN_PLANNER_CHECKPOINT:
+        return HTNPlanner.resume(checkpoint_path, send_task_node_update,
+                                 send_subtask_callback=send_streamed_subtask)
+    raise ValueError(f"{checkpoint_path} can't be resumed by this program, it's a {kind} checkpoint.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a plan with the HTN or A* search planner")
+    parser.add_argument("--resume", help="Continue the plan saved in this checkpoint file")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a service that plans the jobs submitted to it, see planning_service.py")
+    parser.add_argument("--host", default="127.0.0.1", help="Address the service listens on")
+    parser.add_argument("--port", type=int, default=5000, help="Port the service listens on")
+    parser.add_argument("--allow-werkzeug", action="store_true",
+                        help="Let the service run on the werkzeug development server when neither eventlet nor "
+                             "gevent is installed")
+    parser.add_argument("--search-algorithm", choices=SEARCH_ALGORITHMS, default=SEARCH_ASTAR,
+                        help="Search run over the graph built by the search planner, only astar uses the LLM")
+    args = parser.parse_args()
+
+    if args.serve:
+        telemetry.serve_from_env()
+        planning_service = PlanningService(socketio)
+        planning_service.register(app)
+        print(f"Planning service listening on {args.host}:{args.port}, running {planning_service.max_jobs} jobs at once")
+        run_server(args.host, args.port, debug=False, allow_werkzeug=args.allow_werkzeug)
+        return
+
+    # Clear the log file at the beginning of each run
+    with open('function_trace.log', 'w') as log_file:
+        log_file.write("")
+
+    # Serves the LLM metrics for Prometheus when LLM_TELEMETRY_PORT is set
+    telemetry.serve_from_env()
+
+    if args.resume:
+        planner = resume_planner(args.resume, args.search_algorithm)
     else:
-        htn_planner = HTNPlanner(initial_state_input, goal_task, compressed_capabilities, 5, send_task_node_update)
-        plan = htn_planner.htn_planning()
+        planner = create_planner(args.search_algorithm)
+
+    server_thread = threading.Thread(target=run_server)
+    server_thread.start()
+
+    if isinstance(planner, SearchPlanner):
+        plan = planner.plan()
+    else:
+        plan = planner.htn_planning()
 
     if plan:
         print("Plan found:")
@@ -93,6 +155,10 @@ def main():
     else:
         print("No plan found.")
 
+    telemetry.print_summary()
+    print_program_stats()
+    print(f"Response cache: {response_cache.stats()}")
+
 if __name__ == '__main__':
     # Run the main function
-    main()
\ No newline at end of file
+    main()
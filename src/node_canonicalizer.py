@@ -0,0 +1,209 @@
+import re
+import threading
+from collections import Counter
+
+import Levenshtein
+
+# Minimum Levenshtein ratio between the words of two normalized texts for them to be merged into one node, with
+# one extra qualifying word, e.g. "new" in "Create a new directory called project", texts of three words merge
+DEFAULT_MERGE_THRESHOLD = 0.85
+# Tokens of a text whose postings are used to find its merge candidates, the rarest ones are the most selective
+BLOCKING_TOKENS = 3
+# Candidates compared with the Levenshtein ratio per lookup, the ones sharing the most tokens are kept
+MAX_CANDIDATES = 200
+
+# Words that don't change what a task does, dropped before texts are compared. Direction words are kept since
+# "Copy config from server A to server B" and "...from server B to server A" are different tasks
+STOPWORDS = frozenset([
+    "a", "an", "the", "of", "on", "in", "for", "by", "your", "my", "it", "its", "this", "that",
+])
+# Introduce the tool a task is done with. A tool clause runs up to the next clause word and is compared on its own,
+# "install Git using apt" is the same task as "Install git" but "via SSH" and "via VNC" are different tasks
+TOOL_WORDS = frozenset(["using", "via", "with"])
+# Words that join another step to a task, nothing can be added after them
+SEQUENCE_WORDS = frozenset(["and", "then", "after", "before", "while"])
+CLAUSE_WORDS = frozenset(["to", "from", "into", "onto", "on", "in", "for"]) | SEQUENCE_WORDS
+# Words that can't be the only difference between two merged texts
+PROTECTED_WORDS = frozenset(["to", "from", "into", "onto", "out", "not", "no", "never", "without"])
+# Actions a task can add next to its own, "Back up the database" is a different task with "...and delete it"
+ACTION_WORDS = frozenset([
+    "install", "uninstall", "remove", "delete", "create", "make", "start", "stop", "restart", "run", "execute",
+    "open", "close", "copy", "move", "rename", "mount", "unmount", "back", "restore", "configure", "enable", "disable",
+    "connect", "disconnect", "download", "upload", "update", "upgrade", "build", "deploy", "kill", "write", "read",
+    "edit", "check", "test", "set", "add", "reset", "clean", "push", "pull", "commit", "clone", "send", "save",
+    "load", "import", "export", "compile", "verify", "replace", "change", "apply", "merge", "drop", "archive",
+])
+# Separates the tool clause in a normalized text, it's a tool word so it can't appear in the rest of the text
+TOOL_SEPARATOR = " using "
+
+
+def stem(word):
+    # Plural nouns compare equal to their singular
+    if not word.isalpha() or len(word) <= 3 or word.endswith("ss"):
+        return word
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def split_words(text):
+    # (words of the task, words of its tool clauses), lower cased without punctuation or stopwords
+    words = []
+    tool_words = []
+    in_tool_clause = False
+    for word in re.findall(r"\w+", text.lower()):
+        if word in TOOL_WORDS:
+            in_tool_clause = True
+            continue
+        if word in CLAUSE_WORDS:
+            in_tool_clause = False
+        if word not in STOPWORDS:
+            (tool_words if in_tool_clause else words).append(stem(word))
+    return words, tool_words
+
+
+def normalize(text):
+    # Formatting differences compare equal, the tool clause is kept after TOOL_SEPARATOR
+    words, tool_words = split_words(text)
+    normalized = " ".join(words)
+    return normalized + TOOL_SEPARATOR + " ".join(tool_words) if tool_words else normalized
+
+
+def split_normalized(normalized):
+    words, _, tool = normalized.partition(TOOL_SEPARATOR)
+    return words.split(), tool
+
+
+def can_merge(tokens, other_tokens):
+    """
+    Two texts only merge when their words differ by inserted qualifying words. A replaced word, even by a single
+    character as in "alice" and "alex", "80" and "8080" or "mount" and "unmount", makes a different task, and so
+    does a different first word, which is the action, an added action, a different number, a direction or negation
+    word, a word that moved or anything added after a sequence word like "then".
+    """
+    for operation, source, target in Levenshtein.editops(tokens, other_tokens):
+        if operation == "replace":
+            return False
+        if operation == "delete":
+            index, token, text, other = source, tokens[source], tokens, other_tokens
+        else:
+            index, token, text, other = target, other_tokens[target], other_tokens, tokens
+        if index == 0 or token in PROTECTED_WORDS or token in SEQUENCE_WORDS or token in ACTION_WORDS \
+                or token in other or any(char.isdigit() for char in token):
+            return False
+        if any(word in SEQUENCE_WORDS for word in text[:index]):
+            return False
+    return True
+
+
+class NodeCanonicalizer:
+    """
+    Maps generated tasks and states to the first text seen for them, so that paraphrases share one graph node.
+    Texts that normalize to the same string are merged directly, near-duplicates are found by the Levenshtein ratio
+    of their words and must pass can_merge. Tool clauses must be equal, or missing from one of the texts as long
+    as every text merged into the same node named the same tool. Candidates are looked up in a token blocking index
+    instead of comparing a text with every node.
+    """
+
+    def __init__(self, similarity_threshold=DEFAULT_MERGE_THRESHOLD):
+        self.similarity_threshold = similarity_threshold
+        # normalized text -> canonical text
+        self.canonical_texts = {}
+        # normalized text without a tool clause -> tool clause of the texts merged into it
+        self.merged_tools = {}
+        # token -> normalized texts containing it
+        self.postings = {}
+        self.merges = 0
+        self._lock = threading.Lock()
+
+    def candidates(self, normalized):
+        # Must be called while holding the lock
+        tokens = set(normalized.split()) - TOOL_WORDS
+        indexed_tokens = sorted((token for token in tokens if token in self.postings),
+                                key=lambda token: len(self.postings[token]))
+        shared_tokens = Counter()
+        for token in indexed_tokens[:BLOCKING_TOKENS]:
+            shared_tokens.update(self.postings[token])
+        return [candidate for candidate, _ in shared_tokens.most_common(MAX_CANDIDATES)]
+
+    def _tools_match(self, tool, candidate, candidate_tool):
+        # Must be called while holding the lock
+        if tool == candidate_tool or not tool:
+            return True
+        return not candidate_tool and self.merged_tools.get(candidate, tool) == tool
+
+    def _find(self, normalized):
+        # The normalized form of the canonical duplicate of normalized, None when there's none. Must be called while
+        # holding the lock
+        if normalized in self.canonical_texts:
+            return normalized
+        tokens, tool = split_normalized(normalized)
+        best_ratio = self.similarity_threshold
+        best_candidate = None
+        for candidate in self.candidates(normalized):
+            candidate_tokens, candidate_tool = split_normalized(candidate)
+            # The ratio can't reach the threshold when the lengths are too different
+            shorter, longer = sorted((len(candidate_tokens), len(tokens)))
+            if 2 * shorter / (shorter + longer) < best_ratio:
+                continue
+            if not self._tools_match(tool, candidate, candidate_tool):
+                continue
+            ratio = Levenshtein.ratio(tokens, candidate_tokens)
+            if ratio >= best_ratio and can_merge(tokens, candidate_tokens):
+                best_ratio = ratio
+                best_candidate = candidate
+        return best_candidate
+
+    def _add(self, normalized, text):
+        # Must be called while holding the lock
+        self.canonical_texts[normalized] = text
+        for token in set(normalized.split()) - TOOL_WORDS:
+            self.postings.setdefault(token, set()).add(normalized)
+
+    def find(self, text):
+        # Canonical text of a duplicate of text, None when there's none
+        with self._lock:
+            canonical = self._find(normalize(text))
+            return self.canonical_texts[canonical] if canonical is not None else None
+
+    def add(self, text):
+        # Registers text as canonical unless a text with the same normalized form already is, returns the canonical
+        normalized = normalize(text)
+        with self._lock:
+            if normalized not in self.canonical_texts:
+                self._add(normalized, text)
+            return self.canonical_texts[normalized]
+
+    def canonicalize(self, text):
+        # The canonical text of a duplicate of text, or text itself which becomes canonical
+        normalized = normalize(text)
+        with self._lock:
+            canonical = self._find(normalized)
+            if canonical is None:
+                self._add(normalized, text)
+                return text
+            _, tool = split_normalized(normalized)
+            _, canonical_tool = split_normalized(canonical)
+            if tool and not canonical_tool:
+                # Texts naming another tool aren't merged into this node anymore
+                self.merged_tools[canonical] = tool
+            canonical_text = self.canonical_texts[canonical]
+            if canonical_text != text:
+                self.merges += 1
+            return canonical_text
+
+    def merge_duplicates(self, graph_manager, protected=()):
+        """
+        Merges the near-duplicate nodes already in the graph, e.g. a graph restored from a checkpoint, by
+        redirecting their edges to the canonical node with update_node. Protected nodes are never merged away.
+        """
+        for node in protected:
+            self.add(node)
+        for node in graph_manager.get_nodes():
+            if node in protected:
+                continue
+            canonical = self.canonicalize(node)
+            if canonical != node and graph_manager.has_node(canonical):
+                graph_manager.update_node(node, canonical)
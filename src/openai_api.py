@@ -1,60 +1,138 @@
 import datetime
+import json
 import os
+import threading
 import time
 
 import openai
-from ratelimiter import RateLimiter
-import guidance
+
+from llm_backend import count_tokens, make_chat_response
+from llm_cache import ResponseCache
+from llm_client import AsyncLLMClient
+from telemetry import telemetry
 
 openai.api_key = os.environ.get('OPENAI_KEY')
 
-# Configure the rate limiter to allow a maximum of 10 calls per minute
-rate_limiter = RateLimiter(max_calls=10, period=60)
-
-
-def call_openai_api(prompt, max_tokens=None, temperature=1.0, strip=False):
-    retries = 3
-    delay = 5
-
-    while retries > 0:
-        try:
-            # Use the rate limiter to ensure the API is not called too frequently
-            with rate_limiter:
-                response = openai.ChatCompletion.create(
-                    model="gpt-4",
-                    messages=[{"role": "system", "content": prompt}],
-                    max_tokens=max_tokens,
-                    n=1,
-                    stop=None,
-                    temperature=temperature,
-                )
-            return response.choices[0].message.content.strip() if strip else response
-        except openai.error.RateLimitError as e:
-            print(f"RateLimitError encountered: {e}. Retrying in {delay} seconds...")
-            retries -= 1
-            time.sleep(delay)
-        except openai.error.APIError as e:
-            print(f"APIError encountered: {e}. Retrying in {delay} seconds...")
-            retries -= 1
-            time.sleep(delay)
-
-    raise Exception("Failed to get a response from the GPT-4 API after multiple retries.")
+MODEL_NAME = "gpt-4"
+
+# Shared client, limits requests and tokens per minute across every thread using the api
+llm_client = AsyncLLMClient.from_env(MODEL_NAME)
+
+# Persistent cache of responses, identical prompts are served from disk instead of the API
+response_cache = ResponseCache.from_env()
+
+
+def set_llm_client(client):
+    # Replaces the shared client, e.g. with one without rate limits in front of the mock backend, returns the
+    # client it replaced
+    global llm_client
+    previous_client, llm_client = llm_client, client
+    return previous_client
+
+
+def _get_cached_response(prompt, max_tokens, temperature, use_cache):
+    # When use_cache is False the cache is bypassed for the lookup but the fresh response is still stored
+    cached_response = response_cache.get(MODEL_NAME, prompt, temperature, max_tokens) if use_cache else None
+    if cached_response is None:
+        return None
+    return openai.util.convert_to_openai_object(json.loads(cached_response))
+
+
+def _format_response(response, strip):
+    return response.choices[0].message.content.strip() if strip else response
+
+
+def _record_usage(span, response):
+    usage = response.get("usage") or {}
+    span["prompt_tokens"] = usage.get("prompt_tokens", 0)
+    span["completion_tokens"] = usage.get("completion_tokens", 0)
+
+
+async def acall_openai_api(prompt, max_tokens=None, temperature=1.0, strip=False, use_cache=True):
+    span = telemetry.start_span("chat", MODEL_NAME)
+    try:
+        response = _get_cached_response(prompt, max_tokens, temperature, use_cache)
+        if response is not None:
+            span["cache_hit"] = True
+        else:
+            response = await llm_client.acomplete(prompt, max_tokens=max_tokens, temperature=temperature, span=span)
+            response_cache.put(MODEL_NAME, prompt, temperature, max_tokens, json.dumps(response))
+            _record_usage(span, response)
+        return _format_response(response, strip)
+    except Exception as e:
+        span["error"] = type(e).__name__
+        raise
+    finally:
+        telemetry.end_span(span)
+
+
+def call_openai_api(prompt, max_tokens=None, temperature=1.0, strip=False, use_cache=True):
+    span = telemetry.start_span("chat", MODEL_NAME)
+    try:
+        response = _get_cached_response(prompt, max_tokens, temperature, use_cache)
+        if response is not None:
+            span["cache_hit"] = True
+        else:
+            response = llm_client.complete(prompt, max_tokens=max_tokens, temperature=temperature, span=span)
+            response_cache.put(MODEL_NAME, prompt, temperature, max_tokens, json.dumps(response))
+            _record_usage(span, response)
+        return _format_response(response, strip)
+    except Exception as e:
+        span["error"] = type(e).__name__
+        raise
+    finally:
+        telemetry.end_span(span)
+
+
+def stream_openai_api(prompt, max_tokens=None, temperature=1.0, use_cache=True):
+    """
+    Yields the text of the response as it's generated. Streamed responses share the cache of call_openai_api, a
+    cached response is replayed as a single piece and a completed stream is stored as a regular response.
+    """
+    span = telemetry.start_span("chat_stream", MODEL_NAME)
+    completion = []
+    try:
+        response = _get_cached_response(prompt, max_tokens, temperature, use_cache)
+        if response is not None:
+            span["cache_hit"] = True
+            completion.append(response.choices[0].message.content)
+            yield completion[0]
+            return
+
+        for text in llm_client.stream(prompt, max_tokens=max_tokens, temperature=temperature, span=span):
+            if not completion:
+                span["first_token_seconds"] = time.perf_counter() - span["start"]
+            completion.append(text)
+            yield text
+        # Only complete responses are stored, not the ones whose stream failed or was closed early
+        text = "".join(completion)
+        response_cache.put(MODEL_NAME, prompt, temperature, max_tokens,
+                           json.dumps(make_chat_response(MODEL_NAME, text, count_tokens(prompt), count_tokens(text))))
+    except Exception as e:
+        span["error"] = type(e).__name__
+        raise
+    finally:
+        # Streamed responses carry no usage, the tokens are estimated from the text
+        span["prompt_tokens"] = count_tokens(prompt)
+        span["completion_tokens"] = count_tokens("".join(completion)) if completion else 0
+        telemetry.end_span(span)
 
 
 updated_log_files = {}
+# Responses are logged from concurrent workers, the lock keeps the run start marker and each entry in one piece
+log_lock = threading.Lock()
 
 
 def log_response(function_name, response):
     global updated_log_files
 
     log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    os.makedirs(log_dir, exist_ok=True)
 
     log_file_path = f"{log_dir}/{function_name}.log"
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    with open(log_file_path, "a") as log_file:
+    with log_lock, open(log_file_path, "a") as log_file:
         if function_name not in updated_log_files:
             log_file.write("\n--- Application run start ---\n")
             updated_log_files[function_name] = True
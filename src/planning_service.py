@@ -0,0 +1,240 @@
+"""
+Service mode of the planner: plans are submitted as jobs over REST and run concurrently on a bounded pool.
+
+    POST /jobs              Submit a job, {"initial_state", "goal", "capabilities", "planner": "htn" | "search",
+                            "max_depth", "max_iterations", "search_algorithm"}, returns the job with its id
+    GET  /jobs              Every job
+    GET  /jobs/<job_id>     One job, with its plan once it's finished
+    DELETE /jobs/<job_id>   Cancel a job that hasn't started yet
+
+Socket.IO clients emit 'join_job' {"job_id"} to receive the job's 'job_status', 'task_tree_snapshot',
+'task_tree_patch' and 'subtask_streamed' events, they're sent to the job's room only.
+
+    PLANNING_MAX_JOBS - Number of jobs planned at once (default 4)
+    PLANNING_MAX_QUEUED - Number of jobs that can wait for a worker before new jobs are refused (default 100)
+    PLANNING_JOB_RETENTION - Seconds a finished job and its plan are kept before they're evicted (default 3600)
+    PLANNING_MAX_FINISHED - Number of finished jobs kept, the oldest are evicted first (default 1000)
+
+Every job shares the process wide LLM budget, requests from concurrent jobs take turns for it.
+"""
+import os
+import threading
+import time
+import uuid
+
+from flask import jsonify, request
+from flask_socketio import emit, join_room, leave_room
+
+from concurrency import ContextThreadPoolExecutor
+from gpt4_utils import get_initial_task, compress_capabilities
+from htn_planner import HTNPlanner
+from search_planner import SearchPlanner, SEARCH_ASTAR, SEARCH_ALGORITHMS
+from telemetry import telemetry, llm_plan
+from tree_updates import TaskTreePublisher
+
+DEFAULT_MAX_JOBS = 4
+DEFAULT_MAX_QUEUED = 100
+DEFAULT_JOB_RETENTION = 3600
+DEFAULT_MAX_FINISHED = 1000
+DEFAULT_CAPABILITIES = "Linux terminal, internet access"
+DEFAULT_MAX_DEPTH = 5
+DEFAULT_MAX_ITERATIONS = 5000
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+PLANNERS = ("htn", "search")
+
+
+class PlanningJob:
+    def __init__(self, job_id, planner, initial_state, goal, capabilities, max_depth, max_iterations,
+                 search_algorithm=SEARCH_ASTAR):
+        self.job_id = job_id
+        self.planner = planner
+        self.initial_state = initial_state
+        self.goal = goal
+        self.capabilities = capabilities
+        self.max_depth = max_depth
+        self.max_iterations = max_iterations
+        self.search_algorithm = search_algorithm
+        self.status = JOB_QUEUED
+        self.plan = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.publisher = None
+
+    def to_dict(self, include_plan=False):
+        job = {
+            "job_id": self.job_id,
+            "planner": self.planner,
+            "goal": self.goal,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if include_plan:
+            job["plan"] = self.plan.to_dict() if self.plan is not None else None
+            # LLM calls, tokens and cost of the job
+            job["usage"] = telemetry.plan_summary(self.job_id)
+        return job
+
+
+class PlanningService:
+    def __init__(self, socketio, max_jobs=None, max_queued=None, job_retention=None, max_finished=None):
+        self.socketio = socketio
+        self.max_jobs = max_jobs if max_jobs is not None else \
+            int(os.environ.get("PLANNING_MAX_JOBS", DEFAULT_MAX_JOBS))
+        self.max_queued = max_queued if max_queued is not None else \
+            int(os.environ.get("PLANNING_MAX_QUEUED", DEFAULT_MAX_QUEUED))
+        self.job_retention = job_retention if job_retention is not None else \
+            float(os.environ.get("PLANNING_JOB_RETENTION", DEFAULT_JOB_RETENTION))
+        self.max_finished = max_finished if max_finished is not None else \
+            int(os.environ.get("PLANNING_MAX_FINISHED", DEFAULT_MAX_FINISHED))
+        self.executor = ContextThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix="planning-job")
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def emit_to_job(self, job_id, event, data):
+        self.socketio.emit(event, dict(data, job_id=job_id), to=job_id)
+
+    def submit(self, planner, initial_state, goal, capabilities=DEFAULT_CAPABILITIES, max_depth=DEFAULT_MAX_DEPTH,
+               max_iterations=DEFAULT_MAX_ITERATIONS, search_algorithm=SEARCH_ASTAR):
+        if planner not in PLANNERS:
+            raise ValueError(f"Unknown planner '{planner}', expected one of {', '.join(PLANNERS)}.")
+        if search_algorithm not in SEARCH_ALGORITHMS:
+            raise ValueError(f"Unknown search algorithm '{search_algorithm}', expected one of "
+                             f"{', '.join(SEARCH_ALGORITHMS)}.")
+        if not goal:
+            raise ValueError("A goal is required.")
+
+        with self._lock:
+            self._evict_finished_locked()
+            queued = sum(1 for job in self.jobs.values() if job.status == JOB_QUEUED)
+            if queued >= self.max_queued:
+                return None
+            job = PlanningJob(str(uuid.uuid4()), planner, initial_state, goal, capabilities, max_depth,
+                              max_iterations, search_algorithm)
+            job.publisher = TaskTreePublisher(lambda event, data: self.emit_to_job(job.job_id, event, data))
+            self.jobs[job.job_id] = job
+            job.future = self.executor.submit(self.run_job, job)
+        return job
+
+    def _evict_finished_locked(self):
+        # Finished jobs hold their plan tree and publisher, they're dropped with their LLM usage once they expire
+        finished = sorted((job for job in self.jobs.values() if job.status in FINISHED_STATUSES),
+                          key=lambda job: job.finished_at)
+        expired_at = time.time() - self.job_retention
+        evicted = [job for job in finished if job.finished_at < expired_at]
+        evicted.extend(finished[len(evicted):max(len(evicted), len(finished) - self.max_finished)])
+        for job in evicted:
+            del self.jobs[job.job_id]
+            telemetry.discard_plan(job.job_id)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status != JOB_QUEUED or not job.future.cancel():
+                return False
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+        self.emit_to_job(job_id, 'job_status', {"status": job.status})
+        return True
+
+    def set_status(self, job, status, error=None):
+        with self._lock:
+            job.status = status
+            job.error = error
+            if status == JOB_RUNNING:
+                job.started_at = time.time()
+            else:
+                job.finished_at = time.time()
+        self.emit_to_job(job.job_id, 'job_status', {"status": status, "error": error})
+
+    def run_job(self, job):
+        self.set_status(job, JOB_RUNNING)
+        try:
+            # The job id is used as the plan id, so the job's LLM usage and fair share are tracked under it
+            with llm_plan(job.job_id):
+                goal_task = get_initial_task(job.goal)
+                capabilities = compress_capabilities(job.capabilities)
+                if job.planner == "search":
+                    planner = SearchPlanner(job.initial_state, goal_task, capabilities, job.max_iterations,
+                                            job.publisher.publish, search_algorithm=job.search_algorithm)
+                    planner.plan_id = job.job_id
+                    job.plan = planner.plan()
+                else:
+                    planner = HTNPlanner(job.initial_state, goal_task, capabilities, job.max_depth,
+                                         job.publisher.publish, send_subtask_callback=job.publisher.publish_subtask)
+                    planner.plan_id = job.job_id
+                    job.plan = planner.htn_planning()
+            self.set_status(job, JOB_SUCCEEDED)
+        except Exception as e:
+            print(f"Planning job {job.job_id} failed: {e}")
+            self.set_status(job, JOB_FAILED, str(e))
+
+    def register(self, app):
+        @app.route('/jobs', methods=['POST'])
+        def submit_job():
+            body = request.get_json(silent=True) or {}
+            try:
+                job = self.submit(
+                    body.get("planner", "htn"),
+                    body.get("initial_state", ""),
+                    body.get("goal", ""),
+                    body.get("capabilities") or DEFAULT_CAPABILITIES,
+                    int(body.get("max_depth", DEFAULT_MAX_DEPTH)),
+                    int(body.get("max_iterations", DEFAULT_MAX_ITERATIONS)),
+                    body.get("search_algorithm", SEARCH_ASTAR),
+                )
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if job is None:
+                return jsonify({"error": "Too many queued jobs, try again later."}), 503
+            return jsonify(job.to_dict()), 202
+
+        @app.route('/jobs', methods=['GET'])
+        def list_jobs():
+            with self._lock:
+                self._evict_finished_locked()
+                jobs = [job.to_dict() for job in self.jobs.values()]
+            return jsonify(jobs)
+
+        @app.route('/jobs/<job_id>', methods=['GET'])
+        def get_job(job_id):
+            job = self.jobs.get(job_id)
+            if job is None:
+                return jsonify({"error": "Job not found."}), 404
+            return jsonify(job.to_dict(include_plan=job.status == JOB_SUCCEEDED))
+
+        @app.route('/jobs/<job_id>', methods=['DELETE'])
+        def cancel_job(job_id):
+            if job_id not in self.jobs:
+                return jsonify({"error": "Job not found."}), 404
+            if not self.cancel(job_id):
+                return jsonify({"error": "Only queued jobs can be cancelled."}), 409
+            return jsonify(self.jobs[job_id].to_dict())
+
+        @self.socketio.on('join_job')
+        def handle_join_job(data):
+            job = self.jobs.get((data or {}).get("job_id"))
+            if job is None:
+                emit('job_error', {"error": "Job not found."})
+                return
+            join_room(job.job_id)
+            emit('job_status', {"job_id": job.job_id, "status": job.status, "error": job.error})
+            emit('task_tree_snapshot', dict(job.publisher.snapshot(), job_id=job.job_id))
+
+        @self.socketio.on('leave_job')
+        def handle_leave_job(data):
+            job_id = (data or {}).get("job_id")
+            if job_id in self.jobs:
+                leave_room(job_id)
@@ -1,9 +1,12 @@
 import random
 import numpy as np
-import time
+from checkpoint import Checkpointer, read_checkpoint
+from concurrency import get_llm_executor
 from openai_api import call_openai_api, log_response
+from telemetry import llm_stage, llm_plan
 import math
 import sys
+import uuid
 
 # Constants
 EPSILON = sys.float_info.epsilon
@@ -17,28 +20,31 @@ MUTATION_RATE = 0.1
 CROSSOVER_RATE = 0.5
 NEIGHBORHOOD_SIZE = 3
 ADAPTATION_THRESHOLD = 0.1
-PROGRESS_DELAY = 0.5  # Added to introduce a small delay between generations
+CHECKPOINT_KIND = "prompt_evolver"
 
-def generate_initial_prompts(user_goal, prompt_size):
+@llm_stage("initial_prompt")
+def generate_initial_prompt(user_goal, i):
+    prompt = call_openai_api(
+        f"Generate a diverse prompt related to solving the following problem: '{user_goal}'. "
+        f"Consider the problem domain, any constraints or limitations, and the desired format of the solution.",
+        max_tokens=500,
+        temperature=1.0,
+        strip=True
+    )
+    print(f"Generated prompt {i}")
+    return prompt
+
+def generate_initial_prompts(user_goal, prompt_size, executor=None):
     print("Generating initial prompts...")
-    initial_prompts = []
-
-    for i in range(prompt_size):
-        prompt = call_openai_api(
-            f"Generate a diverse prompt related to solving the following problem: '{user_goal}'. "
-            f"Consider the problem domain, any constraints or limitations, and the desired format of the solution.",
-            max_tokens=500,
-            temperature=1.0,
-            strip=True
-        )
-        initial_prompts.append(prompt)
-        print(f"Generated prompt {i}")
+    executor = executor if executor is not None else get_llm_executor()
+    initial_prompts = list(executor.map(lambda i: generate_initial_prompt(user_goal, i), range(prompt_size)))
 
     return initial_prompts
 
 def create_toroidal_grid(population, grid_size):
     second_dimension = PROMPT_SIZE // grid_size
-    grid = np.array(population).reshape(grid_size, second_dimension)
+    # Object dtype so that longer prompts from later generations aren't truncated to the initial string width
+    grid = np.array(population, dtype=object).reshape(grid_size, second_dimension)
     return grid
 
 def get_neighborhood(grid, x, y, neighborhood_size):
@@ -51,6 +57,7 @@ def get_neighborhood(grid, x, y, neighborhood_size):
             neighbors.append(grid[nx, ny])
     return neighbors
 
+@llm_stage("mutate_prompt")
 def mutate_prompt(prompt):
     mutated_prompt = call_openai_api(
         f"Modify the following prompt to make it more effective: '{prompt}'",
@@ -61,6 +68,7 @@ def mutate_prompt(prompt):
 
     return mutated_prompt.strip()
 
+@llm_stage("crossover")
 def llm_crossover(parent_1, parent_2):
     child_prompt = call_openai_api(
         f"Create a new prompt by combining the best features of the following two prompts: '{parent_1}' and '{parent_2}'",
@@ -71,6 +79,7 @@ def llm_crossover(parent_1, parent_2):
 
     return child_prompt.strip()
 
+@llm_stage("generate_result")
 def generate_result(prompt):
     result = call_openai_api(
         prompt,
@@ -81,33 +90,76 @@ def generate_result(prompt):
 
     return result
 
-def fitness_score(prompt, neighbors, memoized_scores, user_goal):
-    print("Calculating fitness scores...")
+@llm_stage("fitness_score")
+def score_prompt(prompt, user_goal):
+    result = generate_result(prompt)
+    score_str = call_openai_api(
+        f"Rate the quality of the solution '{result}' for the problem '{user_goal}'. "
+        f"Rate it on a scale from 0 to 1, where 0 represents a poor solution and 1 represents an excellent solution:",
+        max_tokens=10,
+        temperature=0.5,
+        strip=True
+    )
+
+    try:
+        score = float(score_str)
+    except ValueError:
+        print(f"Error: Unable to convert '{score_str}' to float for prompt: {prompt}")
+        score = 0
+
+    return score
 
+def fitness_score(prompt, neighbors, memoized_scores, user_goal):
     if prompt in memoized_scores:
         score = memoized_scores[prompt]
     else:
-        result = generate_result(prompt)
-        score_str = call_openai_api(
-            f"Rate the quality of the solution '{result}' for the problem '{user_goal}'. "
-            f"Rate it on a scale from 0 to 1, where 0 represents a poor solution and 1 represents an excellent solution:",
-            max_tokens=10,
-            temperature=0.5,
-            strip=True
-        )
-
-        try:
-            score = float(score_str)
-        except ValueError:
-            print(f"Error: Unable to convert '{score_str}' to float for prompt: {prompt}")
-            score = 0
-
+        score = score_prompt(prompt, user_goal)
         memoized_scores[prompt] = score
 
     neighbor_scores = [memoized_scores.get(neighbor, 0) for neighbor in neighbors]
 
     return float(score), sum(neighbor_scores) / len(neighbor_scores)
 
+def evaluate_generation(grid, neighborhood_size, memoized_scores, user_goal, executor):
+    print("Calculating fitness scores...")
+
+    # Every prompt that hasn't been scored yet is scored once, even if it appears in several cells
+    pending_scores = {}
+    for prompt in grid.flat:
+        if prompt not in memoized_scores and prompt not in pending_scores:
+            pending_scores[prompt] = executor.submit(score_prompt, prompt, user_goal)
+
+    for prompt, future in pending_scores.items():
+        memoized_scores[prompt] = future.result()
+
+    fitness_scores = np.zeros(grid.shape)
+    neighbor_scores = np.zeros(grid.shape)
+    for x in range(grid.shape[0]):
+        for y in range(grid.shape[1]):
+            neighbors = get_neighborhood(grid, x, y, neighborhood_size)
+            fitness_scores[x, y], neighbor_scores[x, y] = fitness_score(grid[x, y], neighbors, memoized_scores, user_goal)
+
+    return fitness_scores, neighbor_scores
+
+def breed_generation(grid, neighborhood_size, memoized_scores, executor):
+    # Parents are chosen from the current generation on this thread, only the LLM calls run concurrently
+    children = {}
+    for x in range(grid.shape[0]):
+        for y in range(grid.shape[1]):
+            neighbors = get_neighborhood(grid, x, y, neighborhood_size)
+            parent_1 = grid[x, y]
+            parent_2 = roulette_wheel_selection(neighbors, memoized_scores)
+
+            if random.random() < CROSSOVER_RATE:
+                children[x, y] = executor.submit(llm_crossover, parent_1, parent_2)
+            else:
+                children[x, y] = executor.submit(mutate_prompt, parent_1 if random.random() < 0.5 else parent_2)
+
+    next_grid = grid.copy()
+    for (x, y), future in children.items():
+        next_grid[x, y] = future.result()
+    return next_grid
+
 def calculate_fitness_stats(fitness_scores):
     average_fitness = np.mean(fitness_scores)
     std_dev_fitness = np.std(fitness_scores)
@@ -135,68 +187,116 @@ def adapt_neighborhood_size(neighborhood_size, std_dev_fitness):
 
     return new_neighborhood_size
 
-def main(user_goal):
-    initial_prompts = generate_initial_prompts(user_goal, PROMPT_SIZE)
-    grid = create_toroidal_grid(initial_prompts, GRID_SIZE)
-    generation = 0
-    memoized_scores = {}
-
-    neighborhood_size = NEIGHBORHOOD_SIZE
-    fitness_scores = np.full(grid.shape, EPSILON) + np.random.uniform(-0.01, 0.01, grid.shape)
-
-    while True:
-        generation += 1
-        print(f"Generation: {generation}\n")
-
-        # Calculate fitness statistics
-        z_scores, average_fitness, std_dev_fitness = calculate_fitness_stats(fitness_scores)
-        print(f"Average fitness: {average_fitness}\nStandard deviation of fitness: {std_dev_fitness}\n")
-
-        # Adapt neighborhood size based on fitness statistics
-        neighborhood_size = adapt_neighborhood_size(neighborhood_size, std_dev_fitness)
-        print(f"Adapted neighborhood size: {neighborhood_size}\n")
-
-        neighbor_scores = np.zeros(grid.shape)
-
-        for x in range(grid.shape[0]):
-            for y in range(grid.shape[1]):
-                neighbors = get_neighborhood(grid, x, y, neighborhood_size)
-                fitness_scores[x, y], neighbor_scores[x, y] = fitness_score(grid[x, y], neighbors, memoized_scores, user_goal)
-
-        max_fitness = np.max(z_scores)
-        print(f"Max fitness: {max_fitness}")
-
-        best_prompt = grid[np.unravel_index(np.argmax(z_scores), grid.shape)]
-        best_result = generate_result(
-            f"{best_prompt} Consider the problem domain, any constraints or limitations, and the desired format of the solution."
-            )
-        print(f"Current best prompt: {best_prompt}\nFitness: {max_fitness}\nBest result: {best_result}\n")
+def checkpoint_records(progress, memoized_scores):
+    # progress holds the generation reached and the grid, scores and neighborhood size to continue from
+    records = [{"type": "score", "prompt": prompt, "score": score} for prompt, score in list(memoized_scores.items())]
+    records.append({
+        "type": "generation",
+        "generation": progress["generation"],
+        "grid": progress["grid"].tolist(),
+        "fitness_scores": progress["fitness_scores"].tolist(),
+        "neighborhood_size": progress["neighborhood_size"],
+    })
+    return records
+
+def resume(checkpoint_path, max_generations=None):
+    # Continues the run saved in checkpoint_path, new generations are saved to the same file
+    meta, records = read_checkpoint(checkpoint_path, CHECKPOINT_KIND)
+    memoized_scores = {record["prompt"]: record["score"] for record in records if record["type"] == "score"}
+    progress = [record for record in records if record["type"] == "generation"][-1]
+    progress["grid"] = np.array(progress["grid"], dtype=object)
+    progress["fitness_scores"] = np.array(progress["fitness_scores"])
+    print(f"Resuming after generation {progress['generation']}")
+    return main(meta["user_goal"], max_generations, checkpoint_path, resume_from=(progress, memoized_scores))
+
+def main(user_goal, max_generations=None, checkpoint_path=None, resume_from=None):
+    # LLM calls made by this run are attributed to it in the telemetry
+    with llm_plan(f"prompt-evolver-{uuid.uuid4()}"):
+        executor = get_llm_executor()
+        # Each completed generation is saved to checkpoint_path so that an interrupted run can be resumed
+        checkpointer = Checkpointer(checkpoint_path, CHECKPOINT_KIND, {"user_goal": user_goal}) \
+            if checkpoint_path else None
+        if checkpointer is not None:
+            print(f"Saving progress to {checkpoint_path}")
+
+        if resume_from is not None:
+            progress, memoized_scores = resume_from
+        else:
+            initial_prompts = generate_initial_prompts(user_goal, PROMPT_SIZE, executor)
+            grid = create_toroidal_grid(initial_prompts, GRID_SIZE)
+            memoized_scores = {}
+            progress = {
+                "generation": 0,
+                "grid": grid,
+                "fitness_scores": np.full(grid.shape, EPSILON) + np.random.uniform(-0.01, 0.01, grid.shape),
+                "neighborhood_size": NEIGHBORHOOD_SIZE,
+            }
+            if checkpointer is not None:
+                checkpointer.save(lambda: checkpoint_records(progress, memoized_scores))
+
+        grid = progress["grid"]
+        generation = progress["generation"]
+        neighborhood_size = progress["neighborhood_size"]
+        fitness_scores = progress["fitness_scores"]
 
-        log_response("best_prompt", best_prompt)
-        log_response("best_result", best_result)
-
-        # Determine if the current "max_fitness" is "TARGET_Z_SCORE" std deviations above the mean
-        if max_fitness >= TARGET_Z_SCORE and generation > MIN_TARGET_GENERATION:
-            break
-
-        for x in range(grid.shape[0]):
-            for y in range(grid.shape[1]):
-                neighbors = get_neighborhood(grid, x, y, neighborhood_size)
-                parent_1 = grid[x, y]
-                parent_2 = roulette_wheel_selection(neighbors, memoized_scores)
-
-                if random.random() < CROSSOVER_RATE:
-                    child = llm_crossover(parent_1, parent_2)
-                else:
-                    child = mutate_prompt(parent_1) if random.random() < 0.5 else mutate_prompt(parent_2)
-
-                grid[x, y] = child
-
-        print(f"Progress: Generation {generation} completed. Moving to the next generation...\n")
-        time.sleep(PROGRESS_DELAY)  # Added to introduce a small delay between generations
-
-    print(f"Final best prompt: {best_prompt}\nFitness: {max_fitness}\nBest result: {best_result}")
+        try:
+            while True:
+                generation += 1
+                print(f"Generation: {generation}\n")
+
+                # Calculate fitness statistics
+                z_scores, average_fitness, std_dev_fitness = calculate_fitness_stats(fitness_scores)
+                print(f"Average fitness: {average_fitness}\nStandard deviation of fitness: {std_dev_fitness}\n")
+
+                # Adapt neighborhood size based on fitness statistics
+                neighborhood_size = adapt_neighborhood_size(neighborhood_size, std_dev_fitness)
+                print(f"Adapted neighborhood size: {neighborhood_size}\n")
+
+                fitness_scores, neighbor_scores = evaluate_generation(grid, neighborhood_size, memoized_scores, user_goal,
+                                                                      executor)
+
+                max_fitness = np.max(z_scores)
+                print(f"Max fitness: {max_fitness}")
+
+                best_prompt = grid[np.unravel_index(np.argmax(z_scores), grid.shape)]
+                best_result = generate_result(
+                    f"{best_prompt} Consider the problem domain, any constraints or limitations, and the desired format of the solution."
+                    )
+                print(f"Current best prompt: {best_prompt}\nFitness: {max_fitness}\nBest result: {best_result}\n")
+
+                log_response("best_prompt", best_prompt)
+                log_response("best_result", best_result)
+
+                # Determine if the current "max_fitness" is "TARGET_Z_SCORE" std deviations above the mean
+                if max_fitness >= TARGET_Z_SCORE and generation > MIN_TARGET_GENERATION:
+                    break
+                if max_generations is not None and generation >= max_generations:
+                    break
+
+                grid = breed_generation(grid, neighborhood_size, memoized_scores, executor)
+
+                progress = {
+                    "generation": generation,
+                    "grid": grid,
+                    "fitness_scores": fitness_scores,
+                    "neighborhood_size": neighborhood_size,
+                }
+                if checkpointer is not None:
+                    checkpointer.save(lambda: checkpoint_records(progress, memoized_scores))
+
+                print(f"Progress: Generation {generation} completed. Moving to the next generation...\n")
+        except Exception:
+            # Scores computed before the failure are kept along with the last completed generation
+            if checkpointer is not None:
+                checkpointer.save(lambda: checkpoint_records(progress, memoized_scores))
+            raise
+
+        print(f"Final best prompt: {best_prompt}\nFitness: {max_fitness}\nBest result: {best_result}")
+        return best_prompt
 
 if __name__ == "__main__":
-    user_goal = input("Enter your goal/problem: ")
-    main(user_goal)
\ No newline at end of file
+    if len(sys.argv) == 3 and sys.argv[1] == "--resume":
+        resume(sys.argv[2])
+    else:
+        user_goal = input("Enter your goal/problem: ")
+        main(user_goal, checkpoint_path=f"checkpoints/prompt-evolver-{uuid.uuid4()}.jsonl")
\ No newline at end of file
@@ -4,14 +4,22 @@ The plan method generates tasks randomly and adds them to the graph if they are
 The weight of the edge between two states is calculated based on the difference between the states and the complexity of the task. 
 The planner stops when the goal is reached or the maximum number of iterations is reached.
 """
-import heapq
-import random
-from gpt4_utils import gpt4_is_goal, can_execute, log_state_change
+import json
+import uuid
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from checkpoint import Checkpointer, read_checkpoint
+from concurrency import ContextThreadPoolExecutor
+from gpt4_utils import can_execute
+import openai_api
 from openai_api import call_openai_api, log_response
 from task_node import TaskNode
-from text_utils import extract_lists, trace_function_calls
-from graph_manager import GraphManager
-import numpy as np
+from telemetry import llm_stage, llm_plan
+from text_utils import trace_function_calls
+from graph_manager import GraphManager, SAMPLING_UNIFORM
+from graph_search import astar, dijkstra, bidirectional_dijkstra, yen_k_shortest_paths
+from heuristic_oracle import HeuristicOracle
+from node_canonicalizer import NodeCanonicalizer, DEFAULT_MERGE_THRESHOLD
 
 # Constants for weight/cost range
 WEIGHT_MIN_VALUE = 0.0
@@ -20,6 +28,26 @@ WEIGHT_MAX_VALUE = 100.0
 NUM_CRITERIA = 8
 MAX_SUGGESTED_VALUE = WEIGHT_MAX_VALUE / NUM_CRITERIA
 
+# Number of expansion rounds whose edges are scored together, each round adds two edges
+WEIGHT_BATCH_ROUNDS = 8
+# Completion tokens allowed per weight in a batched scoring reply
+WEIGHT_TOKENS_PER_EDGE = 8
+# Retries show the rejected reply and sample instead of decoding greedily, so they don't repeat the same reply
+WEIGHT_RETRY_TEMPERATURE = 0.5
+# Characters of the rejected reply quoted in a retry
+WEIGHT_RETRY_QUOTED_CHARACTERS = 200
+
+CHECKPOINT_KIND = "search_planner"
+
+# Searches run over the constructed graph, only astar asks the LLM for heuristic estimates
+SEARCH_ASTAR = "astar"
+SEARCH_DIJKSTRA = "dijkstra"
+SEARCH_BIDIRECTIONAL = "bidirectional"
+# Yen's k shortest paths, the cheapest is the plan and the others are kept as alternatives
+SEARCH_K_SHORTEST = "k_shortest"
+SEARCH_ALGORITHMS = (SEARCH_ASTAR, SEARCH_DIJKSTRA, SEARCH_BIDIRECTIONAL, SEARCH_K_SHORTEST)
+DEFAULT_K_PATHS = 3
+
 def is_float(val):
     try:
         float(val)
@@ -28,14 +56,27 @@ def is_float(val):
         return False
 
 
-def reconstruct_path(came_from, start, goal):
-    path = [goal]
-    current = goal
-    while current != start:
-        current = came_from[current]
-        path.append(current)
-    path.reverse()
-    return path
+def parse_weights(response_str, count):
+    """
+    Parses a JSON array of weights, returning a list of count values with None for every item that is not a number
+    or outside the weight range. The weights are matched to the edges by position, so an array of any other length
+    than count is rejected as a whole, a skipped edge would shift every later weight onto the wrong edge.
+    """
+    try:
+        values = json.loads(response_str)
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != count:
+        return [None] * count
+
+    weights = []
+    for value in values:
+        if isinstance(value, (int, float)) and not isinstance(value, bool) \
+                and WEIGHT_MIN_VALUE <= value <= WEIGHT_MAX_VALUE:
+            weights.append(float(value))
+        else:
+            weights.append(None)
+    return weights
 
 
 # It would be costly and time-consuming, but we might get better results if we estimate each criteria in
@@ -54,15 +95,60 @@ def generate_criteria_prompt():
     return criteria_prompt
 
 
+def generate_weights_prompt(edges):
+    edges_prompt = " ".join(
+        f"{number}. From state '{state_a}' to state '{state_b}' for the task '{task}'."
+        for number, (state_a, state_b, task) in enumerate(edges, start=1)
+    )
+    prompt = (
+        f"Please provide float values representing the weights of the following edges between states: {edges_prompt} "
+        f"Consider the following criteria for each edge: "
+        f"{generate_criteria_prompt()}"
+        f"Lower values are considered better. Respond with only a JSON array of {len(edges)} float values in the same "
+        f"order as the edges, each within the range [{WEIGHT_MIN_VALUE}, {WEIGHT_MAX_VALUE}]."
+    )
+    return prompt
+
+
 class SearchPlanner:
 
-    def __init__(self, initial_state, goal_task, capabilities_input, max_iterations, send_update_callback=None):
+    def __init__(self, initial_state, goal_task, capabilities_input, max_iterations, send_update_callback=None,
+                 precompute_heuristic=False, max_in_flight=None, weight_batch_rounds=WEIGHT_BATCH_ROUNDS,
+                 checkpoint_path=None, sampling_strategy=SAMPLING_UNIFORM, search_algorithm=SEARCH_ASTAR,
+                 k_paths=DEFAULT_K_PATHS, canonicalize_nodes=True, merge_threshold=DEFAULT_MERGE_THRESHOLD):
+        if search_algorithm not in SEARCH_ALGORITHMS:
+            raise ValueError(f"Unknown search algorithm '{search_algorithm}', expected one of "
+                             f"{', '.join(SEARCH_ALGORITHMS)}.")
         self.initial_state = initial_state
         self.goal_task = goal_task
         self.capabilities_input = capabilities_input
         self.max_iterations = max_iterations
-        self.graph_manager = GraphManager()
+        # How the pairs of tasks to connect are chosen, see graph_manager.SAMPLING_STRATEGIES
+        self.graph_manager = GraphManager(sampling_strategy)
         self.send_update_callback = send_update_callback
+        # Heuristic estimates are memoized per search, optionally for every node before the search starts
+        self.heuristic_oracle = HeuristicOracle(self.heuristic)
+        self.precompute_heuristic = precompute_heuristic
+        self.search_algorithm = search_algorithm
+        # Number of paths found by the k_shortest search, the paths after the first are kept in alternative_paths
+        self.k_paths = k_paths
+        self.alternative_paths = []
+        # Generated tasks that paraphrase an existing node are merged into it instead of becoming new nodes
+        self.canonicalizer = NodeCanonicalizer(merge_threshold) if canonicalize_nodes else None
+        # Number of graph expansion rounds run at once, defaults to the concurrency allowed by the LLM client
+        self.max_in_flight = max_in_flight if max_in_flight is not None else openai_api.llm_client.max_concurrency
+        self.weight_batch_rounds = weight_batch_rounds
+        self.plan_id = f"search-{uuid.uuid4()}"
+        # Expansion rounds already run and executable tasks waiting to be scored, restored when resuming
+        self.start_iteration = 0
+        self.start_expansions = []
+        # The graph is saved to checkpoint_path while it's constructed so an interrupted run can be resumed
+        self.checkpointer = Checkpointer(checkpoint_path, CHECKPOINT_KIND, {
+            "initial_state": initial_state,
+            "goal_task": goal_task,
+            "capabilities_input": capabilities_input,
+            "max_iterations": max_iterations,
+        }) if checkpoint_path else None
 
         # Add the initial state and goal task to the graph
         self.graph_manager.add_node(initial_state)
@@ -71,6 +157,37 @@ class SearchPlanner:
         # Connect the initial state to the goal task with a default weight
         default_weight = float('inf')
         self.graph_manager.add_edge(initial_state, goal_task, default_weight)
+        if self.canonicalizer is not None:
+            self.canonicalizer.add(initial_state)
+            self.canonicalizer.add(goal_task)
+
+    @classmethod
+    def resume(cls, checkpoint_path, send_update_callback=None, **options):
+        # Continues the graph construction saved in checkpoint_path, new progress is saved to the same file
+        meta, records = read_checkpoint(checkpoint_path, CHECKPOINT_KIND)
+        planner = cls(meta["initial_state"], meta["goal_task"], meta["capabilities_input"], meta["max_iterations"],
+                      send_update_callback, checkpoint_path=checkpoint_path, **options)
+        for record in records:
+            if record["type"] == "node":
+                planner.graph_manager.add_node(record["node"])
+            elif record["type"] == "edge":
+                planner.graph_manager.add_edge(record["source"], record["target"], record["weight"])
+            elif record["type"] == "progress":
+                planner.start_iteration = record["iteration"]
+                planner.start_expansions = [tuple(expansion) for expansion in record["pending_expansions"]]
+        if planner.canonicalizer is not None:
+            # Also merges the duplicates of checkpoints saved without canonicalization
+            planner.canonicalizer.merge_duplicates(planner.graph_manager,
+                                                   (planner.initial_state, planner.goal_task))
+        print(f"Resuming graph construction at iteration {planner.start_iteration} of {planner.max_iterations}")
+        return planner
+
+    def checkpoint_records(self, iteration, pending_expansions):
+        records = [{"type": "node", "node": node} for node in self.graph_manager.get_nodes()]
+        records.extend({"type": "edge", "source": source, "target": target, "weight": weight}
+                       for source, target, weight in self.graph_manager.get_edges())
+        records.append({"type": "progress", "iteration": iteration, "pending_expansions": pending_expansions})
+        return records
 
     def select_valid_random_tasks(self):
         task_a, task_b = self.graph_manager.select_random_tasks(self.initial_state, self.goal_task)
@@ -102,49 +219,141 @@ class SearchPlanner:
                 print(current_task_node.task_name)
                 current_task_node = current_task_node.children[0] if current_task_node.children else None
 
+    def expand(self, task_a, task_b):
+        """
+        Runs one expansion round between task_a and task_b on a worker thread.
+        The graph isn't modified here, the executable task is returned to the planning thread to be scored.
+        """
+        intermediate_task = self.generate_task(task_a, task_b)
+        print(f"Generated task: {intermediate_task}")
+        if self.canonicalizer is not None:
+            # A paraphrase reuses the existing node, and the prompts below are the ones already cached for it
+            canonical_task = self.canonicalizer.canonicalize(intermediate_task)
+            if canonical_task != intermediate_task:
+                print(f"Merged generated task into '{canonical_task}'")
+                intermediate_task = canonical_task
+            if intermediate_task in (task_a, task_b):
+                return None
+        translated_task = self.translate_task(intermediate_task, self.capabilities_input)
+        print(f"Translated task: {translated_task}")
+
+        # Provide task_a to the translated task as state to help determine its executability
+        if not can_execute(translated_task, self.capabilities_input, task_a):
+            return None
+
+        return task_a, task_b, intermediate_task, translated_task
+
+    def score_expansions(self, expansions):
+        # Weighs the edges of several expansion rounds with one batched request
+        edges = []
+        for task_a, task_b, intermediate_task, translated_task in expansions:
+            edges.append((task_a, intermediate_task, translated_task))
+            edges.append((intermediate_task, task_b, translated_task))
+        weights = self.calculate_weights(edges)
+
+        scored_expansions = []
+        for index, (task_a, task_b, intermediate_task, _) in enumerate(expansions):
+            weight_a_to_intermediate, weight_intermediate_to_b = weights[2 * index], weights[2 * index + 1]
+            print(f"Weight from '{task_a}' to '{intermediate_task}': {weight_a_to_intermediate}")
+            print(f"Weight from '{intermediate_task}' to '{task_b}': {weight_intermediate_to_b}")
+            scored_expansions.append(
+                (task_a, task_b, intermediate_task, weight_a_to_intermediate, weight_intermediate_to_b))
+        return scored_expansions
+
+    def apply_expansion(self, expansion):
+        # Only called from the planning thread, which is the single writer of the graph
+        task_a, task_b, intermediate_task, weight_a_to_intermediate, weight_intermediate_to_b = expansion
+
+        # Add the intermediate task to the graph and connect it to the selected tasks
+        self.graph_manager.add_node(intermediate_task)
+        self.graph_manager.add_edge(task_a, intermediate_task, weight_a_to_intermediate)
+        self.graph_manager.add_edge(intermediate_task, task_b, weight_intermediate_to_b)
+
+        """
+        Remove the edge between task_a and task_b, if one exists
+        LLMs do not seem to be good at providing cost estimates that are comparable between 
+        larger and smaller tasks. Using intermediary steps seems to produce better results on average.
+        """
+        if self.graph_manager.has_edge(task_a, task_b) is True:
+            self.graph_manager.delete_edge(task_a, task_b)
+
+    def construct_graph(self):
+        """
+        Runs up to max_in_flight expansion rounds at once. New rounds are only started when earlier ones finish,
+        and the rounds themselves block on the LLM client's rate limits, so a saturated quota stops new work.
+        Executable tasks are collected and their edges are weighed in batches of weight_batch_rounds rounds.
+        """
+        in_flight = {}  # future -> expansions being scored for scoring batches, None for expansion rounds
+        pending_expansions = list(self.start_expansions)
+        iteration = self.start_iteration
+
+        try:
+            # One extra worker so that a scoring batch can run while the expansion rounds fill the pool
+            with ContextThreadPoolExecutor(max_workers=self.max_in_flight + 1,
+                                           thread_name_prefix="graph-expansion") as executor:
+                while iteration < self.max_iterations or in_flight or pending_expansions:
+                    while iteration < self.max_iterations and len(in_flight) < self.max_in_flight:
+                        iteration += 1
+                        print(f"Iteration {iteration} of {self.max_iterations}")
+                        task_a, task_b = self.select_valid_random_tasks()
+                        in_flight[executor.submit(self.expand, task_a, task_b)] = None
+
+                    rounds_running = any(batch is None for batch in in_flight.values())
+                    if len(pending_expansions) >= self.weight_batch_rounds or \
+                            (pending_expansions and iteration >= self.max_iterations and not rounds_running):
+                        batch = pending_expansions[:self.weight_batch_rounds]
+                        pending_expansions = pending_expansions[self.weight_batch_rounds:]
+                        in_flight[executor.submit(self.score_expansions, batch)] = batch
+
+                    done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # Popped once its result is in, a failed round or batch is left to be redone on resume
+                        result = future.result()
+                        batch = in_flight.pop(future)
+                        if batch is not None:
+                            for expansion in result:
+                                self.apply_expansion(expansion)
+                        elif result is not None:
+                            pending_expansions.append(result)
+
+                    if self.checkpointer is not None:
+                        self.checkpointer.maybe_save(lambda: self.checkpoint_records(
+                            *self.completed_progress(iteration, pending_expansions, in_flight)))
+        finally:
+            # Also saved when an LLM call fails for good, so that a restart continues from the last completed round
+            if self.checkpointer is not None:
+                self.checkpointer.save(lambda: self.checkpoint_records(
+                    *self.completed_progress(iteration, pending_expansions, in_flight)))
+
+    def completed_progress(self, iteration, pending_expansions, in_flight):
+        # Rounds still running are left out of a checkpoint and run again on resume, batches being scored are kept
+        running_rounds = sum(1 for batch in in_flight.values() if batch is None)
+        scoring = [expansion for batch in in_flight.values() if batch is not None for expansion in batch]
+        return iteration - running_rounds, [list(expansion) for expansion in scoring + pending_expansions]
+
     def plan(self):
-        # Phase 1: Construct the graph
-        for iteration in range(self.max_iterations):
-            print(f"Iteration {iteration + 1} of {self.max_iterations}")
-
-            task_a, task_b = self.select_valid_random_tasks()
-
-            intermediate_task = self.generate_task(task_a, task_b)
-            print(f"Generated task: {intermediate_task}")
-            translated_task = self.translate_task(intermediate_task, self.capabilities_input)
-            print(f"Translated task: {translated_task}")
-
-            # Provide task_a to the translated task as state to help determine its executability
-            if can_execute(translated_task, self.capabilities_input, task_a):
-                weight_a_to_intermediate = self.calculate_weight(task_a, intermediate_task, translated_task)
-                weight_intermediate_to_b = self.calculate_weight(intermediate_task, task_b, translated_task)
-                print(f"Weight from '{task_a}' to '{intermediate_task}': {weight_a_to_intermediate}")
-                print(f"Weight from '{intermediate_task}' to '{task_b}': {weight_intermediate_to_b}")
-
-                # Add the intermediate task to the graph and connect it to the selected tasks
-                self.graph_manager.add_node(intermediate_task)
-                self.graph_manager.add_edge(task_a, intermediate_task, weight_a_to_intermediate)
-                self.graph_manager.add_edge(intermediate_task, task_b, weight_intermediate_to_b)
-
-                """
-                Remove the edge between task_a and task_b, if one exists
-                LLMs do not seem to be good at providing cost estimates that are comparable between 
-                larger and smaller tasks. Using intermediary steps seems to produce better results on average.
-                """
-                if self.graph_manager.has_edge(task_a, task_b) is True:
-                    self.graph_manager.delete_edge(task_a, task_b)
-
-        # Phase 2: Perform A* search on the constructed graph
-        path = self.astar_search(self.initial_state, self.goal_task)
-        # Convert the path into task_nodes so that it can be visualized
-        task_node_plan = self.convert_search_plan_to_task_node_plan(path)
-
-        # Print the plan
-        self.print_plan(task_node_plan)
-
-        return task_node_plan
+        # LLM calls made while planning are attributed to this plan in the telemetry
+        with llm_plan(self.plan_id):
+            # Phase 1: Construct the graph
+            self.construct_graph()
+            if self.canonicalizer is not None:
+                print(f"Merged {self.canonicalizer.merges} generated tasks into existing nodes, "
+                      f"the graph has {len(self.graph_manager.node_list)} nodes")
+
+            # Phase 2: Search the constructed graph
+            path = self.search(self.initial_state, self.goal_task)
+            # Convert the path into task_nodes so that it can be visualized
+            task_node_plan = self.convert_search_plan_to_task_node_plan(path)
+            if self.send_update_callback and task_node_plan:
+                self.send_update_callback(task_node_plan)
+
+            # Print the plan
+            self.print_plan(task_node_plan)
+
+            return task_node_plan
 
     @trace_function_calls
+    @llm_stage("generate_task")
     def generate_task(self, state_a, state_b):
         good_task_description = (
             "A good task should be relevant, achievable with given capabilities, efficient, low-risk, "
@@ -162,65 +371,102 @@ class SearchPlanner:
         return task
 
     @trace_function_calls
+    @llm_stage("translate_task")
     def translate_task(self, task, capabilities_input):
         prompt = (f"Translate the task '{task}' into a form that can be executed using the following capabilities: "
                   f"'{capabilities_input}'. Provide the executable form in a single line without any commentary "
                   f"or superfluous text.")
-        response = call_openai_api(prompt)
+        response = call_openai_api(prompt, temperature=0)
         translated_task = response.choices[0].message.content.strip()
         log_response("translate_task", translated_task)
         return translated_task
 
     @trace_function_calls
     def calculate_weight(self, state_a, state_b, task):
-        criteria_prompt = generate_criteria_prompt()
-        prompt = (
-            f"Please provide a float value representing the weight of the edge between state '{state_a}' and state '{state_b}' for the task '{task}', considering the following criteria: "
-            f"{criteria_prompt}"
-            f"Lower values are considered better. Ensure the response is a float value within the range [{WEIGHT_MIN_VALUE}, {WEIGHT_MAX_VALUE}]."
-        )
+        return self.calculate_weights([(state_a, state_b, task)])[0]
+
+    @trace_function_calls
+    @llm_stage("calculate_weight")
+    def calculate_weights(self, edges):
+        """
+        Scores a list of (state_a, state_b, task) edges with a single request that returns a JSON array of weights.
+        Items outside the valid range are requested again on their own, and every edge is when the reply doesn't
+        have one weight per edge. The retry prompt quotes the rejected reply.
+        """
+        weights = [None] * len(edges)
+        unscored = list(range(len(edges)))
 
         max_retries = 5
+        response_str = None
         for attempt in range(max_retries):
-            response = call_openai_api(prompt, max_tokens=10)
-
+            prompt = generate_weights_prompt([edges[index] for index in unscored])
+            if attempt > 0:
+                prompt += (f" Your previous reply '{response_str[:WEIGHT_RETRY_QUOTED_CHARACTERS]}' couldn't be used, "
+                           f"it must be a JSON array of exactly {len(unscored)} numbers within the range.")
+            response = call_openai_api(prompt, max_tokens=WEIGHT_TOKENS_PER_EDGE * len(unscored) + 10,
+                                       temperature=0 if attempt == 0 else WEIGHT_RETRY_TEMPERATURE,
+                                       use_cache=attempt == 0)
             response_str = response.choices[0].message.content.strip()
 
-            # Check if the response is a valid float
-            if is_float(response_str):
-                weight = float(response_str)
-                log_response("calculate_weight", weight)
-                return weight
-            else:
-                if attempt < max_retries - 1:
-                    continue
-                else:
-                    raise ValueError("Failed to convert response to float after multiple attempts.")
+            parsed_weights = parse_weights(response_str, len(unscored))
+            for index, weight in zip(list(unscored), parsed_weights):
+                if weight is not None:
+                    weights[index] = weight
+                    unscored.remove(index)
 
-    def astar_search(self, start, goal):
-        open_list = []
-        heapq.heappush(open_list, (0, start))
-        came_from = {}
-        cost_so_far = {start: 0}
+            log_response("calculate_weight", response_str)
+            if not unscored:
+                return weights
 
-        while open_list:
-            _, current = heapq.heappop(open_list)
+        raise ValueError("Failed to convert response to float after multiple attempts.")
 
-            if current == goal:
-                return reconstruct_path(came_from, start, goal)
+    def search(self, start, goal):
+        # Cheapest path of tasks from start to goal with the configured algorithm, None when there's none
+        graph_manager = self.graph_manager
+        start_id = graph_manager.node_id(start)
+        goal_id = graph_manager.node_id(goal)
+        if start_id is None or goal_id is None:
+            return None
 
-            for next_node, edge_cost in self.graph_manager.get_neighbors(current):
-                new_cost = cost_so_far[current] + edge_cost
-                if next_node not in cost_so_far or new_cost < cost_so_far[next_node]:
-                    cost_so_far[next_node] = new_cost
-                    priority = new_cost + self.estimate_cost(current, next_node, goal)
-                    heapq.heappush(open_list, (priority, next_node))
-                    came_from[next_node] = current
+        self.alternative_paths = []
+        if self.search_algorithm == SEARCH_ASTAR:
+            result = self.astar_search(start, goal)
+        elif self.search_algorithm == SEARCH_DIJKSTRA:
+            result = dijkstra(graph_manager, start_id, goal_id)
+        elif self.search_algorithm == SEARCH_BIDIRECTIONAL:
+            result = bidirectional_dijkstra(graph_manager, start_id, goal_id)
+        else:
+            paths = yen_k_shortest_paths(graph_manager, start_id, goal_id, self.k_paths)
+            result = paths[0] if paths else None
+            self.alternative_paths = [(cost, [graph_manager.node_text(node_id) for node_id in path])
+                                      for cost, path in paths[1:]]
+            for cost, path in self.alternative_paths:
+                print(f"Alternative plan with cost {cost}: {' -> '.join(path)}")
+
+        if result is None:
+            return None
+        _, path = result
+        return [graph_manager.node_text(node_id) for node_id in path]
 
-        return None
+    def astar_search(self, start, goal):
+        # (cost, path of node ids) with the LLM heuristic, estimates are memoized for this search
+        self.heuristic_oracle.reset()
+        if self.precompute_heuristic:
+            self.heuristic_oracle.precompute(self.graph_manager.get_nodes(), goal)
+
+        node_text = self.graph_manager.node_text
+        return astar(
+            self.graph_manager,
+            self.graph_manager.node_id(start),
+            self.graph_manager.node_id(goal),
+            heuristic=lambda node_id: self.heuristic_oracle.get(node_text(node_id), goal),
+            prefetch=lambda node_ids: self.heuristic_oracle.prefetch([node_text(node_id) for node_id in node_ids],
+                                                                     goal),
+        )
 
     @trace_function_calls
-    def heuristic(self, current, next_node, goal):
+    @llm_stage("heuristic")
+    def heuristic(self, next_node, goal):
         criteria_prompt = generate_criteria_prompt()
         prompt = (
             f"Please estimate the remaining cost to reach the goal state '{goal}' from the current state '{next_node}', "
@@ -231,7 +477,7 @@ class SearchPlanner:
 
         max_retries = 5
         for attempt in range(max_retries):
-            response = call_openai_api(prompt, max_tokens=10)
+            response = call_openai_api(prompt, max_tokens=10, temperature=0, use_cache=attempt == 0)
 
             response_str = response.choices[0].message.content.strip()
 
@@ -245,12 +491,3 @@ class SearchPlanner:
                     continue
                 else:
                     raise ValueError("Failed to convert response to float after multiple attempts.")
-
-    def estimate_cost(self, current, next_node, goal):
-        # Use the weight of the edge between the current and next_node as part of the cost estimation
-        edge_weight = self.graph_manager.get_edge_weight(current, next_node)
-
-        # Call the heuristic function to get an admissible heuristic cost
-        heuristic_cost = self.heuristic(current, next_node, goal)
-
-        return edge_weight + heuristic_cost
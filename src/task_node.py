@@ -1,6 +1,6 @@
 import uuid
 
-from text_utils import trace_function_calls
+from tracing import trace_function_calls, TRACE_DEBUG
 
 
 class TaskNode:
@@ -10,12 +10,31 @@ class TaskNode:
         self.parent = parent
         self.children = []
         self.status = status
+        # Set once the task has been identified as primitive and executed
+        self.is_primitive = False
 
-    @trace_function_calls
+    @trace_function_calls(level=TRACE_DEBUG)
     def add_child(self, child_node):
         self.children.append(child_node)
         child_node.parent = self
 
-    @trace_function_calls
+    @trace_function_calls(level=TRACE_DEBUG)
     def update_task_name(self, task_name):
-        self.task_name = task_name
\ No newline at end of file
+        self.task_name = task_name
+
+    def to_dict(self):
+        return {
+            "task_name": self.task_name,
+            "status": self.status,
+            "is_primitive": self.is_primitive,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+    @classmethod
+    def from_dict(cls, data, parent=None):
+        # Creates new nodes with fresh node names so that a stored subtree can be reused more than once
+        task_node = cls(data["task_name"], parent=parent, status=data.get("status"))
+        task_node.is_primitive = data.get("is_primitive", False)
+        for child_data in data.get("children", []):
+            task_node.add_child(cls.from_dict(child_data, parent=task_node))
+        return task_node
\ No newline at end of file
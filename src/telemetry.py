@@ -0,0 +1,262 @@
+"""
+Per call LLM telemetry. Every chat completion and guidance program run is recorded as a span tagged with the
+planner stage that made it (decompose, can_execute, heuristic, fitness_score...) and the plan it belongs to.
+Spans feed latency histograms and token/cost counters, and can be exported to a JSONL file and a Prometheus
+text endpoint.
+
+    LLM_TELEMETRY_JSONL - File the spans are appended to (default logs/llm_spans.jsonl, empty to disable)
+    LLM_TELEMETRY_PORT - Port of the local Prometheus endpoint, not started unless set
+"""
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, float("inf"))
+
+# GPT-4 prices in dollars per 1000 tokens
+PROMPT_TOKEN_COST = 0.03
+COMPLETION_TOKEN_COST = 0.06
+
+UNKNOWN_STAGE = "unknown"
+
+current_stage = contextvars.ContextVar("current_stage", default=UNKNOWN_STAGE)
+current_plan = contextvars.ContextVar("current_plan", default=None)
+
+
+class llm_stage:
+    """
+    Tags the LLM calls made inside it with a planner stage.
+    Use as a decorator, @llm_stage("can_execute"), or as a context manager.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(current_stage.set(self.stage))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current_stage.reset(self._tokens.pop())
+
+    def __call__(self, func):
+        stage = self.stage
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = current_stage.set(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                current_stage.reset(token)
+        return wrapper
+
+
+class llm_plan:
+    """
+    Attributes the LLM calls made inside it to a plan, so that the cost of each plan can be reported.
+    """
+
+    def __init__(self, plan_id):
+        self.plan_id = plan_id
+        self._token = None
+
+    def __enter__(self):
+        self._token = current_plan.set(self.plan_id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current_plan.reset(self._token)
+
+
+def token_cost(prompt_tokens, completion_tokens):
+    return prompt_tokens / 1000 * PROMPT_TOKEN_COST + completion_tokens / 1000 * COMPLETION_TOKEN_COST
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for index, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def quantile(self, q):
+        # Upper bound of the bucket containing the quantile
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for upper_bound, bucket_count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return upper_bound
+        return LATENCY_BUCKETS[-1]
+
+
+class StageMetrics:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, span):
+        self.calls += 1
+        self.latency.observe(span["latency_seconds"])
+        self.errors += 1 if span["error"] else 0
+        self.retries += span["retries"]
+        self.cache_hits += 1 if span["cache_hit"] else 0
+        self.prompt_tokens += span["prompt_tokens"]
+        self.completion_tokens += span["completion_tokens"]
+
+    def to_dict(self, total_seconds):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "cache_hits": self.cache_hits,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": token_cost(self.prompt_tokens, self.completion_tokens),
+            "latency_seconds": self.latency.sum,
+            "latency_share": self.latency.sum / total_seconds if total_seconds else 0.0,
+            "p50_seconds": self.latency.quantile(0.5),
+            "p95_seconds": self.latency.quantile(0.95),
+        }
+
+
+class Telemetry:
+    def __init__(self, jsonl_path=None):
+        self.jsonl_path = jsonl_path
+        self.stages = {}
+        self.plans = {}
+        self._jsonl_file = None
+        self._server = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(jsonl_path=os.environ.get("LLM_TELEMETRY_JSONL", "logs/llm_spans.jsonl") or None)
+
+    def start_span(self, kind, name):
+        return {
+            "timestamp": time.time(),
+            "kind": kind,
+            "name": name,
+            "stage": current_stage.get(),
+            "plan": current_plan.get(),
+            "start": time.perf_counter(),
+            "latency_seconds": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "retries": 0,
+            "cache_hit": False,
+            "error": None,
+        }
+
+    def end_span(self, span):
+        span["latency_seconds"] = time.perf_counter() - span.pop("start")
+        with self._lock:
+            self.stages.setdefault(span["stage"], StageMetrics()).record(span)
+            if span["plan"] is not None:
+                self.plans.setdefault(span["plan"], StageMetrics()).record(span)
+            self._write_span(span)
+
+    def _write_span(self, span):
+        if not self.jsonl_path:
+            return
+        if self._jsonl_file is None:
+            log_dir = os.path.dirname(self.jsonl_path)
+            if log_dir and not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            self._jsonl_file = open(self.jsonl_path, "a", buffering=1)
+        self._jsonl_file.write(json.dumps(span) + "\n")
+
+    def summary(self):
+        with self._lock:
+            total_seconds = sum(metrics.latency.sum for metrics in self.stages.values())
+            return {stage: metrics.to_dict(total_seconds) for stage, metrics in self.stages.items()}
+
+    def plan_summary(self, plan_id):
+        with self._lock:
+            metrics = self.plans.get(plan_id)
+            return metrics.to_dict(metrics.latency.sum) if metrics is not None else None
+
+    def discard_plan(self, plan_id):
+        # The per plan metrics are kept until the plan is discarded, the stage totals aren't affected
+        with self._lock:
+            self.plans.pop(plan_id, None)
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"{'stage':<24}{'calls':>7}{'p50 s':>8}{'p95 s':>8}{'time %':>8}{'tokens':>10}{'cost $':>9}")
+        for stage, metrics in sorted(summary.items(), key=lambda item: item[1]["latency_seconds"], reverse=True):
+            tokens = metrics["prompt_tokens"] + metrics["completion_tokens"]
+            print(f"{stage:<24}{metrics['calls']:>7}{metrics['p50_seconds']:>8.2f}{metrics['p95_seconds']:>8.2f}"
+                  f"{metrics['latency_share'] * 100:>8.1f}{tokens:>10}{metrics['cost']:>9.3f}")
+
+    def prometheus_text(self):
+        lines = [
+            "# TYPE llm_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, metrics in self.stages.items():
+                cumulative = 0
+                for upper_bound, bucket_count in zip(LATENCY_BUCKETS, metrics.latency.bucket_counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if upper_bound == float("inf") else str(upper_bound)
+                    lines.append(f'llm_request_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'llm_request_duration_seconds_sum{{stage="{stage}"}} {metrics.latency.sum}')
+                lines.append(f'llm_request_duration_seconds_count{{stage="{stage}"}} {metrics.latency.count}')
+
+            for name, attribute in (("llm_prompt_tokens_total", "prompt_tokens"),
+                                    ("llm_completion_tokens_total", "completion_tokens"),
+                                    ("llm_retries_total", "retries"),
+                                    ("llm_errors_total", "errors"),
+                                    ("llm_cache_hits_total", "cache_hits")):
+                lines.append(f"# TYPE {name} counter")
+                for stage, metrics in self.stages.items():
+                    lines.append(f'{name}{{stage="{stage}"}} {getattr(metrics, attribute)}')
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(self, port, host="127.0.0.1"):
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = telemetry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="telemetry-metrics", daemon=True).start()
+
+    def serve_from_env(self):
+        port = os.environ.get("LLM_TELEMETRY_PORT")
+        if port and self._server is None:
+            self.serve_prometheus(int(port))
+
+
+telemetry = Telemetry.from_env()
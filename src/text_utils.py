@@ -1,68 +1,98 @@
 import os
 import re
 import datetime
+import threading
+
+from tracing import trace_function_calls, TRACE_DEBUG
+
+# Responses are parsed from concurrent workers, each entry is written in one piece
+parsing_errors_log_lock = threading.Lock()
 
 def log_parsing_errors(input_text, extracted_list):
     log_dir = "../parsing_errors"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    os.makedirs(log_dir, exist_ok=True)
 
     log_file_path = f"{log_dir}/parsing_errors.log"
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    with open(log_file_path, "a") as log_file:
+    with parsing_errors_log_lock, open(log_file_path, "a") as log_file:
         log_file.write(f"{timestamp}: Input text:\n{input_text}\n")
         log_file.write(f"{timestamp}: Extracted list:\n{', '.join(extracted_list)}\n\n")
 
-def trace_function_calls(func):
-    def wrapper(*args, **kwargs):
-        with open('function_trace.log', 'a') as log_file:
-            log_file.write(f"Function {func.__name__} called with arguments {args} and keyword arguments {kwargs}\n")
-        result = func(*args, **kwargs)
-        with open('function_trace.log', 'a') as log_file:
-            log_file.write(f"Function {func.__name__} returned {result}\n")
-        return result
-    return wrapper
-
-@trace_function_calls
+# [subtask] items, one level of nested brackets is allowed inside an item. Written as runs of plain text between
+# nested items rather than an alternation per character
+SUBTASK_PATTERN = re.compile(r'\[([^\[\]]*(?:\[[^\[\]]*\][^\[\]]*)*)\]')
+BACKTICK_COMMAND_PATTERN = re.compile(r"`(.+?)`")
+# URLs and quoted commands are swapped for indexed placeholders in a single pass, so their brackets and
+# punctuation aren't parsed, and each placeholder is restored from its own index afterwards. A URL is matched
+# atomically, (?=(...))\1, and a command can span a URL but never ends on a quote inside one, as if the URLs had
+# been replaced before the commands were looked for. Both alternatives start with a literal character so the
+# scan can skip ahead to the next 'h' or quote
+PROTECTED_PATTERN = re.compile(
+    r"h(?=(ttps?://\S+))\1"
+    r"|'(?<!\[')(?:(?=(https?://\S+))\2|(?!https?://)[^']|'')*?'(?!\])"
+)
+
+@trace_function_calls(level=TRACE_DEBUG)
 def extract_lists(text):
-    # Define patterns
-    subtask_pattern = r'\[((?:[^\[\]]|\[[^\[\]]*\])*)\]'
-    url_pattern = r'https?://\S+'
-    command_pattern = r"(?<!\[)'(?:[^']|'')*?'(?!\])"
-    backtick_command_pattern = r"`(.+?)`"
-
-    # Replace URLs and commands with placeholders
-    url_placeholder = "URL_PLACEHOLDER"
-    command_placeholder = "COMMAND_PLACEHOLDER"
-    urls_replacements = re.findall(url_pattern, text)
-    commands_replacements = re.findall(command_pattern, text)
-    text = re.sub(url_pattern, url_placeholder, text)
-    text = re.sub(command_pattern, command_placeholder, text)
-
-    # Extract subtasks
-    subtask_list = re.findall(subtask_pattern, text)
-    backtick_command_list = re.findall(backtick_command_pattern, text)
-
-    # Combine lists
-    combined_list = subtask_list + backtick_command_list
+    protected = []
+
+    def protect(match):
+        protected.append(match.group(0))
+        return f"\x00{len(protected) - 1}\x00"
+
+    # NUL delimits the placeholders, it never appears in a usable response
+    text = PROTECTED_PATTERN.sub(protect, text.replace('\x00', ''))
+
+    # Subtasks first, then the backtick commands, including the ones inside subtasks
+    combined_list = SUBTASK_PATTERN.findall(text)
+    if '`' in text:
+        combined_list.extend(BACKTICK_COMMAND_PATTERN.findall(text))
 
     # Clean list items by removing trailing punctuation marks and restoring URLs and commands
     cleaned_list = []
     for item in combined_list:
         cleaned_item = item.rstrip('.!?')
+        if protected and '\x00' in cleaned_item:
+            # Placeholders are \x00<index>\x00, so every odd part of the split is an index
+            parts = cleaned_item.split('\x00')
+            parts[1::2] = [protected[int(index)] for index in parts[1::2]]
+            cleaned_item = ''.join(parts)
+        cleaned_list.append(cleaned_item)
 
-        # Check if the cleaned item is shorter than the original and ends with a word character
-        # If so, append the last character from the original item
-        if len(cleaned_item) < len(item) and re.search(r'\w$', item):
-            cleaned_item += item[-1]
+    return cleaned_list
 
-        # Restore URLs and commands
-        while url_placeholder in cleaned_item and urls_replacements:
-            cleaned_item = cleaned_item.replace(url_placeholder, urls_replacements.pop(0), 1)
-        while command_placeholder in cleaned_item and commands_replacements:
-            cleaned_item = cleaned_item.replace(command_placeholder, commands_replacements.pop(0), 1)
+class SubtaskStreamParser:
+    """
+    Incremental counterpart of extract_lists for streamed responses. Each top level [subtask] is returned by feed
+    as soon as its closing bracket arrives, one level of nested brackets is kept inside a subtask. The complete
+    text is kept so that the final list can still be taken from extract_lists.
+    """
 
-        cleaned_list.append(cleaned_item)
+    def __init__(self):
+        self.chunks = []
+        self.current = []
+        self.depth = 0
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
 
-    return cleaned_list
\ No newline at end of file
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        subtasks = []
+        for char in chunk:
+            if char == '[':
+                if self.depth > 0:
+                    self.current.append(char)
+                self.depth += 1
+            elif char == ']' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    subtasks.append(''.join(self.current).strip().rstrip('.!?'))
+                    self.current = []
+                else:
+                    self.current.append(char)
+            elif self.depth > 0:
+                self.current.append(char)
+        return subtasks
@@ -0,0 +1,90 @@
+import atexit
+import functools
+import logging
+import os
+import queue
+import random
+import reprlib
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Trace levels, functions decorated with a level below TRACE_LEVEL are left undecorated
+TRACE_DEBUG = logging.DEBUG  # Hot helpers such as TaskNode.add_child and extract_lists
+TRACE_INFO = logging.INFO  # Planner and LLM level functions
+TRACE_OFF = logging.CRITICAL + 1
+
+TRACE_LEVELS = {"debug": TRACE_DEBUG, "info": TRACE_INFO, "off": TRACE_OFF}
+DEFAULT_TRACE_LEVEL = "info"
+
+TRACE_LEVEL = TRACE_LEVELS.get(os.environ.get("TRACE_LEVEL", DEFAULT_TRACE_LEVEL).lower())
+if TRACE_LEVEL is None:
+    print(f"Unknown TRACE_LEVEL '{os.environ['TRACE_LEVEL']}', expected one of {', '.join(TRACE_LEVELS)}. "
+          f"Using '{DEFAULT_TRACE_LEVEL}'.")
+    TRACE_LEVEL = TRACE_LEVELS[DEFAULT_TRACE_LEVEL]
+# Fraction of calls that are traced, 1.0 traces every call
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+TRACE_FILE = os.environ.get("TRACE_FILE", "function_trace.log")
+# Argument and result reprs are truncated to this many characters
+TRACE_MAX_REPR = int(os.environ.get("TRACE_MAX_REPR", 200))
+
+_trace_repr = reprlib.Repr()
+_trace_repr.maxstring = TRACE_MAX_REPR
+_trace_repr.maxother = TRACE_MAX_REPR
+_trace_repr.maxlevel = 3
+
+_trace_logger = None
+_trace_listener = None
+_trace_lock = threading.Lock()
+
+
+def _get_trace_logger():
+    # Records are handed to a background thread through a queue, the file is only written by that thread
+    global _trace_logger, _trace_listener
+
+    with _trace_lock:
+        if _trace_logger is None:
+            file_handler = logging.FileHandler(TRACE_FILE, mode="a", delay=True)
+            file_handler.setFormatter(logging.Formatter("%(message)s"))
+            record_queue = queue.SimpleQueue()
+            _trace_listener = QueueListener(record_queue, file_handler)
+            _trace_listener.start()
+            atexit.register(_trace_listener.stop)
+
+            logger = logging.getLogger("function_trace")
+            logger.setLevel(TRACE_DEBUG)
+            logger.propagate = False
+            logger.addHandler(QueueHandler(record_queue))
+            _trace_logger = logger
+        return _trace_logger
+
+
+def trace_repr(value):
+    return _trace_repr.repr(value)
+
+
+def trace_function_calls(func=None, *, level=TRACE_INFO):
+    """
+    Logs the calls and results of the decorated function to the trace file.
+    Can be used as @trace_function_calls or @trace_function_calls(level=TRACE_DEBUG).
+    """
+    if func is None:
+        return functools.partial(trace_function_calls, level=level)
+
+    # Decided once at decoration time so that disabled tracing costs nothing per call
+    if level < TRACE_LEVEL or TRACE_SAMPLE_RATE <= 0:
+        return func
+
+    logger = _get_trace_logger()
+    sample_rate = TRACE_SAMPLE_RATE
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return func(*args, **kwargs)
+
+        logger.log(level, "Function %s called with arguments %s and keyword arguments %s",
+                   func.__name__, trace_repr(args), trace_repr(kwargs))
+        result = func(*args, **kwargs)
+        logger.log(level, "Function %s returned %s", func.__name__, trace_repr(result))
+        return result
+    return wrapper
@@ -0,0 +1,123 @@
+import threading
+
+# Patch operations sent to the frontend, nodes are identified by TaskNode.node_name
+NODE_ADDED = "node-added"
+NODE_REMOVED = "node-removed"
+STATUS_CHANGED = "status-changed"
+RENAMED = "renamed"
+
+
+class TaskTreePublisher:
+    """
+    Publishes changes to a TaskNode tree as patches instead of re-sending the whole tree.
+    Only the updated node and its direct children are compared with the last published view,
+    new subtrees are sent once when they first appear. Each batch of patches carries a sequence
+    number so that clients joining late can start from a snapshot and apply the patches after it.
+    """
+
+    def __init__(self, emit):
+        # emit(event, data) sends an event to the connected clients
+        self.emit = emit
+        self.sequence = 0
+        self.root_name = None
+        # node_name -> last published task_name, status, parent and children
+        self.published_nodes = {}
+        self._lock = threading.Lock()
+
+    def publish(self, task_node):
+        with self._lock:
+            patches = []
+            root_node = task_node
+            while root_node.parent is not None:
+                root_node = root_node.parent
+
+            if root_node.node_name != self.root_name:
+                # A different tree is being planned, start over with the new root
+                self.root_name = root_node.node_name
+                self.published_nodes = {}
+                self._add_subtree(root_node, patches)
+            elif task_node.node_name not in self.published_nodes:
+                # Publish from the highest ancestor the clients haven't seen yet
+                unpublished_node = task_node
+                while unpublished_node.parent.node_name not in self.published_nodes:
+                    unpublished_node = unpublished_node.parent
+                self._add_subtree(unpublished_node, patches)
+            else:
+                self._diff_node(task_node, patches)
+                for child in task_node.children:
+                    if child.node_name in self.published_nodes:
+                        self._diff_node(child, patches)
+
+            if patches:
+                self.sequence += 1
+                self.emit('task_tree_patch', {"seq": self.sequence, "patches": patches})
+
+    def publish_subtask(self, task_node, candidate, task_name):
+        # A subtask of a candidate decomposition of task_node, sent while the candidate is still being generated.
+        # Clients drop the streamed subtasks of a node once its accepted children are added
+        self.emit('subtask_streamed', {"parent": task_node.node_name, "parent_task": task_node.task_name,
+                                       "candidate": candidate, "task_name": task_name})
+
+    def _add_subtree(self, task_node, patches):
+        parent_name = task_node.parent.node_name if task_node.parent is not None else None
+        self.published_nodes[task_node.node_name] = {
+            "task_name": task_node.task_name,
+            "status": task_node.status,
+            "parent": parent_name,
+            "children": [],
+        }
+        if parent_name in self.published_nodes:
+            self.published_nodes[parent_name]["children"].append(task_node.node_name)
+
+        patches.append({
+            "op": NODE_ADDED,
+            "node_name": task_node.node_name,
+            "parent": parent_name,
+            "task_name": task_node.task_name,
+            "status": task_node.status,
+        })
+        for child in task_node.children:
+            self._add_subtree(child, patches)
+
+    def _remove_subtree(self, node_name):
+        published_node = self.published_nodes.pop(node_name)
+        for child_name in published_node["children"]:
+            self._remove_subtree(child_name)
+
+    def _diff_node(self, task_node, patches):
+        published_node = self.published_nodes[task_node.node_name]
+
+        if published_node["task_name"] != task_node.task_name:
+            published_node["task_name"] = task_node.task_name
+            patches.append({"op": RENAMED, "node_name": task_node.node_name, "task_name": task_node.task_name})
+
+        if published_node["status"] != task_node.status:
+            published_node["status"] = task_node.status
+            patches.append({"op": STATUS_CHANGED, "node_name": task_node.node_name, "status": task_node.status})
+
+        child_names = [child.node_name for child in task_node.children]
+        current_children = set(child_names)
+        for child_name in list(published_node["children"]):
+            if child_name not in current_children:
+                published_node["children"].remove(child_name)
+                self._remove_subtree(child_name)
+                patches.append({"op": NODE_REMOVED, "node_name": child_name, "parent": task_node.node_name})
+
+        for child in task_node.children:
+            if child.node_name not in self.published_nodes:
+                self._add_subtree(child, patches)
+
+    def _published_tree(self, node_name):
+        published_node = self.published_nodes[node_name]
+        return {
+            "node_name": node_name,
+            "task_name": published_node["task_name"],
+            "status": published_node["status"],
+            "children": [self._published_tree(child_name) for child_name in published_node["children"]],
+        }
+
+    def snapshot(self):
+        # Built from the published view so that it matches the sequence number exactly
+        with self._lock:
+            tree = self._published_tree(self.root_name) if self.root_name in self.published_nodes else None
+            return {"seq": self.sequence, "tree": tree}
@@ -1,20 +1,144 @@
+import hashlib
+import json
+import re
+import threading
+
 import chromadb
+import numpy as np
+from chromadb.config import Settings
+
+from task_node import TaskNode
+
+DEFAULT_PERSIST_DIRECTORY = "method_library"
+EMBEDDING_DIMENSIONS = 1024
+
+
+class HashingEmbeddingFunction:
+    """
+    Local embedding made from hashed word and character trigram features.
+    It needs no model download or network access, so the method library works offline.
+    """
+
+    def __init__(self, dimensions=EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def __call__(self, texts):
+        return [self.embed(text) for text in texts]
+
+    def features(self, text):
+        words = re.findall(r"\w+", text.lower())
+        features = list(words)
+        for word in words:
+            padded = f" {word} "
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def embed(self, text):
+        vector = np.zeros(self.dimensions)
+        for feature in self.features(text):
+            digest = hashlib.md5(feature.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimensions
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[index] += sign
+
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+
+def normalize_task_name(task_name):
+    return " ".join(re.findall(r"\w+", task_name.lower()))
+
+
+def method_document(task_name):
+    # Only the task name is embedded, the capabilities are shared by every stored task and are matched exactly
+    return normalize_task_name(task_name)
+
+
+def capabilities_key(capabilities):
+    return hashlib.sha256(capabilities.encode("utf-8")).hexdigest()
+
+
+def method_id(task_name, capabilities):
+    return hashlib.sha256(f"{method_document(task_name)}\n{capabilities}".encode("utf-8")).hexdigest()
+
+
+def subtree_depth(task_node_data):
+    if not task_node_data["children"]:
+        return 0
+    return 1 + max(subtree_depth(child) for child in task_node_data["children"])
+
+
+# One client and collection per persist directory for the whole process, every client would overwrite the files
+# written by the others when persisting, e.g. with the planning service running jobs concurrently
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+
+def get_library(persist_directory):
+    # (client, collection, lock) of the method library stored in persist_directory, in memory when it's None
+    with _libraries_lock:
+        if persist_directory not in _libraries:
+            if persist_directory:
+                client = chromadb.Client(Settings(chroma_db_impl="duckdb+parquet",
+                                                  persist_directory=persist_directory))
+            else:
+                client = chromadb.Client()
+            collection = client.get_or_create_collection(
+                "task_nodes",
+                embedding_function=HashingEmbeddingFunction(),
+                metadata={"hnsw:space": "cosine"},
+            )
+            _libraries[persist_directory] = (client, collection, threading.Lock())
+        return _libraries[persist_directory]
 
 
 class VectorDB:
-    def __init__(self):
-        # Create a chroma client
-        self.client = chromadb.Client()
+    """
+    Library of successful decompositions keyed by the normalized task name and the exact same capabilities.
+    Near-identical names like "Install git" and "Uninstall git" are different tasks, so stored decompositions are
+    looked up by their id instead of by the similarity of the embedded names.
+    """
+
+    def __init__(self, persist_directory=DEFAULT_PERSIST_DIRECTORY):
+        self.persist_directory = persist_directory
+        # Stored on disk so that decompositions are reused between runs. Concurrent plans and sibling subtrees
+        # share the collection, it's used by one of them at a time
+        self.client, self.collection, self._lock = get_library(persist_directory)
 
-        # Create a collection
-        self.collection = self.client.create_collection("task_nodes")
+    def add_task_node(self, task_name, task_node, capabilities):
+        # task_name is the name the task had before decomposition, primitive tasks are renamed when translated
+        task_node_data = task_node.to_dict()
+        metadata = {
+            "task_name": task_name,
+            "capabilities": capabilities_key(capabilities),
+            "depth": subtree_depth(task_node_data),
+            "subtree": json.dumps(task_node_data),
+        }
+        with self._lock:
+            self.collection.upsert(documents=[method_document(task_name)],
+                                   ids=[method_id(task_name, capabilities)], metadatas=[metadata])
 
-    def add_task_node(self, task_node):
-        self.collection.upsert(documents=[task_node.task_name], ids=[task_node.node_name], metadatas=[task_node])
+    def get_task_node(self, task_name, capabilities):
+        with self._lock:
+            result = self.collection.get(ids=[method_id(task_name, capabilities)])
+        if not result['metadatas']:
+            return None
+        return TaskNode.from_dict(json.loads(result['metadatas'][0]["subtree"]))
 
-    def get_task_node(self, task_node):
-        return self.collection.get(ids=[task_node.node_name])['metadatas'][0]
+    def query_by_name(self, task_name, capabilities, max_depth=None):
+        # Stored decomposition of a task with the same normalized name, None when it's deeper than max_depth
+        with self._lock:
+            result = self.collection.get(ids=[method_id(task_name, capabilities)])
+        if not result['metadatas']:
+            return None
+        metadata = result['metadatas'][0]
+        if max_depth is not None and metadata["depth"] > max_depth:
+            return None
+        return TaskNode.from_dict(json.loads(metadata["subtree"]))
 
-    def query_by_name(self, task_name):
-        task_nodes = self.collection.query(query_texts=[task_name], n_results=1)
-        return task_nodes['metadatas'][0]
+    def persist(self):
+        if self.persist_directory:
+            with self._lock:
+                self.client.persist()
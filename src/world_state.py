@@ -0,0 +1,148 @@
+import itertools
+import json
+import re
+
+# Facts rendered into a prompt, the most relevant to the prompt's focus are chosen so the prompt size stays flat
+DEFAULT_MAX_RENDERED_FACTS = 12
+
+# Key used for the free text description when the initial state can't be split into facts
+DESCRIPTION_KEY = "description"
+
+# Versions are unique across every state so they can identify a state in caches and logs
+_versions = itertools.count()
+
+
+def fact_words(text):
+    return frozenset(re.findall(r"\w+", text.lower()))
+
+
+def fact_key(key):
+    # Keys that only differ in case, spacing or punctuation name the same fact
+    return " ".join(re.findall(r"[^\W_]+", key.lower()))
+
+
+def parse_facts(response_str):
+    """
+    Parses a JSON object of facts into a {key: value} dict, a null value removes the fact.
+    Returns None when the response isn't a JSON object.
+    """
+    try:
+        facts = json.loads(response_str)
+    except ValueError:
+        return None
+    if not isinstance(facts, dict):
+        return None
+    return {str(key).strip(): None if value is None else str(value).strip() for key, value in facts.items()}
+
+
+def render_state(state, focus=None):
+    # Planner functions accept both free text states and world states
+    return state.render(focus) if isinstance(state, WorldState) else state
+
+
+def state_records(states):
+    """
+    Checkpoint records for the given states and every state they were derived from. Each state is written once,
+    parents before their children, as the delta that produced it.
+    """
+    records = {}
+    for state in states:
+        chain = []
+        while state is not None and state.version not in records:
+            chain.append(state)
+            state = state.parent
+        for state in reversed(chain):
+            record = {"type": "state", "version": state.version, "task": state.task, "delta": state.delta,
+                      "parent": state.parent.version if state.parent is not None else None}
+            if state.parent is None:
+                record["facts"] = {key: fact.value for key, fact in state.facts.items()}
+            records[state.version] = record
+    return list(records.values())
+
+
+def load_states(records):
+    # Rebuilds the states written by state_records, keyed by the version they had when they were written
+    states = {}
+    for record in records:
+        if record["parent"] is None:
+            states[record["version"]] = WorldState(facts=record["facts"])
+        else:
+            states[record["version"]] = states[record["parent"]].apply(record["delta"], record["task"])
+    return states
+
+
+class Fact:
+    __slots__ = ("value", "version", "words")
+
+    def __init__(self, key, value, version):
+        self.value = value
+        self.version = version
+        self.words = fact_words(f"{key} {value}")
+
+
+class WorldState:
+    """
+    Key/value facts about the world. A state is never modified, applying a delta returns a new state that
+    references the state it was derived from, so the per step history is kept as a chain of deltas. The fact
+    values are shared between states instead of copying the whole description after every step.
+    """
+
+    def __init__(self, facts=None, parent=None, delta=None, task=None):
+        self.version = next(_versions)
+        self.parent = parent
+        self.delta = delta or {}
+        # Task whose execution produced this state
+        self.task = task
+        self.facts = dict(parent.facts) if parent is not None else {}
+        for key, value in (facts or {}).items():
+            self.facts[key] = Fact(key, value, self.version)
+        for key, value in self.delta.items():
+            if value is None:
+                self.facts.pop(key, None)
+            else:
+                self.facts[key] = Fact(key, value, self.version)
+
+    @classmethod
+    def from_text(cls, text, facts=None):
+        # facts are the facts extracted from the text, the text itself is kept when there are none
+        return cls(facts=facts or {DESCRIPTION_KEY: text})
+
+    def apply(self, delta, task=None):
+        return WorldState(parent=self, delta=delta, task=task)
+
+    def get(self, key, default=None):
+        fact = self.facts.get(key)
+        return fact.value if fact is not None else default
+
+    def resolve_delta(self, delta):
+        # Maps the keys of a generated delta onto the existing facts they name, the model only sees some of the facts
+        # and otherwise writes a changed fact under a new key next to the stale one
+        existing_keys = {fact_key(key): key for key in self.facts}
+        resolved = {}
+        for key, value in delta.items():
+            resolved[key if key in self.facts else existing_keys.get(fact_key(key), key)] = value
+        return resolved
+
+    def relevant_facts(self, focus, max_facts=DEFAULT_MAX_RENDERED_FACTS):
+        # Ranked by the words shared with the focus, recently changed facts first on ties
+        focus_words = fact_words(focus)
+        ranked = sorted(self.facts.items(), key=lambda item: (len(item[1].words & focus_words), item[1].version),
+                        reverse=True)
+        return dict(ranked[:max_facts])
+
+    def render(self, focus=None, max_facts=DEFAULT_MAX_RENDERED_FACTS):
+        facts = self.relevant_facts(focus, max_facts) if focus is not None else self.facts
+        return "; ".join(f"{key}: {fact.value}" for key, fact in sorted(facts.items()))
+
+    def history(self):
+        # (task, delta) for every step from the initial state to this one
+        steps = []
+        state = self
+        while state.parent is not None:
+            steps.append((state.task, state.delta))
+            state = state.parent
+        steps.reverse()
+        return steps
+
+    def __str__(self):
+        return self.render()
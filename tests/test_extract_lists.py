@@ -0,0 +1,29 @@
+import random
+
+import pytest
+
+from benchmark import legacy_extract_lists, random_subtask_response
+from text_utils import extract_lists
+
+CASES_PER_SEED = 500
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_legacy_parser_on_generated_responses(seed):
+    random.seed(seed)
+    for _ in range(CASES_PER_SEED):
+        text = random_subtask_response(random.randint(0, 10))
+        assert extract_lists(text) == legacy_extract_lists(text, restore_by_position=True), text
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("", []),
+    ("[Install git], [Configure nginx.]", ["Install git", "Configure nginx"]),
+    ("[Run 'apt install git']", ["Run 'apt install git'"]),
+    ("[Download https://example.com/file.tar.gz and extract it]",
+     ["Download https://example.com/file.tar.gz and extract it"]),
+    ("[Create [config] file!!]", ["Create [config] file"]),
+    ("Run `ls -la` first", ["ls -la"]),
+])
+def test_examples(text, expected):
+    assert extract_lists(text) == expected
@@ -0,0 +1,55 @@
+import pytest
+
+from node_canonicalizer import NodeCanonicalizer
+
+MERGED_PAIRS = [
+    ("Install git", "install Git using apt"),
+    ("Install git.", "install git"),
+    ("Create a new directory called project", "Create directory called project"),
+    ("Install packages", "Install the package"),
+    ("Install nginx web server", "Install nginx server"),
+    ("Copy the config to the server", "Copy config to server using scp"),
+]
+
+DIFFERENT_PAIRS = [
+    ("Install git", "Uninstall git"),
+    ("Mount /dev/sdb1", "Unmount /dev/sdb1"),
+    ("Start the nginx service", "Restart the nginx service"),
+    ("Open port 80", "Open port 8080"),
+    ("Install Python 3.10", "Install Python 3.11"),
+    ("Create user alice", "Create user alex"),
+    ("Copy config from server A to server B", "Copy config from server B to server A"),
+    ("Create a new directory called project", "Create a new directory called backup"),
+    ("Install git", "Install git lfs"),
+    ("Start nginx", "Do not start nginx"),
+    ("Copy file to server", "Copy file from server"),
+    ("Enable the firewall", "Disable the firewall"),
+    ("Connect to the server via SSH", "Connect to the server via VNC"),
+    ("Deploy the app with Docker", "Deploy the app with Kubernetes"),
+    ("Back up the database", "Back up the database using pg_dump then delete it"),
+    ("Back up the database", "Back up the database and delete it"),
+    ("Back up the database", "Back up and delete the database"),
+    ("Restart nginx", "Restart nginx after editing the config"),
+]
+
+
+@pytest.mark.parametrize("text, other", MERGED_PAIRS)
+def test_paraphrases_merge(text, other):
+    canonicalizer = NodeCanonicalizer()
+    canonicalizer.add(text)
+    assert canonicalizer.canonicalize(other) == text
+
+
+@pytest.mark.parametrize("text, other", DIFFERENT_PAIRS)
+def test_different_tasks_dont_merge(text, other):
+    canonicalizer = NodeCanonicalizer()
+    canonicalizer.add(text)
+    assert canonicalizer.canonicalize(other) == other
+
+
+def test_tool_variants_dont_merge_through_a_tool_less_node():
+    canonicalizer = NodeCanonicalizer()
+    canonicalizer.add("Connect to the server")
+    assert canonicalizer.canonicalize("Connect to the server via SSH") == "Connect to the server"
+    assert canonicalizer.canonicalize("Connect to the server via VNC") == "Connect to the server via VNC"
+    assert canonicalizer.canonicalize("connect to the server via ssh") == "Connect to the server"